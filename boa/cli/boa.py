@@ -3,20 +3,15 @@
 
 import sys
 import argparse
-
-from conda.base.context import context
-
-from boa.core import monkey_patch_emscripten
-
-if any("emscripten" in arg for arg in sys.argv):
-    print("Monkeypatching emscripten")
-    monkey_patch_emscripten.patch()
-
-from boa.core.config import init_global_config
+from functools import partial
+
+# Only light modules are imported here, conda, libmambapy, rich, ... are
+# imported by the subcommands that need them (keeps --help and --version fast)
+from boa.core.profiling import PROFILE_FORMATS
+from boa.core.daemon_socket import SOCKET_ENV as DAEMON_SOCKET_ENV
+from boa.core.daemon_socket import daemon_supported
+from boa.core.telemetry import METRICS_FILE_ENV
 from boa._version import __version__
-from boa.core.utils import init_api_context
-
-cc_conda_build = context.conda_build if hasattr(context, "conda_build") else {}
 
 banner = r"""
            _
@@ -27,7 +22,20 @@ banner = r"""
 """
 
 
-def main(config=None):
+def pkg_formats(value):
+    formats = []
+    for f in value.split(","):
+        f = f.strip()
+        if f not in ("1", "2"):
+            raise argparse.ArgumentTypeError(
+                f"invalid package format: '{f}' (choose from '1', '2')"
+            )
+        if f not in formats:
+            formats.append(f)
+    return formats
+
+
+def get_parser():
     parser = argparse.ArgumentParser(
         description="Boa, the fast, mamba powered-build tool for conda packages."
     )
@@ -71,17 +79,76 @@ def main(config=None):
         help="Validate recipe.yaml",
     )
 
+    # The following arguments are taken directly from conda-build, they apply to
+    # builds and tests
+    conda_build_flags = argparse.ArgumentParser(add_help=False)
+    conda_build_parser = conda_build_flags.add_argument_group(
+        "special conda-build flags"
+    )
+    conda_build_parser.add_argument(
+        "--build-id-pat",
+        default=False,
+        dest="conda_build_build_id_pat",
+        help="""\
+            specify a templated pattern to use as build folder names.  Use if having issues with
+            paths being too long, or to ensure a particular build folder name.
+            When not specified, the default is to use the pattern {n}_{t}.
+            Template variables are: n: package name, t: timestamp, v: package_version""",
+    )
+    conda_build_parser.add_argument(
+        "--no-remove-work-dir",
+        dest="conda_build_remove_work_dir",
+        default=True,
+        action="store_false",
+        help="""\
+            Disable removal of the work dir before testing.  Be careful using this option, as
+            you package may depend on files that are not included in the package, and may pass
+            tests, but ultimately fail on installed systems.""",
+    )
+    conda_build_parser.add_argument(
+        "--keep-old-work",
+        action="store_true",
+        dest="conda_build_keep_old_work",
+        help="Do not remove anything from environment, even after successful build and test.",
+    )
+    conda_build_parser.add_argument(
+        "--prefix-length",
+        dest="conda_build_prefix_length",
+        help="""\
+            length of build prefix.  For packages with binaries that embed the path, this is
+            critical to ensuring that your package can run as many places as possible.  Note
+            that this value can be altered by the OS below boa (e.g. encrypted
+            filesystems on Linux), and you should prefer to set --croot to a non-encrypted
+            location instead, so that you maintain a known prefix length.""",
+        default=255,
+        type=int,
+    )
+    conda_build_parser.add_argument(
+        "--croot",
+        dest="conda_build_croot",
+        help="Build root folder.  Equivalent to CONDA_BLD_PATH, but applies only to this call of boa.",
+    )
     test_parser = argparse.ArgumentParser(add_help=False)
     test_parser.add_argument(
         "--extra-deps",
         action="append",
         help="Extra dependencies to add to all test environment creation steps.",
     )
-    subparsers.add_parser(
+    test_subparser = subparsers.add_parser(
         "test",
-        parents=[parent_parser, test_parser],
+        parents=[parent_parser, test_parser, variant_parser, conda_build_flags],
         help="test an already built package (include_recipe of the package must be true)",
     )
+    test_subparser.add_argument(
+        "--output-folder",
+        help="Local channel the test environment is resolved with (default: conda_build/output_folder of the conda config)",
+    )
+    test_subparser.add_argument(
+        "--no-update-index",
+        dest="update_channel_index",
+        action="store_false",
+        help="Do not update the index of the channel the package is in (e.g. because another process keeps it up to date)",
+    )
 
     build_parser = argparse.ArgumentParser(add_help=False)
     build_parser.add_argument(
@@ -97,7 +164,8 @@ def main(config=None):
             "folder to dump output package to.  Package are moved here if build or test succeeds."
             "  Destination folder must exist prior to using this."
         ),
-        default=cc_conda_build.get("output_folder"),
+        # defaults to conda_build/output_folder of the conda config
+        default=None,
     )
 
     build_parser.add_argument(
@@ -112,63 +180,62 @@ def main(config=None):
         dest="notest",
         help="Do not test the package.",
     )
+    build_parser.add_argument(
+        "--test-jobs",
+        type=int,
+        default=1,
+        help="""Number of tests that run in parallel (in separate processes) while
+        the remaining outputs are built. By default tests run right after the build.""",
+    )
+    build_parser.add_argument(
+        "--no-step-cache",
+        action="store_false",
+        dest="step_cache",
+        help="Do not restore non-package steps from the step cache.",
+    )
     build_parser.add_argument(
         "--continue-on-failure",
         action="store_true",
         help="Continue building remaining recipes if a recipe fails.",
     )
-    # The following arguments are taken directly from conda-build
-    conda_build_parser = build_parser.add_argument_group("special conda-build flags")
-    conda_build_parser.add_argument(
-        "--build-id-pat",
-        default=False,
-        dest="conda_build_build_id_pat",
-        help="""\
-            specify a templated pattern to use as build folder names.  Use if having issues with
-            paths being too long, or to ensure a particular build folder name.
-            When not specified, the default is to use the pattern {n}_{t}.
-            Template variables are: n: package name, t: timestamp, v: package_version""",
+    build_parser.add_argument(
+        "--profile",
+        type=str,
+        metavar="FILE",
+        help="Write the wall time, CPU time, peak memory and I/O of every build phase to FILE",
     )
-    conda_build_parser.add_argument(
-        "--no-remove-work-dir",
-        dest="conda_build_remove_work_dir",
-        default=True,
-        action="store_false",
-        help="""\
-            Disable removal of the work dir before testing.  Be careful using this option, as
-            you package may depend on files that are not included in the package, and may pass
-            tests, but ultimately fail on installed systems.""",
+    build_parser.add_argument(
+        "--profile-format",
+        choices=PROFILE_FORMATS,
+        default="json",
+        help="Format of the --profile file (json, or chrome for the Chrome trace event format)",
     )
-    conda_build_parser.add_argument(
-        "--keep-old-work",
+    build_parser.add_argument(
+        "--daemon",
         action="store_true",
-        dest="conda_build_keep_old_work",
-        help="Do not remove anything from environment, even after successful build and test.",
+        help="Run the build in the daemon started with `boa serve`",
     )
-    conda_build_parser.add_argument(
-        "--prefix-length",
-        dest="conda_build_prefix_length",
-        help="""\
-            length of build prefix.  For packages with binaries that embed the path, this is
-            critical to ensuring that your package can run as many places as possible.  Note
-            that this value can be altered by the OS below boa (e.g. encrypted
-            filesystems on Linux), and you should prefer to set --croot to a non-encrypted
-            location instead, so that you maintain a known prefix length.""",
-        default=255,
-        type=int,
+    build_parser.add_argument(
+        "--daemon-socket",
+        type=str,
+        default=None,
+        help="Socket of the daemon (default: same as `boa serve`)",
     )
-    conda_build_parser.add_argument(
-        "--croot",
-        dest="conda_build_croot",
-        help="Build root folder.  Equivalent to CONDA_BLD_PATH, but applies only to this call of `boa build`.",
+    build_parser.add_argument(
+        "--metrics-file",
+        type=str,
+        metavar="FILE",
+        help=f"Write build telemetry in the Prometheus text format to FILE (default: ${METRICS_FILE_ENV} if set)",
     )
     build_parser.add_argument(
         "--pkg-format",
         dest="conda_pkg_format",
-        choices=["1", "2"],
+        type=pkg_formats,
         default="1",
-        help="Package format version.  Version 1 is the standard .tar.bz2 format.  Version 2 is the new .conda format.",
+        help="""Package format version.  Version 1 is the standard .tar.bz2 format.  Version 2 is the new .conda format.
+        Pass a comma separated list (e.g. 1,2) to write several formats from a single build.""",
     )
+    conda_build_parser = build_parser.add_argument_group("special conda-build flags")
     conda_build_parser.add_argument(
         "--zstd-compression-level",
         help="""\
@@ -178,6 +245,15 @@ def main(config=None):
         choices=range(1, 22),
         default=22,
     )
+    conda_build_parser.add_argument(
+        "--compression-threads",
+        help="""\
+            Number of threads used to compress packages (zstd for v2 packages,
+            parallel bzip2 for v1 packages). Defaults to 0, which uses all
+            available cores.""",
+        type=int,
+        default=0,
+    )
 
     for k in ("perl", "lua", "python", "numpy", "r_base"):
         conda_build_parser.add_argument(
@@ -188,7 +264,13 @@ def main(config=None):
 
     subparsers.add_parser(
         "build",
-        parents=[parent_parser, build_parser, variant_parser],
+        parents=[
+            parent_parser,
+            conda_build_flags,
+            build_parser,
+            variant_parser,
+            test_parser,
+        ],
         help="build a recipe",
     )
 
@@ -207,45 +289,160 @@ def main(config=None):
         default=1,
         help="the number of parallel processing elements",
     )
+    transmute_parser.add_argument(
+        "--metrics-file",
+        type=str,
+        metavar="FILE",
+        help=f"Write telemetry in the Prometheus text format to FILE (default: ${METRICS_FILE_ENV} if set)",
+    )
 
-    args = parser.parse_args()
+    serve_parser = subparsers.add_parser(
+        "serve",
+        help="run a build daemon that keeps solvers and caches warm between builds",
+    )
+    serve_parser.add_argument(
+        "--socket",
+        type=str,
+        default=None,
+        help=f"Unix socket to listen on (default: ${DAEMON_SOCKET_ENV} or a socket in the runtime directory)",
+    )
+    serve_parser.add_argument(
+        "--solver-ttl",
+        type=float,
+        default=600,
+        help="Seconds after which solvers are rebuilt to pick up new repodata (default: 600)",
+    )
+    serve_parser.add_argument(
+        "--emscripten",
+        action="store_true",
+        help="Patch conda and conda-build for emscripten once at startup, required for emscripten builds",
+    )
 
-    command = args.command
+    return parser
 
-    init_api_context()
-    init_global_config(args)
 
+def patch_emscripten(argv):
+    if any("emscripten" in arg for arg in argv):
+        # has to happen before conda_build is used
+        from boa.core import monkey_patch_emscripten
+
+        print("Monkeypatching emscripten")
+        monkey_patch_emscripten.patch()
+
+
+def build(args):
+    from boa.core.config import boa_config
     from boa.core.run_build import run_build
-    from boa.cli import convert
-    from boa.cli import transmute
-    from boa.cli import validate
-    from boa.cli import test
+    from boa.core.telemetry import telemetry
+
+    boa_config.console.print(banner)
+
+    if args.command == "build" and args.output_folder is None:
+        from conda.base.context import context
+
+        cc_conda_build = getattr(context, "conda_build", {})
+        args.output_folder = cc_conda_build.get("output_folder")
+
+    with telemetry(args.command, getattr(args, "metrics_file", None)):
+        run_build(args)
+
+
+def run_in_daemon(argv, solver_ttl=600):
+    """Run ``boa argv`` in the current (daemon) process"""
+    args = get_parser().parse_args(argv)
+    if args.command not in ("build", "render"):
+        print(f"The boa daemon can not run '{args.command}'", file=sys.stderr)
+        return 2
+
+    if any("emscripten" in arg for arg in argv):
+        from boa.core import monkey_patch_emscripten
+
+        # conda and conda-build are patched for the whole process, not per build
+        if not monkey_patch_emscripten._patched:
+            print(
+                "The boa daemon was not started with `boa serve --emscripten`",
+                file=sys.stderr,
+            )
+            return 2
+
+    from boa.core.config import init_global_config
+    from boa.core.profiling import profiler
+    from boa.core.solver import expire_solvers
+    from boa.core.telemetry import metrics
+
+    init_global_config(args)
+    # every build starts with fresh measurements and current repodata
+    profiler.reset()
+    metrics.reset()
+    expire_solvers(solver_ttl)
+    build(args)
+    return 0
+
+
+def main(config=None):
+    parser = get_parser()
+    args = parser.parse_args()
+
+    command = args.command
+
+    if not command:
+        print(banner)
+        parser.print_help(sys.stdout)
+        return
 
     if command == "convert":
+        from boa.cli import convert
+
         convert.main(args.target)
         exit()
 
+    if command == "serve" or (command == "build" and args.daemon):
+        if not daemon_supported():
+            print(
+                "The boa daemon needs Unix sockets, which this platform does not support",
+                file=sys.stderr,
+            )
+            exit(1)
+
+    if command == "build" and args.daemon:
+        from boa.core.daemon import submit
+
+        exit(submit(sys.argv[1:], args.daemon_socket))
+
+    # also applies the patches of `serve --emscripten`
+    patch_emscripten(sys.argv)
+
+    from boa.core.config import init_global_config
+    from boa.core.utils import init_api_context
+
+    init_api_context()
+    init_global_config(args)
+
     if command == "validate":
+        from boa.cli import validate
+
         validate.main(args.target)
         exit()
 
     if command == "test":
+        from boa.cli import test
+
         test.main(args)
         exit()
 
     if command == "transmute":
+        from boa.cli import transmute
+
         transmute.main(args)
         exit()
 
-    from boa.core.config import boa_config
-
-    boa_config.console.print(banner)
+    if command == "serve":
+        from boa.core.daemon import serve
 
-    if command == "build" or command == "render":
-        run_build(args)
+        serve(partial(run_in_daemon, solver_ttl=args.solver_ttl), args.socket)
+        exit()
 
-    if not command:
-        parser.print_help(sys.stdout)
+    build(args)
 
 
 if __name__ == "__main__":
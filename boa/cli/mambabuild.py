@@ -22,6 +22,8 @@ from boa.core.solver import MambaSolver
 from boa.core.utils import normalize_subdir
 from boa.core.utils import init_api_context
 from boa.core.config import boa_config
+from boa.core.profiling import profiler
+from boa.core.telemetry import metrics, telemetry
 
 only_dot_or_digit_re = re.compile(r"^[\d\.]+$")
 
@@ -95,6 +97,7 @@ def _get_solver(channel_urls, subdir, output_folder):
     """Gets a solver from cache or creates a new one if needed."""
     subdir = normalize_subdir(subdir)
 
+    metrics.cache_lookup("solver", subdir in solver_map)
     if subdir in solver_map:
         solver = solver_map[subdir]
         solver.replace_channels()
@@ -139,7 +142,8 @@ def mamba_get_package_records(
     _specs = [s.conda_build_form() for s in _specs]
     try:
         # We only create fresh environments in builds and can ignore unlink precs.
-        _, link_precs = solver.solve_for_unlink_link_precs(_specs, prefix)
+        with profiler.phase("solve"):
+            _, link_precs = solver.solve_for_unlink_link_precs(_specs, prefix)
     except RuntimeError as e:
         conflict_packages = parse_problems(str(e))
 
@@ -298,4 +302,10 @@ def main():
     else:
         action = "build"
 
-    call_conda_build(action, config)
+    # conda-build parses the arguments, telemetry is enabled by $BOA_METRICS_FILE
+    with telemetry("mambabuild"):
+        result = call_conda_build(action, config)
+        if action == "build":
+            for path in result or []:
+                if os.path.isfile(path):
+                    metrics.record_package(path)
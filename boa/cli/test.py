@@ -1,7 +1,10 @@
 # Copyright (C) 2021, QuantStack
 # SPDX-License-Identifier: BSD-3-Clause
+import os
+
 from boa.core.run_build import initialize_conda_build_config
 from boa.core.test import run_test
+from boa.core.utils import get_config
 
 from rich.console import Console
 
@@ -11,6 +14,19 @@ console = Console()
 def main(args):
     stats = {}
     config = initialize_conda_build_config(args)
+    if getattr(args, "output_folder", None):
+        config.output_folder = os.path.abspath(args.output_folder)
+    config.update_channel_index = getattr(args, "update_channel_index", True)
+
+    if args.target_platform or args.variant_config_files:
+        # same configuration as `boa build` with these options
+        from conda.base.context import context
+
+        variant = {"target_platform": args.target_platform or context.subdir}
+        folder = args.recipe_dir or os.path.dirname(os.path.abspath(args.target))
+        _, config = get_config(
+            folder, variant, args.variant_config_files, config=config
+        )
 
     run_test(
         args.target,
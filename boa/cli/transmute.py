@@ -1,19 +1,26 @@
 # Copyright (C) 2021, QuantStack
 # SPDX-License-Identifier: BSD-3-Clause
 
-from glob import glob
 import os
-from pathlib import Path
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from glob import iglob
 from math import log
-from libmambapy import transmute as mamba_transmute
-from joblib import Parallel, delayed
 
 from rich.console import Console
 
+from boa.core.telemetry import metrics, telemetry
+
 console = Console()
 
 unit_list = list(zip(["bytes", "kB", "MB", "GB", "TB", "PB"], [0, 0, 1, 2, 2, 2]))
 
+# a crashed worker takes the whole pool down, the files it was working on are
+# retried this many times on a new pool
+MAX_RETRIES = 1
+
 
 def sizeof_fmt(num):
     """Human friendly file size"""
@@ -29,52 +36,171 @@ def sizeof_fmt(num):
         return "1 byte"
 
 
-def transmute_task(f, args):
+def output_path(f, output_folder):
+    """Path of the transmuted package of ``f``, None if ``f`` is not a package"""
     filename = os.path.basename(f)
-    outpath = os.path.abspath(args.output_directory)
-
-    if f.endswith(".tar.bz2"):
-        filename = filename[:-8]
-        outfile = os.path.join(outpath, filename + ".conda")
-    elif f.endswith(".conda"):
-        filename = filename[:-6]
-        outfile = os.path.join(outpath, filename + ".tar.bz2")
-    else:
-        console.print("[bold red]Transmute can only handle .tar.bz2 and .conda formats")
-
-    console.print(f"Processing {filename}")
-    mamba_transmute(f, outfile, args.compression_level)
-
-    stat_before = Path(f).stat()
-    stat_after = Path(outfile).stat()
-
-    saved_percent = 1.0 - (stat_after.st_size / stat_before.st_size)
-    color = "[bold green]" if saved_percent > 0 else "[bold red]"
+    if filename.endswith(".tar.bz2"):
+        return os.path.join(output_folder, filename[: -len(".tar.bz2")] + ".conda")
+    if filename.endswith(".conda"):
+        return os.path.join(output_folder, filename[: -len(".conda")] + ".tar.bz2")
+    return None
+
+
+def is_up_to_date(f, outfile):
+    try:
+        return os.stat(outfile).st_mtime >= os.stat(f).st_mtime
+    except FileNotFoundError:
+        return False
+
+
+def transmute_task(f, outfile, compression_level):
+    """Transmute ``f`` to ``outfile``, returns the sizes before and after and
+    the duration. Runs in a worker process."""
+    from libmambapy import transmute as mamba_transmute
+
+    start = time.perf_counter()
+    # libmamba picks the format from the extension, keep it for the temporary
+    # file. Renaming it into place means that an existing outfile is complete.
+    tmp = os.path.join(
+        os.path.dirname(outfile), f".{os.getpid()}.part-{os.path.basename(outfile)}"
+    )
+    try:
+        if not mamba_transmute(f, tmp, compression_level):
+            raise RuntimeError("libmamba could not transmute the package")
+        os.replace(tmp, outfile)
+    finally:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+    return os.path.getsize(f), os.path.getsize(outfile), time.perf_counter() - start
+
+
+def iter_files(patterns):
+    seen = set()
+    for pattern in patterns:
+        for f in iglob(pattern):
+            f = os.path.abspath(f)
+            if f not in seen and not os.path.isdir(f):
+                seen.add(f)
+                yield f
+
+
+class Transmuter:
+    """Transmutes packages on a pool of ``jobs`` worker processes.
+
+    Files are submitted as they are found, at most ``2 * jobs`` of them are in
+    flight, so that memory use does not grow with the number of packages.
+    Every result is reported as soon as it is done; a failing package does not
+    stop the others.
+    """
+
+    def __init__(self, output_folder, compression_level, jobs):
+        self.output_folder = output_folder
+        self.compression_level = compression_level
+        self.jobs = jobs
+        self.pool = ProcessPoolExecutor(jobs)
+        self.pending = {}
+        self.retries = {}
+        self.done = self.skipped = self.failed = 0
+
+    def submit(self, f):
+        outfile = output_path(f, self.output_folder)
+        if outfile is None:
+            self.fail(f, "transmute can only handle .tar.bz2 and .conda packages")
+            return
+        if is_up_to_date(f, outfile):
+            self.skipped += 1
+            console.print(f"Skipping {os.path.basename(f)}, {outfile} is up to date")
+            return
+        self._submit(f, outfile)
+        while len(self.pending) >= 2 * self.jobs:
+            self.collect(FIRST_COMPLETED)
+
+    def _submit(self, f, outfile):
+        future = self.pool.submit(transmute_task, f, outfile, self.compression_level)
+        self.pending[future] = (f, outfile)
+
+    def collect(self, return_when):
+        finished, _ = wait(self.pending, return_when=return_when)
+        broken = []
+        for future in finished:
+            f, outfile = self.pending.pop(future)
+            try:
+                self.report(f, outfile, *future.result())
+            except BrokenProcessPool:
+                broken.append((f, outfile))
+            except Exception as e:
+                self.fail(f, e)
+        if broken:
+            self.restart(broken)
+
+    def restart(self, broken):
+        # all pending futures of a broken pool fail, start over with a new pool
+        broken += list(self.pending.values())
+        self.pending = {}
+        self.pool.shutdown(wait=False)
+        self.pool = ProcessPoolExecutor(self.jobs)
+        for f, outfile in broken:
+            self.retries[f] = self.retries.get(f, 0) + 1
+            if self.retries[f] > MAX_RETRIES:
+                self.fail(f, "the worker process crashed")
+            else:
+                self._submit(f, outfile)
+
+    def finish(self):
+        while self.pending:
+            self.collect(FIRST_COMPLETED)
+        self.pool.shutdown()
+
+    def report(self, f, outfile, size_before, size_after, duration):
+        self.done += 1
+        saved_percent = 1.0 - (size_after / size_before) if size_before else 0.0
+        color = "[bold green]" if saved_percent > 0 else "[bold red]"
+
+        metrics.observe("boa_phase_duration_seconds", duration, phase="transmute")
+        metrics.record_package(outfile)
+        if size_before:
+            metrics.observe("boa_transmute_size_ratio", size_after / size_before)
+
+        console.print(f"\n[{self.done}] Converting [bold]{os.path.basename(f)}")
+        console.print(f"Done: [bold]{outfile}")
+        console.print(f"   Before    : {sizeof_fmt(size_before)}")
+        console.print(f"   After     : {sizeof_fmt(size_after)}")
+        console.print(f"   Difference: {color}{saved_percent * 100:.2f}%")
 
-    return filename, outfile, stat_before, stat_after, saved_percent, color
+    def fail(self, f, error):
+        self.failed += 1
+        console.print(f"\n[bold red]Failed to transmute {f}: {error}")
 
 
 def main(args):
-    # from libmambapy import Context
-    # api_ctx = Context()
-    # api_ctx.set_verbosity(1)
-
-    files = args.files
-    final_files = []
-
-    if not os.path.exists(args.output_directory):
-        Path(args.output_directory).mkdir(parents=True, exist_ok=True)
-
-    for f in files:
-        final_files += [os.path.abspath(fx) for fx in glob(f)]
-
-    logs = Parallel(n_jobs=args.num_jobs)(
-        delayed(transmute_task)(f, args) for f in final_files
+    with telemetry("transmute", getattr(args, "metrics_file", None)):
+        _transmute(args)
+
+
+def _transmute(args):
+    output_folder = os.path.abspath(args.output_folder)
+    os.makedirs(output_folder, exist_ok=True)
+    # same as joblib: -1 for all CPUs, -2 for all but one, ...
+    jobs = args.num_jobs
+    if jobs < 0:
+        jobs = max((os.cpu_count() or 1) + 1 + jobs, 1)
+    jobs = max(jobs, 1)
+
+    transmuter = Transmuter(output_folder, args.compression_level, jobs)
+    try:
+        for f in iter_files(args.files):
+            transmuter.submit(f)
+        transmuter.finish()
+    except KeyboardInterrupt:
+        # shutdown(cancel_futures=True) needs Python 3.9
+        for future in transmuter.pending:
+            future.cancel()
+        transmuter.pool.shutdown(wait=False)
+        raise
+
+    console.print(
+        f"\nTransmuted {transmuter.done}, skipped {transmuter.skipped} (up to date), "
+        f"failed {transmuter.failed}"
     )
-
-    for filename, outfile, stat_before, stat_after, saved_percent, color in logs:
-        console.print(f"\nConverting [bold]{filename}")
-        console.print(f"Done: [bold]{outfile}")
-        console.print(f"   Before    : {sizeof_fmt(stat_before.st_size)}")
-        console.print(f"   After     : {sizeof_fmt(stat_after.st_size)}")
-        console.print(f"   Difference: {color}{saved_percent * 100:.2f}%")
+    if transmuter.failed:
+        sys.exit(1)
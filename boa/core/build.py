@@ -6,9 +6,9 @@ Module that does most of the heavy lifting for the ``conda build`` command.
 """
 from __future__ import absolute_import, division, print_function
 
-import fnmatch
 import io
 import os
+from collections import namedtuple
 from os.path import isdir, isfile, join
 import shutil
 import sys
@@ -22,10 +22,7 @@ from conda_build.create_test import create_all_test_files
 # http://stackoverflow.com/a/13057751/1170370
 import encodings.idna  # NOQA
 
-import conda_package_handling.api
-
 # used to get version
-from conda.gateways.disk.create import TemporaryDirectory
 from conda_build.utils import tmp_chdir
 
 from conda_build import source, utils
@@ -46,13 +43,30 @@ if sys.platform == "win32":
 
 from boa.core.utils import (
     env_path_backup_var_exists,
+    get_shell_path,
     get_sys_vars_stubs,
-    shell_path,
 )
 from boa.core.recipe_handling import copy_recipe
+from boa.core.prefix_snapshot import PrefixSnapshot
+from boa.core.profiling import profiler
+from boa.core.telemetry import metrics
+from boa.core.source_cache import fetch_sources
+from boa.core.step_cache import step_work_dir
+from boa.core.file_scan import (
+    create_info_files_json_v1,
+    get_files_with_prefix,
+    prefix_variants,
+    scan_files,
+)
+from boa.core.packaging import (
+    PKG_FORMAT_EXTENSIONS,
+    create_packages,
+    get_compression_threads,
+)
 from boa.core.config import boa_config
 from boa.tui.exceptions import BoaRunBuildException
 from boa.core import environ
+from boa.helpers.glob_matcher import FileSelector
 
 from conda_build.build import (
     _write_sh_activation_text,
@@ -62,7 +76,6 @@ from conda_build.build import (
     copy_test_source_files,
     log_stats,
     write_hash_input,
-    get_files_with_prefix,
     record_prefix_files,
     write_info_files_file,
     write_link_json,
@@ -70,7 +83,6 @@ from conda_build.build import (
     write_info_json,
     get_entry_point_script_names,
     write_run_exports,
-    create_info_files_json_v1,
 )
 
 from rich.prompt import Confirm
@@ -118,10 +130,13 @@ def create_info_files(m, files, prefix):
 
     write_info_files_file(m, files)
 
-    files_with_prefix = get_files_with_prefix(m, [], files, prefix)
+    # read every file once to get checksums, sizes and embedded prefixes
+    with profiler.phase("hashing", output=m.name()):
+        file_scans = scan_files(prefix, files, prefix_variants(m, prefix))
+    files_with_prefix = get_files_with_prefix(m, files, prefix, file_scans)
     record_prefix_files(m, files_with_prefix)
     checksums = create_info_files_json_v1(
-        m, m.config.info_dir, prefix, files, files_with_prefix
+        m, m.config.info_dir, prefix, files, files_with_prefix, file_scans
     )
 
     # write_no_link(m, files)
@@ -151,14 +166,17 @@ def create_info_files(m, files, prefix):
     return checksums
 
 
-def post_process_files(m, initial_prefix_files):
+def post_process_files(m, initial_prefix_files, prefix_snapshot=None):
+    if prefix_snapshot is None:
+        prefix_snapshot = PrefixSnapshot(m.config.host_prefix)
+
     get_build_metadata(m)
     create_post_scripts(m)
 
     # this is new-style noarch, with a value of 'python'
     if m.noarch != "python":
         utils.create_entry_points(m.get_value("build/entry_points"), config=m.config)
-    current_prefix_files = utils.prefix_files(prefix=m.config.host_prefix)
+    current_prefix_files = prefix_snapshot.refresh()
 
     python = (
         m.config.build_python
@@ -177,7 +195,7 @@ def post_process_files(m, initial_prefix_files):
     )
 
     # The post processing may have deleted some files (like easy-install.pth)
-    current_prefix_files = utils.prefix_files(prefix=m.config.host_prefix)
+    current_prefix_files = prefix_snapshot.refresh()
     new_files = sorted(current_prefix_files - initial_prefix_files)
     new_files = utils.filter_files(new_files, prefix=m.config.host_prefix)
 
@@ -218,7 +236,7 @@ can lead to packages that include their dependencies."""
             m, pkg_files, m.config.host_prefix, entry_point_script_names
         )
 
-    current_prefix_files = utils.prefix_files(prefix=m.config.host_prefix)
+    current_prefix_files = prefix_snapshot.refresh()
     new_files = current_prefix_files - initial_prefix_files
     fix_permissions(new_files, m.config.host_prefix)
 
@@ -226,22 +244,44 @@ can lead to packages that include their dependencies."""
 
 
 def select_files(files, include_files, exclude_files):
-    to_include, to_exclude = set(), set()
-    if include_files:
-        for f in include_files:
-            to_include |= set(fnmatch.filter(files, f))
-    else:
-        to_include = set(files)
-    if exclude_files:
-        for f in exclude_files:
-            to_exclude |= set(fnmatch.filter(to_include, f))
+    return FileSelector(include_files, exclude_files).select(files)
+
+
+StagedPackage = namedtuple(
+    "StagedPackage",
+    (
+        "name",
+        "prefix",
+        "files",
+        "basename",
+        "extensions",
+        "output_folder",
+        "zstd_compression_level",
+        "threads",
+        "debug",
+        "keep_prefix",
+    ),
+)
+
+
+def bundle_conda(
+    metadata, initial_files, env, files_selector=None, prefix_snapshot=None
+):
+    return write_package(
+        stage_package(metadata, initial_files, files_selector, prefix_snapshot)
+    )
 
-    final_files = to_include - to_exclude
-    return final_files
 
+def stage_package(metadata, initial_files, files_selector=None, prefix_snapshot=None):
+    """Post-process the files of the output and create its info files, then
+    move the host prefix out of the way. Returns the ``StagedPackage`` that
+    ``write_package`` compresses, the host prefix is free for the next output
+    in the meantime."""
+    if prefix_snapshot is None:
+        prefix_snapshot = PrefixSnapshot(metadata.config.host_prefix)
 
-def bundle_conda(metadata, initial_files, env, files_selector=None):
-    files = post_process_files(metadata, initial_files)
+    with profiler.phase("post_process", output=metadata.name()):
+        files = post_process_files(metadata, initial_files, prefix_snapshot)
 
     # first filter is so that info_files does not pick up ignored files
     files = utils.filter_files(files, prefix=metadata.config.host_prefix)
@@ -271,107 +311,112 @@ def bundle_conda(metadata, initial_files, env, files_selector=None):
         )
 
     # here we add the info files into the prefix, so we want to re-collect the files list
-    prefix_files = set(utils.prefix_files(metadata.config.host_prefix))
+    prefix_files = prefix_snapshot.refresh()
     files = utils.filter_files(
         prefix_files - initial_files, prefix=metadata.config.host_prefix
     )
     if files_selector:
         include_files = files_selector.get("include")
         if include_files:
-            include_files += ["info/*"]
+            include_files = include_files + ["info/*"]
         files = select_files(files, include_files, files_selector.get("exclude"))
 
     basename = metadata.dist()
-    tmp_archives = []
-    final_outputs = []
-    cph_kwargs = {}
-    ext = ".tar.bz2"
-    if output.get("type") == "conda_v2" or metadata.config.conda_pkg_format == "2":
-        ext = ".conda"
-        cph_kwargs["compression_tuple"] = (
-            ".tar.zst",
-            "zstd",
-            f"zstd:compression-level={metadata.config.zstd_compression_level}",
-        )
-
-    with TemporaryDirectory() as tmp:
-        conda_package_handling.api.create(
-            metadata.config.host_prefix,
-            files,
-            basename + ext,
-            out_folder=tmp,
-            **cph_kwargs,
+    pkg_formats = getattr(metadata.config, "pkg_formats", None) or [
+        metadata.config.conda_pkg_format
+    ]
+    extensions = [PKG_FORMAT_EXTENSIONS.get(f, ".tar.bz2") for f in pkg_formats]
+
+    # we're done building, perform some checks
+    #     if tmp_path.endswith('.tar.bz2'):
+    #         tarcheck.check_all(tmp_path, metadata.config)
+
+    #     # we do the import here because we want to respect logger level context
+    #     try:
+    #         from conda_verify.verify import Verify
+    #     except ImportError:
+    #         Verify = None
+    #         log.warn("Importing conda-verify failed.  Please be sure to test your packages.  "
+    #             "conda install conda-verify to make this message go away.")
+    #     if getattr(metadata.config, "verify", False) and Verify:
+    #         verifier = Verify()
+    #         checks_to_ignore = (utils.ensure_list(metadata.config.ignore_verify_codes) +
+    #                             metadata.ignore_verify_codes())
+    #         try:
+    #             verifier.verify_package(path_to_package=tmp_path, checks_to_ignore=checks_to_ignore,
+    #                                     exit_on_error=metadata.config.exit_on_verify_error)
+    #         except KeyError as e:
+    #             log.warn("Package doesn't have necessary files.  It might be too old to inspect."
+    #                      "Legacy noarch packages are known to fail.  Full message was {}".format(e))
+    try:
+        crossed_subdir = metadata.config.target_subdir
+    except AttributeError:
+        crossed_subdir = metadata.config.host_subdir
+    subdir = "noarch" if (metadata.noarch or metadata.noarch_python) else crossed_subdir
+    if metadata.config.output_folder:
+        output_folder = os.path.join(metadata.config.output_folder, subdir)
+    else:
+        output_folder = os.path.join(
+            os.path.dirname(metadata.config.bldpkgs_dir), subdir
         )
-        tmp_archives = [os.path.join(tmp, basename + ext)]
-
-        # we're done building, perform some checks
-        for tmp_path in tmp_archives:
-            #     if tmp_path.endswith('.tar.bz2'):
-            #         tarcheck.check_all(tmp_path, metadata.config)
-            output_filename = os.path.basename(tmp_path)
-
-            #     # we do the import here because we want to respect logger level context
-            #     try:
-            #         from conda_verify.verify import Verify
-            #     except ImportError:
-            #         Verify = None
-            #         log.warn("Importing conda-verify failed.  Please be sure to test your packages.  "
-            #             "conda install conda-verify to make this message go away.")
-            #     if getattr(metadata.config, "verify", False) and Verify:
-            #         verifier = Verify()
-            #         checks_to_ignore = (utils.ensure_list(metadata.config.ignore_verify_codes) +
-            #                             metadata.ignore_verify_codes())
-            #         try:
-            #             verifier.verify_package(path_to_package=tmp_path, checks_to_ignore=checks_to_ignore,
-            #                                     exit_on_error=metadata.config.exit_on_verify_error)
-            #         except KeyError as e:
-            #             log.warn("Package doesn't have necessary files.  It might be too old to inspect."
-            #                      "Legacy noarch packages are known to fail.  Full message was {}".format(e))
-            try:
-                crossed_subdir = metadata.config.target_subdir
-            except AttributeError:
-                crossed_subdir = metadata.config.host_subdir
-            subdir = (
-                "noarch"
-                if (metadata.noarch or metadata.noarch_python)
-                else crossed_subdir
-            )
-            if metadata.config.output_folder:
-                output_folder = os.path.join(metadata.config.output_folder, subdir)
-            else:
-                output_folder = os.path.join(
-                    os.path.dirname(metadata.config.bldpkgs_dir), subdir
-                )
-            final_output = os.path.join(output_folder, output_filename)
-            if os.path.isfile(final_output):
-                utils.rm_rf(final_output)
-
-            # disable locking here. It's just a temp folder getting locked.
-            # Having it proved a major bottleneck.
-            utils.copy_into(
-                tmp_path, final_output, metadata.config.timeout, locking=False
-            )
-            final_outputs.append(final_output)
-
-    update_index(
-        os.path.dirname(output_folder), verbose=metadata.config.debug, threads=1
-    )
 
     # clean out host prefix so that this output's files don't interfere with other outputs
     # We have a backup of how things were before any output scripts ran.  That's
     # restored elsewhere.
+    prefix = metadata.config.host_prefix
+    dest = os.path.join(
+        os.path.dirname(prefix),
+        "_".join(("_h_env_moved", metadata.dist(), metadata.config.host_subdir)),
+    )
     if metadata.config.keep_old_work:
-        prefix = metadata.config.host_prefix
-        dest = os.path.join(
-            os.path.dirname(prefix),
-            "_".join(("_h_env_moved", metadata.dist(), metadata.config.host_subdir)),
-        )
         console.print("Renaming host env directory, ", prefix, " to ", dest)
-        if os.path.exists(dest):
-            utils.rm_rf(dest)
-        shutil.move(prefix, dest)
-    else:
-        utils.rm_rf(metadata.config.host_prefix)
+    if os.path.exists(dest):
+        utils.rm_rf(dest)
+    shutil.move(prefix, dest)
+
+    return StagedPackage(
+        name=metadata.name(),
+        prefix=dest,
+        files=files,
+        basename=basename,
+        extensions=extensions,
+        output_folder=output_folder,
+        zstd_compression_level=metadata.config.zstd_compression_level,
+        threads=get_compression_threads(metadata.config),
+        debug=metadata.config.debug,
+        keep_prefix=metadata.config.keep_old_work,
+    )
+
+
+def write_package(staged):
+    """Compress and index the ``StagedPackage`` ``staged``, returns the paths
+    of the packages."""
+    # the archives are written next to their final location and renamed into place
+    with profiler.phase("compression", output=staged.name):
+        final_outputs = create_packages(
+            staged.prefix,
+            staged.files,
+            staged.basename,
+            staged.extensions,
+            staged.output_folder,
+            zstd_compression_level=staged.zstd_compression_level,
+            threads=staged.threads,
+        )
+
+    if metrics.enabled:
+        files_size = sum(
+            os.lstat(os.path.join(staged.prefix, f)).st_size for f in staged.files
+        )
+        for path in final_outputs:
+            metrics.record_package(path, files_size)
+
+    with profiler.phase("index", output=staged.name):
+        update_index(
+            os.path.dirname(staged.output_folder), verbose=staged.debug, threads=1
+        )
+
+    if not staged.keep_prefix:
+        utils.rm_rf(staged.prefix)
 
     return final_outputs
 
@@ -520,7 +565,7 @@ def execute_build_script(m, src_dir, env, provision_only=False):
 
                 if not provision_only:
                     cmd = (
-                        [shell_path]
+                        [get_shell_path()]
                         + (["-x"] if m.config.debug else [])
                         + ["-o", "errexit", work_file]
                     )
@@ -565,6 +610,7 @@ def execute_build_script(m, src_dir, env, provision_only=False):
 
 def _try_download(m, interactive):
     try:
+        fetch_sources(m)
         source.provide(m)
     except RuntimeError as e:
         if interactive:
@@ -610,7 +656,9 @@ def _try_download(m, interactive):
 
 
 def download_source(m, interactive=False):
-    with utils.path_prepended(m.config.build_prefix):
+    with utils.path_prepended(m.config.build_prefix), profiler.phase(
+        "source", output=m.name()
+    ):
         _try_download(m, interactive)
 
 
@@ -621,7 +669,11 @@ def build(
     allow_interactive=False,
     continue_on_failure=False,
     provision_only=False,
+    write=True,
 ):
+    """Build the output of ``m`` and return the paths of its packages. With
+    ``write=False`` a package output is only staged and the ``StagedPackage``
+    is returned, to be written with ``write_package``."""
     try:
         if not stats:
             stats = {}
@@ -650,13 +702,15 @@ def build(
             os.makedirs(src_dir)
 
         utils.rm_rf(m.config.info_dir)
-        files_before_script = utils.prefix_files(prefix=m.config.host_prefix)
+        prefix_snapshot = PrefixSnapshot(m.config.host_prefix)
+        files_before_script = prefix_snapshot.files()
 
         with open(join(m.config.build_folder, "prefix_files.txt"), "w") as f:
             f.write("\n".join(sorted(list(files_before_script))))
             f.write("\n")
 
-        execute_build_script(m, src_dir, env, provision_only=provision_only)
+        with profiler.phase("build_script", output=m.name()):
+            execute_build_script(m, src_dir, env, provision_only=provision_only)
 
         if provision_only:
             return
@@ -666,15 +720,19 @@ def build(
             return
 
         if m.output.is_package:
-            final_outputs = bundle_conda(
-                m, files_before_script, env, m.output.sections["files"]
+            staged = stage_package(
+                m,
+                files_before_script,
+                m.output.sections["files"],
+                prefix_snapshot=prefix_snapshot,
             )
+            if not write:
+                return staged
+            final_outputs = write_package(staged)
         else:
             # only store the working dir!
-            # TODO add the build hash to distinguish variants
-            moved_work_dir = (
-                pathlib.Path(m.config.work_dir).parent / f"work_{m.output.name}"
-            )
+            moved_work_dir = step_work_dir(m.output)
+            utils.rm_rf(str(moved_work_dir))
             shutil.move(m.config.work_dir, moved_work_dir)
             m.output.moved_work_dir = moved_work_dir
             (moved_work_dir / "conda_build.sh").unlink()
@@ -14,21 +14,19 @@ class BoaConfig:
     is_mambabuild = False
 
     def __init__(self, args=None):
-        if args and getattr(args, "json", False):
-            self.console.quiet = True
-            self.json = True
-
-        if args and getattr(args, "quiet", False):
-            self.console.quiet = True
-            self.quiet = True
-
-        if args and getattr(args, "debug", False):
-            self.debug = args.debug
+        self.json = bool(getattr(args, "json", False))
+        self.quiet = bool(getattr(args, "quiet", False))
+        self.debug = getattr(args, "debug", False) or False
+        self.console.quiet = self.json or self.quiet
 
 
 def init_global_config(args=None):
     global boa_config
-    boa_config = BoaConfig(args)
+    if boa_config is None:
+        boa_config = BoaConfig(args)
+    else:
+        # modules keep a reference to the instance, update it in place
+        boa_config.__init__(args)
 
 
 if not boa_config:
@@ -0,0 +1,252 @@
+# Copyright (C) 2021, QuantStack
+# SPDX-License-Identifier: BSD-3-Clause
+
+"""
+Build daemon.
+
+``boa serve`` keeps a boa process running on a Unix socket. Python, conda and
+libmamba are initialised once, and the solvers (with their parsed repodata),
+the render caches and the package cache index stay in memory between builds.
+
+``boa build --daemon`` sends its command line, working directory and
+environment to the daemon and waits for the exit status of the build. The
+stdout and stderr file descriptors of the client are passed along with the
+request (``SCM_RIGHTS``), so the output of the build, including the output of
+build scripts, goes straight to the terminal of the client.
+
+Builds run one after the other. The conda configuration is the one the daemon
+was started with, restart it after changing ``.condarc``. Builds for
+emscripten need a daemon started with ``boa serve --emscripten``, the patches
+of conda and conda-build are applied once when it starts.
+
+The request contains the environment of the client (tokens, credentials), so
+both ends check that the other one runs as the same user. The default socket
+is in a directory only the user can access, and the socket is created with
+mode 0600.
+
+Unix sockets are required, check ``daemon_supported()`` before importing this
+module.
+"""
+
+import array
+import json
+import os
+import socket
+import socketserver
+import stat
+import struct
+import sys
+import traceback
+from contextlib import contextmanager
+
+from boa.core.daemon_socket import SOCKET_ENV, default_socket_path
+
+
+def _send_fds(sock, data, fds):
+    """``socket.send_fds`` (Python 3.9+)"""
+    return sock.sendmsg(
+        [data], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array("i", fds))]
+    )
+
+
+def _recv_fds(sock, bufsize, maxfds):
+    """``socket.recv_fds`` (Python 3.9+), returns the data and the file
+    descriptors"""
+    fds = array.array("i")
+    msg, ancdata, _, _ = sock.recvmsg(bufsize, socket.CMSG_LEN(maxfds * fds.itemsize))
+    for cmsg_level, cmsg_type, cmsg_data in ancdata:
+        if cmsg_level == socket.SOL_SOCKET and cmsg_type == socket.SCM_RIGHTS:
+            # a truncated message can end with a partial descriptor
+            end = len(cmsg_data) - (len(cmsg_data) % fds.itemsize)
+            fds.frombytes(cmsg_data[:end])
+    return msg, list(fds)
+
+
+def _peer_uid(sock):
+    """uid of the process at the other end of ``sock``, None if the platform
+    can not tell (``SO_PEERCRED`` is Linux only)"""
+    if not hasattr(socket, "SO_PEERCRED"):
+        return None
+    size = struct.calcsize("3i")
+    _, uid, _ = struct.unpack(
+        "3i", sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, size)
+    )
+    return uid
+
+
+def _check_private_dir(path):
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o077:
+        raise RuntimeError(
+            f"{path} has to be a directory owned by the current user with mode 0700"
+        )
+
+
+def _make_private_dir(path):
+    try:
+        os.mkdir(path, 0o700)
+    except FileExistsError:
+        pass
+    _check_private_dir(path)
+
+
+def _check_daemon_owner(sock, socket_path):
+    uid = _peer_uid(sock)
+    if uid is None:
+        # no peer credentials, the socket has to be in a private directory
+        _check_private_dir(os.path.dirname(socket_path))
+        uid = os.stat(socket_path).st_uid
+    if uid != os.getuid():
+        raise RuntimeError(
+            f"The process listening on {socket_path} is not run by the current user"
+        )
+
+
+def submit(argv, socket_path=None):
+    """Run ``boa argv`` in the daemon and return its exit status"""
+    socket_path = socket_path or default_socket_path()
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(socket_path)
+        except OSError as e:
+            print(
+                f"Could not connect to the boa daemon at {socket_path} ({e.strerror}), "
+                "start it with `boa serve`",
+                file=sys.stderr,
+            )
+            return 1
+
+        # the request contains the environment, check who gets it
+        try:
+            _check_daemon_owner(sock, socket_path)
+        except (OSError, RuntimeError) as e:
+            print(f"Not sending the build to the boa daemon: {e}", file=sys.stderr)
+            return 1
+
+        request = {"argv": argv, "cwd": os.getcwd(), "env": dict(os.environ)}
+        sys.stdout.flush()
+        sys.stderr.flush()
+        _send_fds(sock, b"\0", [sys.stdout.fileno(), sys.stderr.fileno()])
+        sock.sendall(json.dumps(request).encode() + b"\n")
+
+        with sock.makefile("rb") as fi:
+            line = fi.readline()
+        if not line:
+            print("The boa daemon closed the connection", file=sys.stderr)
+            return 1
+        return json.loads(line)["exit_code"]
+
+
+@contextmanager
+def _redirected(stdout_fd, stderr_fd):
+    """Point the file descriptors 1 and 2 of this process (inherited by
+    subprocesses) to ``stdout_fd`` and ``stderr_fd``."""
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved = os.dup(1), os.dup(2)
+    os.dup2(stdout_fd, 1)
+    os.dup2(stderr_fd, 2)
+    try:
+        yield
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.dup2(saved[0], 1)
+        os.dup2(saved[1], 2)
+        os.close(saved[0])
+        os.close(saved[1])
+
+
+@contextmanager
+def _client_context(request):
+    cwd = os.getcwd()
+    environ = dict(os.environ)
+    os.environ.clear()
+    os.environ.update(request["env"])
+    try:
+        os.chdir(request["cwd"])
+        yield
+    finally:
+        os.chdir(cwd)
+        os.environ.clear()
+        os.environ.update(environ)
+
+
+def _exit_code(e):
+    if e.code is None:
+        return 0
+    return e.code if isinstance(e.code, int) else 1
+
+
+class BuildRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        # the socket is only accessible by the user, Linux can double check
+        uid = _peer_uid(self.request)
+        if uid is not None and uid != os.getuid():
+            return
+        _, fds = _recv_fds(self.request, 1, 2)
+        try:
+            if len(fds) != 2:
+                return
+            request = json.loads(self.rfile.readline())
+            exit_code = self.server.run(request, *fds)
+            self.wfile.write(json.dumps({"exit_code": exit_code}).encode() + b"\n")
+        finally:
+            for fd in fds:
+                os.close(fd)
+
+
+class BuildServer(socketserver.UnixStreamServer):
+    def __init__(self, socket_path, run):
+        self.run_argv = run
+        super().__init__(socket_path, BuildRequestHandler)
+
+    def server_bind(self):
+        # create the socket with mode 0600, other users can not connect while
+        # its mode is changed
+        umask = os.umask(0o177)
+        try:
+            super().server_bind()
+        finally:
+            os.umask(umask)
+
+    def run(self, request, stdout_fd, stderr_fd):
+        with _redirected(stdout_fd, stderr_fd), _client_context(request):
+            try:
+                return self.run_argv(request["argv"])
+            except SystemExit as e:
+                return _exit_code(e)
+            except Exception:
+                traceback.print_exc()
+                return 1
+
+
+def _remove_stale_socket(socket_path):
+    if not os.path.exists(socket_path):
+        return
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(socket_path)
+        except OSError:
+            os.unlink(socket_path)
+            return
+    raise RuntimeError(f"A boa daemon is already listening on {socket_path}")
+
+
+def serve(run, socket_path=None):
+    """Serve builds on ``socket_path``, ``run(argv)`` runs one build and returns
+    its exit status."""
+    if not socket_path and not os.environ.get(SOCKET_ENV):
+        socket_path = default_socket_path()
+        _make_private_dir(os.path.dirname(socket_path))
+    socket_path = socket_path or default_socket_path()
+    _remove_stale_socket(socket_path)
+
+    with BuildServer(socket_path, run) as server:
+        print(f"boa daemon listening on {socket_path}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.unlink(socket_path)
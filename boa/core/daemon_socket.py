@@ -0,0 +1,28 @@
+# Copyright (C) 2021, QuantStack
+# SPDX-License-Identifier: BSD-3-Clause
+
+"""
+Socket of the build daemon. Importable on every platform, unlike
+``boa.core.daemon`` which needs Unix sockets.
+"""
+
+import os
+import socket
+import tempfile
+
+SOCKET_ENV = "BOA_DAEMON_SOCKET"
+
+
+def daemon_supported():
+    """The daemon passes file descriptors over a Unix socket (``SCM_RIGHTS``),
+    which e.g. Windows does not support."""
+    return hasattr(socket, "AF_UNIX") and hasattr(socket, "SCM_RIGHTS")
+
+
+def default_socket_path():
+    path = os.environ.get(SOCKET_ENV)
+    if path:
+        return path
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR") or tempfile.gettempdir()
+    # the directory is only accessible by the user, see boa.core.daemon
+    return os.path.join(runtime_dir, f"boa-{os.getuid()}", "daemon.sock")
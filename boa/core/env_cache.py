@@ -0,0 +1,92 @@
+# Copyright (C) 2021, QuantStack
+# SPDX-License-Identifier: BSD-3-Clause
+
+"""
+Cache of test environments.
+
+Most outputs and variants of a recipe are tested in environments that only
+differ in the package under test. The first test links the environment
+without that package, stores a copy and then links the tested package on
+top. The following tests clone the stored environment, so that only the
+tested package has to be fetched and linked.
+
+Installed files contain the prefix they were installed to, so environments
+are only reused at the same prefix. The test prefix is in the build folder of
+a recipe build, the cache therefore lives in that build folder as well and is
+removed when the recipe build ends. The cache is only used where the
+filesystem supports reflinks, copying whole environments is not faster than
+linking them.
+"""
+
+import json
+import os
+
+from conda_build import utils
+
+from boa.core.clone import clone_tree, supports_reflinks
+from boa.core.step_cache import hash_json
+from boa.core.telemetry import metrics
+
+
+def split_tested_package(to_link, name):
+    """Split the ``to_link`` list of a transaction (as returned by
+    ``Transaction.to_conda``) into the tested package and the environment."""
+    tested, env = [], []
+    for entry in to_link:
+        if json.loads(entry[2])["name"] == name:
+            tested.append(entry)
+        else:
+            env.append(entry)
+    return tested, env
+
+
+def pinned_specs(to_link):
+    """Specs that select exactly the packages of ``to_link``"""
+    specs = []
+    for _, _, jsn in to_link:
+        record = json.loads(jsn)
+        specs.append(f"{record['name']} {record['version']} {record['build']}")
+    return specs
+
+
+class TestEnvCache:
+    def __init__(self, config):
+        self.root = os.path.join(config.build_folder, "boa_test_envs")
+        self.enabled = supports_reflinks(self.root)
+
+    def remove(self):
+        """Remove all stored environments"""
+        utils.rm_rf(self.root)
+
+    def key(self, prefix, env_to_link):
+        packages = []
+        for channel, fn, jsn in env_to_link:
+            record = json.loads(jsn)
+            checksum = record.get("sha256") or record.get("md5", "")
+            packages.append(f"{channel}/{fn} {checksum}")
+        return hash_json({"prefix": prefix, "packages": sorted(packages)})
+
+    def path(self, key):
+        return os.path.join(self.root, key)
+
+    def restore(self, key, prefix):
+        cached = self.path(key)
+        hit = os.path.isdir(cached)
+        metrics.cache_lookup("test_env", hit)
+        if not hit:
+            return False
+        utils.rm_rf(prefix)
+        clone_tree(cached, prefix)
+        return True
+
+    def store(self, key, prefix):
+        cached = self.path(key)
+        if os.path.isdir(cached):
+            return
+        tmp = cached + ".part"
+        utils.rm_rf(tmp)
+        try:
+            clone_tree(prefix, tmp)
+            os.rename(tmp, cached)
+        except OSError:
+            utils.rm_rf(tmp)
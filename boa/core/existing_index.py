@@ -0,0 +1,95 @@
+# Copyright (C) 2021, QuantStack
+# SPDX-License-Identifier: BSD-3-Clause
+
+import json
+import logging
+import os
+from dataclasses import dataclass
+from typing import Dict, Iterable, Set, Tuple
+
+PACKAGE_EXTENSIONS = (".tar.bz2", ".conda")
+
+log = logging.getLogger("boa")
+
+
+@dataclass(frozen=True)
+class ExistingPackage:
+    subdir: str
+    fn: str
+    name: str
+    version: str
+    build: str
+
+
+def strip_package_extension(fn):
+    for ext in PACKAGE_EXTENSIONS:
+        if fn.endswith(ext):
+            return fn[: -len(ext)]
+    return None
+
+
+class ExistingPackages:
+    """In-memory index of the packages (``.tar.bz2`` and ``.conda``) in the
+    subdirs of an output folder.
+
+    Records come from the ``repodata.json`` of every subdir; files that are not
+    indexed yet are added from a single directory listing, and records of
+    files that were removed since indexing are dropped.
+    """
+
+    def __init__(self, output_folder, subdirs: Iterable[str]):
+        self.output_folder = output_folder
+        self.packages: Dict[str, ExistingPackage] = {}
+        self._name_versions: Set[Tuple[str, str]] = set()
+        self._builds: Dict[Tuple[str, str], Set[str]] = {}
+        for subdir in dict.fromkeys(subdirs):
+            self._load_subdir(subdir)
+
+    def _load_subdir(self, subdir):
+        path = os.path.join(self.output_folder, subdir)
+        try:
+            with os.scandir(path) as it:
+                files = {e.name for e in it if strip_package_extension(e.name)}
+        except FileNotFoundError:
+            return
+
+        records = {}
+        try:
+            with open(os.path.join(path, "repodata.json")) as fi:
+                repodata = json.load(fi)
+            for key in ("packages", "packages.conda"):
+                records.update(repodata.get(key, {}))
+        except (OSError, ValueError):
+            pass
+
+        for fn in files:
+            record = records.get(fn)
+            if record:
+                name, version, build = (
+                    record["name"],
+                    record["version"],
+                    record["build"],
+                )
+            else:
+                # name-version-build, neither version nor build contain dashes
+                parts = strip_package_extension(fn).rsplit("-", 2)
+                if len(parts) != 3:
+                    log.warning(f"Ignoring {fn} in {path}, not a package file name")
+                    continue
+                name, version, build = parts
+            self._add(ExistingPackage(subdir, fn, name, version, build))
+
+    def _add(self, pkg: ExistingPackage):
+        self.packages[f"{pkg.name}-{pkg.version}-{pkg.build}"] = pkg
+        self._name_versions.add((pkg.name, pkg.version))
+        self._builds.setdefault((pkg.name, pkg.version), set()).add(pkg.build)
+
+    def has_dist(self, dist):
+        """``dist`` is ``name-version-build`` (without subdir and extension)"""
+        return dist in self.packages
+
+    def has_version(self, name, version):
+        return (name, version) in self._name_versions
+
+    def builds(self, name, version):
+        return self._builds.get((name, version), set())
@@ -0,0 +1,220 @@
+# Copyright (C) 2021, QuantStack
+# SPDX-License-Identifier: BSD-3-Clause
+
+"""
+Single pass over the files of a package that computes everything the info
+files need: sha256, size and embedded prefixes (text and binary).
+
+This replaces ``get_files_with_prefix`` and ``create_info_files_json_v1`` from
+conda-build which read every file several times on a single thread.
+
+The regex ``replacements`` of the variant that conda-build can record as
+additional prefix placeholders are not supported: boa always passed an empty
+list of replacements to conda-build, so only the prefix spellings of
+``prefix_variants`` are detected, as before.
+"""
+
+import fnmatch
+import hashlib
+import json
+import mmap
+import os
+import stat
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+from conda.base.constants import PREFIX_PLACEHOLDER
+from conda_build import utils
+from conda_build.build import get_short_path
+
+# sha256 of an empty file (also used for broken symlinks, like conda-build)
+EMPTY_SHA256 = "e3b0c44298fc1c149afbf4c8996fb92427ae41e4649b934ca495991b7852b855"
+
+
+@dataclass
+class FileScan:
+    path: str
+    sha256: Optional[str] = None
+    size: int = 0
+    inode: int = 0
+    nlink: int = 1
+    is_symlink: bool = False
+    is_binary: bool = False
+    prefixes: List[str] = field(default_factory=list)
+
+
+def prefix_variants(m, prefix):
+    """The spellings of the prefix that are detected in files"""
+    if utils.on_win or m.config.subdir.startswith("win"):
+        # If we've cross compiled on Windows to unix, chances are many files
+        # will refer to Windows paths.
+        return [
+            prefix[0].upper() + prefix[1:],
+            prefix[0].lower() + prefix[1:],
+            prefix.replace("\\", "/"),
+            PREFIX_PLACEHOLDER,
+            PREFIX_PLACEHOLDER.replace("/", "\\"),
+        ]
+    return [prefix, PREFIX_PLACEHOLDER]
+
+
+def prefix_replacement_excluded(path):
+    if path.endswith((".pyc", ".pyo")) or not os.path.isfile(path):
+        return True
+    if sys.platform != "darwin" and os.path.islink(path):
+        # OSX does not allow hard-linking symbolic links, so we cannot
+        # skip symbolic links (as we can on Linux)
+        return True
+    return False
+
+
+def scan_file(prefix, f, needles):
+    path = os.path.join(prefix, f)
+    st = os.lstat(path)
+    scan = FileScan(f, inode=st.st_ino, nlink=st.st_nlink)
+
+    if stat.S_ISLNK(st.st_mode):
+        scan.is_symlink = True
+        try:
+            st = os.stat(path)
+        except OSError:
+            # symlink to nowhere, so an empty file
+            scan.sha256 = EMPTY_SHA256
+            return scan
+
+    scan.size = st.st_size
+    if not stat.S_ISREG(st.st_mode):
+        return scan
+
+    if st.st_size == 0:
+        scan.sha256 = EMPTY_SHA256
+        return scan
+
+    with open(path, "rb") as fi, mmap.mmap(
+        fi.fileno(), 0, access=mmap.ACCESS_READ
+    ) as mm:
+        # hashlib releases the GIL for large buffers, so this runs in parallel
+        scan.sha256 = hashlib.sha256(mm).hexdigest()
+        if needles and not scan.is_symlink:
+            scan.is_binary = mm.find(b"\x00") != -1
+            scan.prefixes = [
+                needle.decode("utf-8") for needle in needles if mm.find(needle) != -1
+            ]
+    return scan
+
+
+def scan_files(prefix, files, variants, threads=None) -> Dict[str, FileScan]:
+    """Read every file once (in parallel) and collect hashes, sizes and the
+    prefix variants they contain."""
+    needles = [v.encode("utf-8") for v in dict.fromkeys(variants)]
+
+    def task(f):
+        if prefix_replacement_excluded(os.path.join(prefix, f)):
+            return scan_file(prefix, f, None)
+        return scan_file(prefix, f, needles)
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        return {scan.path: scan for scan in executor.map(task, sorted(files))}
+
+
+def get_files_with_prefix(m, files, prefix, file_scans):
+    """Same result as ``conda_build.build.get_files_with_prefix``, computed from
+    the results of ``scan_files``."""
+    ignore_files = m.ignore_prefix_files()
+    ignore_types = set()
+    if not hasattr(ignore_files, "__iter__"):
+        if ignore_files is True:
+            ignore_types.update(("text", "binary"))
+        ignore_files = []
+    if not m.get_value(
+        "build/detect_binary_files_with_prefix", not utils.on_win
+    ) and not m.get_value("build/binary_has_prefix_files", None):
+        ignore_types.add("binary")
+    ignore_files = set(ignore_files)
+
+    files_with_prefix = []
+    for f in sorted(files):
+        scan = file_scans[f]
+        if scan.is_symlink or f in ignore_files:
+            continue
+        mode = "binary" if scan.is_binary else "text"
+        if mode in ignore_types:
+            continue
+        for pfx in sorted(set(scan.prefixes)):
+            files_with_prefix.append((pfx, mode, f))
+
+    if m.config.verbose:
+        for pfx, mode, f in files_with_prefix:
+            print(f"{mode:<6} {f} ({pfx})")
+    return sorted(files_with_prefix)
+
+
+def _is_no_link(no_link, short_path):
+    return any(fnmatch.fnmatch(short_path, p) for p in utils.ensure_list(no_link))
+
+
+def create_info_files_json_v1(
+    m, info_dir, prefix, files, files_with_prefix, file_scans
+):
+    """Write ``info/paths.json`` from the results of ``scan_files`` and return a
+    dict of ``short_path: sha256``. Like conda-build, no ``paths.json`` is
+    written for old style ``noarch_python`` packages."""
+    # fields: "_path", "sha256", "size_in_bytes", "path_type", "file_mode",
+    #         "prefix_placeholder", "no_link", "inode_paths"
+    placeholders = {}
+    for pfx, mode, f in files_with_prefix:
+        placeholders.setdefault(f, (pfx, mode))
+
+    inode_paths = {}
+    for f in sorted(files):
+        scan = file_scans[f]
+        if not scan.is_symlink and scan.nlink > 1:
+            inode_paths.setdefault(scan.inode, []).append(f)
+
+    no_link_files = m.get_value("build/no_link")
+
+    files_json = []
+    for f in sorted(files):
+        scan = file_scans[f]
+        path = os.path.join(prefix, f)
+        short_path = get_short_path(m, f)
+        if short_path:
+            short_path = short_path.replace("\\", "/").replace("\\\\", "/")
+
+        if scan.is_symlink:
+            path_type = "softlink"
+        elif os.path.isdir(path):
+            path_type = "directory"
+        else:
+            path_type = "hardlink"
+
+        file_info = {
+            "_path": short_path,
+            "sha256": scan.sha256,
+            "size_in_bytes": scan.size,
+            "path_type": path_type,
+        }
+        if no_link_files and _is_no_link(no_link_files, f):
+            file_info["no_link"] = True
+        if f in placeholders:
+            file_info["prefix_placeholder"], file_info["file_mode"] = placeholders[f]
+        if path_type == "hardlink" and scan.nlink > 1:
+            file_info["inode_paths"] = inode_paths[scan.inode]
+        files_json.append(file_info)
+
+    # don't create info/paths.json file if this is an old noarch package
+    if not m.noarch_python:
+        with open(os.path.join(info_dir, "paths.json"), "w") as fo:
+            json.dump(
+                {"paths": files_json, "paths_version": 1},
+                fo,
+                sort_keys=True,
+                indent=2,
+                separators=(",", ": "),
+            )
+
+    # Return a dict of file: sha256. We could (but currently do not)
+    # use this to detect overlap and mutated overlap.
+    return {x["_path"]: x["sha256"] for x in files_json}
@@ -8,6 +8,7 @@ import sys
 import re
 import json
 import copy
+from functools import lru_cache
 
 from typing import Union, Dict, Iterable, Any, Optional
 
@@ -23,6 +24,42 @@ except ImportError:
 from conda_build.utils import ensure_list, expand_globs, on_win
 
 
+# packages that add a prefix to the build string (see build_string_from_metadata)
+BUILD_STRING_PACKAGES = (
+    "numpy",
+    "python",
+    "perl",
+    "lua",
+    "r",
+    "r-base",
+    "mro-base",
+    "mro-base_impl",
+)
+
+
+# always excluded from the hash, they are part of the build string
+BUILD_STRING_EXCLUDES = ("python", "r_base", "perl", "lua", "target_platform")
+
+
+@lru_cache(maxsize=None)
+def _exclude_pattern(excludes):
+    return re.compile("|".join("{}[\\s$]?.*".format(exc) for exc in excludes))
+
+
+@lru_cache(maxsize=None)
+def _hash_pattern(hash_length):
+    return re.compile("h[0-9a-f]{%s}" % hash_length)
+
+
+@lru_cache(maxsize=None)
+def _split_key(in_key):
+    if in_key.count("/") == 2:
+        section, num, key = in_key.split("/")
+        return section, int(num), key
+    section, key = in_key.split("/")
+    return section, 0, key
+
+
 def get_package_version_pin(specs, name):
     for s in specs:
         x = s.split(" ")
@@ -127,6 +164,7 @@ class MetaData:
         self._meta_path = os.path.join(self.path, self._meta_name)
 
         self.noarch = self.output.sections["build"].get("noarch", None)
+        self._cache = {}
 
     def get_section(self, key: str) -> Union[Dict, Iterable]:
         return self.output.sections[key]
@@ -135,11 +173,7 @@ class MetaData:
         return self.output.skip()
 
     def get_value(self, in_key: str, default: Any = None, autotype=True) -> Any:
-        if in_key.count("/") == 2:
-            section, num, key = in_key.split("/")
-        else:
-            section, key = in_key.split("/")
-            num = 0
+        section, num, key = _split_key(in_key)
 
         # conda-build compat
         if default_structs:
@@ -151,7 +185,7 @@ class MetaData:
 
         section = self.meta.get(section, {})
         if isinstance(section, list):
-            return section[int(num)].get(key, default)
+            return section[num].get(key, default)
         else:
             return section.get(key, default)
 
@@ -289,6 +323,9 @@ class MetaData:
             rebuilds. We reduce the scope to include only the pins added by conda_build_config.yaml,
             and no longer hash files that contribute to the recipe.
         """
+        return self._cached("hash_dependencies", self._compute_hash_dependencies)
+
+    def _compute_hash_dependencies(self):
         hash_ = ""
         hashing_dependencies = self.get_hash_contents()
         if hashing_dependencies:
@@ -301,7 +338,35 @@ class MetaData:
             hash_ = "h{0}".format(hash_.hexdigest())[: self.config.hash_length + 1]
         return hash_
 
+    def _cache_state(self):
+        # everything the cached values depend on, besides the output itself
+        # which bumps its revision whenever it is finalized (finalize_solve
+        # also changes the variant in place). The variant is compared by
+        # identity first, other in place changes have to call invalidate.
+        return (
+            self.output.revision,
+            self.final,
+            self.config.filename_hashing,
+            self.config.hash_length,
+            self.meta.get("build", {}).get("string"),
+            self.config.variant,
+        )
+
+    def _cached(self, name, compute):
+        state = self._cache_state()
+        cached = self._cache.get(name)
+        if cached is None or cached[0] != state:
+            cached = self._cache[name] = (state, compute())
+        return cached[1]
+
+    def invalidate(self):
+        """Drop cached values after modifying the metadata in place"""
+        self._cache.clear()
+
     def build_id(self):
+        return self._cached("build_id", self._compute_build_id)
+
+    def _compute_build_id(self):
         manual_build_string = self.get_value("build/string")
         if manual_build_string:
             out = manual_build_string
@@ -310,7 +375,8 @@ class MetaData:
             out = build_string_from_metadata(self)
             if self.config.filename_hashing and self.final:
                 hash_ = self.hash_dependencies()
-                if not re.findall("h[0-9a-f]{%s}" % self.config.hash_length, out):
+                hash_pattern = _hash_pattern(self.config.hash_length)
+                if not hash_pattern.search(out):
                     ret = out.rsplit("_", 1)
                     try:
                         int(ret[0])
@@ -320,9 +386,40 @@ class MetaData:
                     if len(ret) > 1:
                         out = "_".join([out] + ret[1:])
                 else:
-                    out = re.sub("h[0-9a-f]{%s}" % self.config.hash_length, hash_, out)
+                    out = hash_pattern.sub(hash_, out)
         return out
 
+    def predict_build_id(self):
+        """The build id computed from the variant alone, before the environments
+        are solved. Returns None if the build id depends on the solve:
+
+        - python is a dependency but not part of the variant (the solved python
+          version is added to the hash)
+        - a package that adds a prefix to the build string (py, np, ...) is a
+          build or host dependency but not an explicit run dependency, so it
+          might only end up in the run requirements through run_exports
+        """
+        if self.get_value("build/string"):
+            return self.build_id()
+
+        dependencies = {
+            x.name
+            for x in self.get_dependencies("build") + self.get_dependencies("host")
+        }
+        if "python" in dependencies and self.config.variant.get("python") is None:
+            return None
+
+        run_dependencies = {
+            x.name
+            for x in self.get_dependencies("run")
+            if not x.is_transitive_dependency
+        }
+        for name in BUILD_STRING_PACKAGES:
+            if name in dependencies and name not in run_dependencies:
+                return None
+
+        return self.build_id()
+
     def dist(self):
         return "%s-%s-%s" % (self.name(), self.version(), self.build_id())
 
@@ -361,6 +458,10 @@ class MetaData:
         #    recipe.  Includes compiler if compiler jinja2 function is used.
         """
 
+        # computed once per finalized output, copied as callers might modify it
+        return dict(self._cached("hash_contents", self._compute_hash_contents))
+
+    def _compute_hash_contents(self):
         # trim_build_only_deps(self, dependencies)
         dependencies = (
             self.get_dependencies("build")
@@ -369,8 +470,7 @@ class MetaData:
         )
         dependencies = {x.name for x in dependencies}
         # filter out ignored versions
-        build_string_excludes = ["python", "r_base", "perl", "lua", "target_platform"]
-        build_string_excludes.extend(
+        build_string_excludes = BUILD_STRING_EXCLUDES + tuple(
             ensure_list(self.config.variant.get("ignore_version", []))
         )
 
@@ -383,9 +483,7 @@ class MetaData:
         #         build_string_excludes.append('numpy')
         # always exclude older stuff that's always in the build string (py, np, pl, r, lua)
         if build_string_excludes:
-            exclude_pattern = re.compile(
-                "|".join("{}[\\s$]?.*".format(exc) for exc in build_string_excludes)
-            )
+            exclude_pattern = _exclude_pattern(build_string_excludes)
             filtered_deps = []
             for req in dependencies:
                 if exclude_pattern.match(req):
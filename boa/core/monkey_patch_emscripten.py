@@ -2,7 +2,15 @@ import os
 import sys
 
 
+_patched = False
+
+
 def patch():
+    global _patched
+    if _patched:
+        return
+    _patched = True
+
     ###############################################
     # CONDA MONKEY-PATCH
     ###############################################
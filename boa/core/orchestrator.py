@@ -0,0 +1,137 @@
+# Copyright (C) 2021, QuantStack
+# SPDX-License-Identifier: BSD-3-Clause
+
+"""
+Tasks with explicit dependencies.
+
+Every task is a blocking function, it runs according to its kind:
+
+- ``io``: network and disk I/O (source downloads, ...), on a thread pool driven
+  by an asyncio event loop in a background thread
+- ``cpu``: CPU bound work (package compression, ...), like ``io`` tasks but on
+  a pluggable executor (a thread pool by default, pass a
+  ``ProcessPoolExecutor`` for work that holds the GIL)
+- ``serial``: steps using process global state (the libmamba context, the
+  build and host prefixes, the work directory, the terminal), one after the
+  other in the order they were added, on the thread calling ``TaskGraph.run``
+
+A task starts as soon as all its dependencies have finished, so for example
+the downloads for output N+1 run while the build script of output N runs.
+Serial tasks run on the calling (main) thread, so prompts, Ctrl-C and
+``sys.exit`` in a build behave as without the task graph.
+"""
+
+import asyncio
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+TASK_KINDS = ("io", "cpu", "serial")
+
+
+class DependencyFailed(Exception):
+    pass
+
+
+def _call(func, args):
+    try:
+        return True, func(*args)
+    except BaseException as e:  # noqa: B036
+        # also SystemExit, which would stop the event loop
+        return False, e
+
+
+def _run_loop(loop):
+    asyncio.set_event_loop(loop)
+    loop.run_forever()
+    # cancel the tasks that did not finish, like asyncio.run
+    tasks = asyncio.all_tasks(loop)
+    for task in tasks:
+        task.cancel()
+    loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+    loop.close()
+
+
+class TaskGraph:
+    def __init__(self, cpu_executor=None, io_workers=8):
+        self.cpu_executor = cpu_executor
+        self.io_workers = io_workers
+        self._tasks = {}
+
+    def add(self, name, func, *args, deps=(), kind="io"):
+        """Add the task ``name`` running ``func(*args)`` after the tasks
+        ``deps``, which have to be added before. Returns ``name``."""
+        if name in self._tasks:
+            raise ValueError(f"Task {name} already exists")
+        if kind not in TASK_KINDS:
+            raise ValueError(f"Unknown task kind {kind}")
+        for dep in deps:
+            if dep not in self._tasks:
+                raise ValueError(f"Unknown dependency {dep} of task {name}")
+        self._tasks[name] = (func, args, tuple(deps), kind)
+        return name
+
+    def run(self):
+        """Run all tasks and return their results by name.
+
+        An exception raised by a serial task, or by an I/O or CPU task a
+        serial task depends on, is raised again right away; the I/O and CPU
+        tasks that did not start yet are cancelled. Other failing I/O and CPU
+        tasks only fail the tasks depending on them, the first exception (in
+        the order the tasks were added) is raised once all tasks have
+        finished."""
+        executors = {
+            "io": ThreadPoolExecutor(self.io_workers, thread_name_prefix="boa-io"),
+            "cpu": self.cpu_executor
+            or ThreadPoolExecutor(os.cpu_count(), thread_name_prefix="boa-cpu"),
+        }
+        loop = asyncio.new_event_loop()
+        thread = threading.Thread(
+            target=_run_loop, args=(loop,), name="boa-tasks", daemon=True
+        )
+        thread.start()
+        # name -> concurrent.futures.Future of (ok, result or exception)
+        futures = {}
+        try:
+            for name, (func, args, deps, kind) in self._tasks.items():
+                if kind == "serial":
+                    futures[name] = Future()
+                else:
+                    futures[name] = asyncio.run_coroutine_threadsafe(
+                        self._run_task(
+                            loop, executors[kind], futures, name, func, args, deps
+                        ),
+                        loop,
+                    )
+
+            for name, (func, args, deps, kind) in self._tasks.items():
+                if kind != "serial":
+                    continue
+                for dep in deps:
+                    ok, value = futures[dep].result()
+                    if not ok:
+                        raise value
+                futures[name].set_result((True, func(*args)))
+
+            outcomes = {name: future.result() for name, future in futures.items()}
+        finally:
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+            for executor in executors.values():
+                if executor is not self.cpu_executor:
+                    executor.shutdown(wait=False)
+
+        for ok, value in outcomes.values():
+            if not ok and not isinstance(value, DependencyFailed):
+                raise value
+        return {name: value for name, (_, value) in outcomes.items()}
+
+    @staticmethod
+    async def _run_task(loop, executor, futures, name, func, args, deps):
+        for dep in deps:
+            ok, value = await asyncio.wrap_future(futures[dep])
+            if not ok:
+                error = DependencyFailed(f"{dep} (needed by {name}) failed")
+                error.__cause__ = value
+                return False, error
+        return await loop.run_in_executor(executor, _call, func, args)
@@ -0,0 +1,315 @@
+# Copyright (C) 2021, QuantStack
+# SPDX-License-Identifier: BSD-3-Clause
+
+"""
+Writing of the final package archives.
+
+Archives are created in a hidden temporary directory inside of the output
+folder and atomically renamed into place once complete, so that the index
+never picks up half-written packages and no extra copy is needed.
+"""
+
+import bz2
+import collections
+import inspect
+import json
+import os
+import shutil
+import tarfile
+import tempfile
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+import conda_package_handling.api
+from conda_package_handling.conda_fmt import CondaFormat_v2
+
+# bzip2 works on blocks of at most 900k, compressing chunks of that size
+# independently loses next to nothing in compression ratio.
+BZ2_CHUNK_SIZE = 900 * 1000
+
+CONDA_PACKAGE_FORMAT_VERSION = 2
+
+PKG_FORMAT_EXTENSIONS = {"1": ".tar.bz2", "2": ".conda"}
+
+
+def get_compression_threads(config):
+    threads = getattr(config, "compression_threads", 1)
+    if threads is None or threads <= 0:
+        threads = os.cpu_count() or 1
+    return threads
+
+
+class ParallelBZ2Writer:
+    """Write-only file object compressing chunks on a thread pool.
+
+    Every chunk becomes an independent bzip2 stream. The concatenation of
+    those streams is a valid multi-stream bzip2 file (as produced by
+    ``pbzip2``) that is read back transparently by ``bz2``, ``tarfile``
+    and libarchive.
+    """
+
+    def __init__(self, fileobj, threads, compresslevel=9, chunk_size=BZ2_CHUNK_SIZE):
+        self._fileobj = fileobj
+        self._compresslevel = compresslevel
+        self._chunk_size = chunk_size
+        self._max_pending = 2 * threads
+        self._pool = ThreadPoolExecutor(max_workers=threads)
+        self._pending = collections.deque()
+        self._buffer = bytearray()
+        self._written_streams = 0
+
+    def write(self, data):
+        self._buffer += data
+        while len(self._buffer) >= self._chunk_size:
+            chunk = bytes(self._buffer[: self._chunk_size])
+            del self._buffer[: self._chunk_size]
+            self._submit(chunk)
+        return len(data)
+
+    def _submit(self, chunk):
+        self._pending.append(
+            self._pool.submit(bz2.compress, chunk, self._compresslevel)
+        )
+        # keep memory bounded, results are written in submission order
+        while len(self._pending) > self._max_pending:
+            self._write_next()
+
+    def _write_next(self):
+        self._fileobj.write(self._pending.popleft().result())
+        self._written_streams += 1
+
+    def close(self):
+        if self._buffer or not (self._pending or self._written_streams):
+            self._submit(bytes(self._buffer))
+            self._buffer = bytearray()
+        try:
+            while self._pending:
+                self._write_next()
+        finally:
+            self._pool.shutdown()
+
+
+def _anonymize_tarinfo(tarinfo):
+    tarinfo.uid = tarinfo.gid = 0
+    tarinfo.uname = tarinfo.gname = ""
+    return tarinfo
+
+
+def sort_file_order(files):
+    """info/ files first (so that readers find them early), then the rest
+    grouped by extension which helps the compression ratio."""
+
+    def order(f):
+        f = f.replace("\\", "/")
+        return (not f.startswith("info/"), os.path.splitext(f)[1], f)
+
+    return sorted(files, key=order)
+
+
+class TarBz2Writer:
+    """Writer for ``.tar.bz2`` packages, compressed with ``ParallelBZ2Writer``."""
+
+    def __init__(self, path, threads):
+        self._fileobj = open(path, "wb")
+        self._writer = ParallelBZ2Writer(self._fileobj, threads)
+        self._tar = tarfile.open(fileobj=self._writer, mode="w|")
+
+    def add(self, path, arcname):
+        self._tar.add(path, arcname=arcname, recursive=False, filter=_anonymize_tarinfo)
+
+    def close(self):
+        try:
+            self._tar.close()
+            self._writer.close()
+        finally:
+            self._fileobj.close()
+
+
+class CondaWriter:
+    """Writer for ``.conda`` packages.
+
+    Files have to be added grouped by component (see ``sort_file_order``), as
+    only one member of the zip container can be open for writing at a time.
+    """
+
+    def __init__(self, path, compression_level, threads):
+        import zstandard
+
+        self._file_id = os.path.basename(path)[: -len(".conda")]
+        self._compressor = zstandard.ZstdCompressor(
+            level=compression_level, threads=threads if threads > 1 else 0
+        )
+        self._zip = zipfile.ZipFile(path, "w", compression=zipfile.ZIP_STORED)
+        self._zip.writestr(
+            "metadata.json",
+            json.dumps({"conda_pkg_format_version": CONDA_PACKAGE_FORMAT_VERSION}),
+        )
+        self._written = set()
+        self._component = None
+
+    def _open_component(self, component):
+        if component in self._written:
+            raise ValueError(f"Files of component {component} are not grouped")
+        self._close_component()
+        raw = self._zip.open(
+            f"{component}-{self._file_id}.tar.zst", "w", force_zip64=True
+        )
+        stream = self._compressor.stream_writer(raw, closefd=False)
+        tar = tarfile.open(fileobj=stream, mode="w|")
+        self._component = (component, raw, stream, tar)
+
+    def _close_component(self):
+        if self._component is None:
+            return
+        component, raw, stream, tar = self._component
+        tar.close()
+        stream.close()
+        raw.close()
+        self._written.add(component)
+        self._component = None
+
+    def add(self, path, arcname):
+        is_info = arcname.replace("\\", "/").startswith("info/")
+        component = "info" if is_info else "pkg"
+        if self._component is None or self._component[0] != component:
+            self._open_component(component)
+        self._component[3].add(
+            path, arcname=arcname, recursive=False, filter=_anonymize_tarinfo
+        )
+
+    def close(self):
+        try:
+            for component in ("info", "pkg"):
+                if component not in self._written and (
+                    self._component is None or self._component[0] != component
+                ):
+                    # both components are always present, even if empty
+                    self._open_component(component)
+            self._close_component()
+        finally:
+            self._zip.close()
+
+
+def create_tar_bz2(prefix, files, out_path, threads):
+    writer = TarBz2Writer(out_path, threads)
+    try:
+        for f in sort_file_order(files):
+            writer.add(os.path.join(prefix, f), f)
+    finally:
+        writer.close()
+    return out_path
+
+
+def _zstd_kwargs(compression_level, threads):
+    if "compressor" in inspect.signature(CondaFormat_v2.create).parameters:
+        import zstandard
+
+        # zstandard: 0 is single-threaded, N > 1 spawns N worker threads
+        zstd_threads = threads if threads > 1 else 0
+
+        def compressor():
+            return zstandard.ZstdCompressor(
+                level=compression_level, threads=zstd_threads
+            )
+
+        return {"compressor": compressor}
+
+    # conda-package-handling < 2 only knows the (single-threaded) tuple
+    return {
+        "compression_tuple": (
+            ".tar.zst",
+            "zstd",
+            f"zstd:compression-level={compression_level}",
+        )
+    }
+
+
+def create_package(
+    prefix, files, out_fn, out_folder, zstd_compression_level=22, threads=1
+):
+    """Create the package ``out_fn`` in ``out_folder`` from ``files`` (relative to
+    ``prefix``) and return the path of the final archive."""
+    os.makedirs(out_folder, exist_ok=True)
+    final_path = os.path.join(out_folder, out_fn)
+
+    # same filesystem as the final path, so the rename below is atomic
+    tmp_dir = tempfile.mkdtemp(prefix=".boa-", dir=out_folder)
+    try:
+        tmp_path = os.path.join(tmp_dir, out_fn)
+        if out_fn.endswith(".conda"):
+            conda_package_handling.api.create(
+                prefix,
+                files,
+                out_fn,
+                out_folder=tmp_dir,
+                **_zstd_kwargs(zstd_compression_level, threads),
+            )
+        elif threads > 1:
+            create_tar_bz2(prefix, files, tmp_path, threads)
+        else:
+            conda_package_handling.api.create(prefix, files, out_fn, out_folder=tmp_dir)
+        os.replace(tmp_path, final_path)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    return final_path
+
+
+def create_packages(
+    prefix,
+    files,
+    basename,
+    extensions,
+    out_folder,
+    zstd_compression_level=22,
+    threads=1,
+):
+    """Create one package per extension in ``extensions`` and return their paths.
+
+    With more than one extension all archives are written in a single pass over
+    the file list, adding every file to all archives before moving on to the next
+    one, so that each file is only read from disk once.
+    """
+    if len(extensions) == 1:
+        return [
+            create_package(
+                prefix,
+                files,
+                basename + extensions[0],
+                out_folder,
+                zstd_compression_level=zstd_compression_level,
+                threads=threads,
+            )
+        ]
+
+    os.makedirs(out_folder, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(prefix=".boa-", dir=out_folder)
+    try:
+        writers = []
+        try:
+            for ext in extensions:
+                tmp_path = os.path.join(tmp_dir, basename + ext)
+                if ext == ".conda":
+                    writers.append(
+                        CondaWriter(tmp_path, zstd_compression_level, threads)
+                    )
+                else:
+                    writers.append(TarBz2Writer(tmp_path, threads))
+
+            for f in sort_file_order(files):
+                path = os.path.join(prefix, f)
+                for writer in writers:
+                    writer.add(path, f)
+        finally:
+            for writer in writers:
+                writer.close()
+
+        final_paths = []
+        for ext in extensions:
+            final_path = os.path.join(out_folder, basename + ext)
+            os.replace(os.path.join(tmp_dir, basename + ext), final_path)
+            final_paths.append(final_path)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    return final_paths
@@ -0,0 +1,126 @@
+# Copyright (C) 2021, QuantStack
+# SPDX-License-Identifier: BSD-3-Clause
+
+import os
+import queue
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from conda.base.context import context
+
+from boa.core.config import boa_config
+from boa.core.profiling import profiler
+from boa.core.test import run_test
+
+console = boa_config.console
+
+
+def forwarded_test_args(args, output_folder=None):
+    """Options of ``args`` (of ``boa build``) that apply to ``boa test``, as a
+    command line. ``--croot`` is left out, every test job uses its own.
+
+    The tests resolve the built packages from ``output_folder``, the build
+    keeps its index up to date, so the test jobs do not update it."""
+    argv = []
+    output_folder = output_folder or getattr(args, "output_folder", None)
+    if output_folder:
+        argv += ["--output-folder", os.path.abspath(output_folder)]
+    argv.append("--no-update-index")
+    if getattr(args, "offline", False):
+        argv.append("--offline")
+    if getattr(args, "target_platform", None):
+        argv += ["--target-platform", args.target_platform]
+    for f in getattr(args, "variant_config_files", None) or []:
+        argv += ["-m", os.path.abspath(f)]
+    for dep in getattr(args, "extra_deps", None) or []:
+        argv += ["--extra-deps", dep]
+    if getattr(args, "conda_build_build_id_pat", False):
+        argv += ["--build-id-pat", args.conda_build_build_id_pat]
+    if not getattr(args, "conda_build_remove_work_dir", True):
+        argv.append("--no-remove-work-dir")
+    if getattr(args, "conda_build_keep_old_work", False):
+        argv.append("--keep-old-work")
+    if getattr(args, "conda_build_prefix_length", None):
+        argv += ["--prefix-length", str(args.conda_build_prefix_length)]
+    return argv
+
+
+class TestScheduler:
+    """Runs the tests of finished outputs while the following outputs build.
+
+    With a single job the tests run inline, right after the build of an output.
+    With more jobs every test runs in its own ``boa test`` process (the solver
+    and the mamba context are process global) on a worker pool, with the
+    options ``argv`` (see ``forwarded_test_args``). Every worker slot uses its
+    own build root, so that concurrent tests never share a test prefix or test
+    directory.
+    """
+
+    def __init__(self, jobs=1, argv=(), extra_deps=None, test_envs=None):
+        self.jobs = max(jobs or 1, 1)
+        self.argv = list(argv)
+        self.extra_deps = extra_deps
+        # the test environment cache of the build, for tests in this process
+        self.test_envs = test_envs
+        self._pool = None
+        self._futures = []
+        self._slots = queue.Queue()
+        for slot in range(self.jobs):
+            self._slots.put(slot)
+
+    def submit(self, output, package, config):
+        if self.jobs == 1:
+            with profiler.phase("test", output=output.name):
+                run_test(
+                    package,
+                    config,
+                    {},
+                    move_broken=False,
+                    provision_only=False,
+                    extra_deps=self.extra_deps,
+                    test_envs=self.test_envs,
+                )
+            return
+
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=self.jobs)
+        console.print(f"[yellow]Scheduling tests of {os.path.basename(package)}")
+        future = self._pool.submit(self._run, output, package, config)
+        self._futures.append((output, package, future))
+
+    def _run(self, output, package, config):
+        slot = self._slots.get()
+        try:
+            croot = os.path.join(config.croot, "boa_test_jobs", str(slot))
+            cmd = [sys.executable, "-m", "boa.cli.boa", "test", *self.argv]
+            cmd += ["--croot", croot, package]
+            # the channels of the build, also if they do not come from .condarc
+            env = dict(os.environ, CONDA_CHANNELS=",".join(context.channels))
+            with profiler.phase("test", output=output.name):
+                proc = subprocess.run(
+                    cmd,
+                    env=env,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.STDOUT,
+                    universal_newlines=True,
+                )
+            return proc.returncode, proc.stdout
+        finally:
+            self._slots.put(slot)
+
+    def wait(self):
+        """Wait for all scheduled tests and return the outputs that failed"""
+        failed = []
+        for output, package, future in self._futures:
+            returncode, log = future.result()
+            console.print(f"\n[yellow]Tests of {os.path.basename(package)}[/yellow]\n")
+            print(log)
+            if returncode != 0:
+                console.print(f"[red]Tests failed for {os.path.basename(package)}")
+                failed.append(output)
+        self._futures = []
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+        return failed
@@ -0,0 +1,93 @@
+# Copyright (C) 2021, QuantStack
+# SPDX-License-Identifier: BSD-3-Clause
+
+import fnmatch
+import os
+import re
+
+_MAGIC = re.compile(r"[*?\[]")
+
+
+class PrefixIndex:
+    """Existence checks against a prefix with one ``os.scandir`` per directory.
+
+    Directory listings are read lazily and kept in memory, so that checking
+    many files in the same directories (``lib``, ``include``, ``bin``, ...)
+    costs a single listing per directory instead of a ``stat`` per file.
+    Symlinks are followed, like ``os.path.isfile`` and ``os.path.isdir`` do.
+    """
+
+    def __init__(self, prefix):
+        self.prefix = os.path.abspath(prefix)
+        self._listings = {}
+
+    def listdir(self, path):
+        """Map of entry name to ``"d"`` (directory), ``"f"`` (file) or ``"o"``
+        (anything else) for the directory ``path``, empty if it does not exist."""
+        path = os.path.normpath(path)
+        listing = self._listings.get(path)
+        if listing is None:
+            listing = {}
+            try:
+                with os.scandir(path) as it:
+                    for entry in it:
+                        try:
+                            if entry.is_dir():
+                                listing[entry.name] = "d"
+                            elif entry.is_file():
+                                listing[entry.name] = "f"
+                            else:
+                                # broken symlinks, sockets, ...
+                                listing[entry.name] = "o"
+                        except OSError:
+                            listing[entry.name] = "o"
+            except OSError:
+                pass
+            self._listings[path] = listing
+        return listing
+
+    def kind(self, path):
+        path = os.path.normpath(os.path.join(self.prefix, path))
+        parent, name = os.path.split(path)
+        if not name:
+            return "d" if os.path.isdir(path) else None
+        return self.listdir(parent).get(name)
+
+    def isfile(self, path):
+        return self.kind(path) == "f"
+
+    def isdir(self, path):
+        return self.kind(path) == "d"
+
+    def glob(self, pattern):
+        """Same matches as ``glob.glob(pattern)`` (non-recursive), sorted"""
+        # a trailing separator only matches directories
+        dirs_only = pattern.endswith(("/", os.sep))
+        pattern = os.path.normpath(os.path.join(self.prefix, pattern))
+        drive, rest = os.path.splitdrive(pattern)
+        root = drive + os.sep if os.path.isabs(pattern) else ""
+        parts = [p for p in rest.split(os.sep) if p]
+
+        current = [root or os.curdir]
+        for i, part in enumerate(parts):
+            last = i == len(parts) - 1
+            matches = []
+            for base in current:
+                listing = self.listdir(base)
+                if _MAGIC.search(part):
+                    names = fnmatch.filter(listing, part)
+                    if not part.startswith("."):
+                        names = [n for n in names if not n.startswith(".")]
+                else:
+                    names = [part] if part in listing else []
+                for name in names:
+                    if (last and not dirs_only) or listing[name] == "d":
+                        matches.append(os.path.join(base, name))
+            current = matches
+            if not current:
+                break
+        if not root:
+            current = [os.path.relpath(p) for p in current]
+        if dirs_only:
+            current = [p + os.sep for p in current]
+        return sorted(current)
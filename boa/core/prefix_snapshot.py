@@ -0,0 +1,92 @@
+# Copyright (C) 2021, QuantStack
+# SPDX-License-Identifier: BSD-3-Clause
+
+import os
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Set, Tuple
+
+# Directories modified this close to a scan might receive further changes
+# within the same mtime tick (filesystems with coarse timestamps), so they are
+# always listed again on the next refresh.
+RACY_WINDOW_NS = 2 * 10**9
+
+
+@dataclass
+class _DirRecord:
+    key: Tuple[int, int]
+    racy: bool
+    files: Dict[str, int] = field(default_factory=dict)
+    subdirs: List[str] = field(default_factory=list)
+
+
+class PrefixSnapshot:
+    """Listing of the files in a prefix that can be refreshed incrementally.
+
+    The file set is the same as the one returned by
+    ``conda_build.utils.prefix_files``: all files (including broken symlinks)
+    and symlinks to directories, relative to the prefix.
+
+    For every directory the inode and mtime are recorded. Adding, removing or
+    renaming an entry changes the mtime of its parent directory, so on
+    ``refresh`` only directories whose (inode, mtime) changed are listed again
+    with ``os.scandir``; all others reuse their previous listing, which turns
+    repeated walks of a large prefix into one ``stat`` per directory.
+    """
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self._dirs: Dict[str, _DirRecord] = {}
+        self._files: Dict[str, int] = {}
+        self.refresh()
+
+    def files(self) -> Set[str]:
+        return set(self._files)
+
+    def inodes(self) -> Dict[str, int]:
+        return dict(self._files)
+
+    def refresh(self) -> Set[str]:
+        dirs: Dict[str, _DirRecord] = {}
+        files: Dict[str, int] = {}
+        now_ns = time.time_ns()
+        self._scan_dir("", self.prefix, now_ns, dirs, files)
+        self._dirs = dirs
+        self._files = files
+        return self.files()
+
+    def _scan_dir(self, rel, path, now_ns, dirs, files):
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return
+
+        key = (st.st_ino, st.st_mtime_ns)
+        record = self._dirs.get(rel)
+        if record is None or record.racy or record.key != key:
+            record = _DirRecord(key, racy=now_ns - st.st_mtime_ns < RACY_WINDOW_NS)
+            try:
+                with os.scandir(path) as it:
+                    for entry in it:
+                        relpath = os.path.join(rel, entry.name) if rel else entry.name
+                        try:
+                            is_dir = entry.is_dir()
+                        except OSError:
+                            is_dir = False
+                        if is_dir and not entry.is_symlink():
+                            record.subdirs.append(entry.name)
+                        else:
+                            record.files[relpath] = entry.inode()
+            except FileNotFoundError:
+                return
+        dirs[rel] = record
+        files.update(record.files)
+
+        for name in record.subdirs:
+            self._scan_dir(
+                os.path.join(rel, name) if rel else name,
+                os.path.join(path, name),
+                now_ns,
+                dirs,
+                files,
+            )
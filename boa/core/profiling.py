@@ -0,0 +1,161 @@
+# Copyright (C) 2021, QuantStack
+# SPDX-License-Identifier: BSD-3-Clause
+
+"""
+Timing and resource usage of the build phases.
+
+Every phase records wall time, CPU time (of boa and its child processes),
+the RSS of boa at its start and end and the bytes read and written. CPU time
+and I/O are measured for the whole process, phases that run concurrently
+(e.g. parallel tests) are therefore attributed each other's usage. The peak
+RSS is only known for the whole process and is reported once per run.
+
+The records are written as JSON or in the Chrome trace event format
+(viewable with chrome://tracing or https://ui.perfetto.dev).
+"""
+
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    # Windows
+    resource = None
+
+PROFILE_FORMATS = ("json", "chrome")
+
+
+def _read_io():
+    """Bytes read and written by this process (Linux only)"""
+    try:
+        with open("/proc/self/io") as fi:
+            values = dict(line.split(": ") for line in fi.read().splitlines())
+        return int(values["read_bytes"]), int(values["write_bytes"])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def _children_cpu_time():
+    if resource is None:
+        return 0.0
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _current_rss():
+    """Current RSS in bytes of this process (Linux only)"""
+    try:
+        with open("/proc/self/statm") as fi:
+            return int(fi.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def peak_rss():
+    """Peak RSS in bytes of this process and of its largest child"""
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    scale = 1 if sys.platform == "darwin" else 1024
+    return scale * max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+
+
+class Profiler:
+    def __init__(self):
+        self.enabled = False
+        self.events = []
+        self._lock = threading.Lock()
+        self._start = time.perf_counter()
+
+    def enable(self):
+        self.enabled = True
+
+    def reset(self):
+        """Disable the profiler and drop the recorded events"""
+        self.enabled = False
+        with self._lock:
+            self.events = []
+        self._start = time.perf_counter()
+
+    def _sample(self):
+        return (
+            time.perf_counter(),
+            time.process_time() + _children_cpu_time(),
+            _read_io(),
+            _current_rss(),
+        )
+
+    @contextmanager
+    def phase(self, name, **labels):
+        """Record the phase ``name``, ``labels`` (e.g. output name, environment)
+        are stored with the record."""
+        if not self.enabled:
+            yield
+            return
+
+        wall_start, cpu_start, io_start, rss_start = self._sample()
+        try:
+            yield
+        finally:
+            wall_end, cpu_end, io_end, rss_end = self._sample()
+            event = {
+                "name": name,
+                "labels": labels,
+                "thread": threading.get_ident(),
+                "start": wall_start - self._start,
+                "wall_time": wall_end - wall_start,
+                "cpu_time": cpu_end - cpu_start,
+                "rss_start": rss_start,
+                "rss_end": rss_end,
+            }
+            if io_start and io_end:
+                event["read_bytes"] = io_end[0] - io_start[0]
+                event["write_bytes"] = io_end[1] - io_start[1]
+            with self._lock:
+                self.events.append(event)
+
+    def to_json(self):
+        return {"pid": os.getpid(), "peak_rss": peak_rss(), "phases": self.events}
+
+    def to_chrome_trace(self):
+        trace_events = []
+        for event in self.events:
+            args = dict(event["labels"])
+            args.update(
+                (k, v)
+                for k, v in event.items()
+                if k not in ("name", "labels", "thread", "start")
+            )
+            trace_events.append(
+                {
+                    "name": event["name"],
+                    "cat": "boa",
+                    "ph": "X",
+                    "ts": int(event["start"] * 1e6),
+                    "dur": int(event["wall_time"] * 1e6),
+                    "pid": os.getpid(),
+                    "tid": event["thread"],
+                    "args": args,
+                }
+            )
+        return {
+            "traceEvents": trace_events,
+            "displayTimeUnit": "ms",
+            "otherData": {"peak_rss": peak_rss()},
+        }
+
+    def write(self, path, fmt="json"):
+        data = self.to_chrome_trace() if fmt == "chrome" else self.to_json()
+        with open(path, "w") as fo:
+            json.dump(data, fo, indent=2)
+
+
+profiler = Profiler()
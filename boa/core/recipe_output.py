@@ -21,6 +21,7 @@ from conda_build.jinja_context import native_compiler
 from libmambapy import Context as MambaContext
 from boa.core.config import boa_config
 from boa.core.conda_build_spec import CondaBuildSpec
+from boa.core.profiling import profiler
 from boa.helpers.ast_extract_syms import ast_extract_syms
 
 console = boa_config.console
@@ -50,6 +51,8 @@ class Output:
         self.noarch = d["build"].get("noarch", False)
         self.is_first = False
         self.is_package = "package" in d
+        # bumped whenever the output is finalized, invalidates MetaData caches
+        self.revision = 0
 
         self.sections = {}
 
@@ -541,7 +544,8 @@ class Output:
             elif env == "build":
                 MambaContext().target_prefix = self.config.build_prefix
                 # solver.replace_installed(self.config.build_prefix)
-            t = solver.solve(specs, [pkg_cache])
+            with profiler.phase("solve", output=self.name, env=env):
+                t = solver.solve(specs, [pkg_cache])
 
             _, install_pkgs, _ = t.to_conda()
             for _, _, p in install_pkgs:
@@ -564,15 +568,19 @@ class Output:
                 "pkg_cache": pkg_cache,
             }
 
-            downloaded = t.fetch_extract_packages()
+            # libmamba fetches and extracts in one step
+            with profiler.phase("fetch_extract", output=self.name, env=env):
+                downloaded = t.fetch_extract_packages()
             if not downloaded:
                 raise RuntimeError("Did not succeed in downloading packages.")
 
             if env in ("build", "host"):
                 self.propagate_run_exports(env, self.transactions[env]["pkg_cache"])
 
-    def set_final_build_id(self, meta, all_outputs):
-        self.final_build_id = meta.build_id()
+    def set_final_build_id(self, meta, all_outputs, build_id=None):
+        # build_id: the predicted build id of an output that is not solved
+        self.final_build_id = build_id or meta.build_id()
+        self.revision += 1
 
         final_run_exports = {}
         # we need to evaluate run_exports pin_subpackage here
@@ -606,3 +614,4 @@ class Output:
             )
 
         self.variant = self.config.variant
+        self.revision += 1
@@ -5,7 +5,6 @@ import argparse
 import os
 import glob
 import json
-import shutil
 import pathlib
 from collections import OrderedDict
 
@@ -20,9 +19,22 @@ from boa.core.render import render
 from boa.core.utils import get_config
 from boa.core.recipe_output import Output
 from boa.core.solver import refresh_solvers
-from boa.core.build import build, download_source
+from boa.core.build import build, download_source, write_package
+from boa.core.clone import clone_tree
+from boa.core.env_cache import TestEnvCache
+from boa.core.existing_index import ExistingPackages
 from boa.core.metadata import MetaData
-from boa.core.test import run_test
+from boa.core.parallel_tests import TestScheduler, forwarded_test_args
+from boa.core.profiling import profiler
+from boa.core.orchestrator import TaskGraph
+from boa.core.source_cache import (
+    SourceCache,
+    SourceTreeCache,
+    WorkDirSources,
+    fetch_source,
+    src_cache_fn,
+)
+from boa.core.step_cache import StepCache, get_required_step, step_work_dir
 from boa.core.config import boa_config
 from boa.core.validation import validate, ValidationError, SchemaError
 from boa.core.variant_arithmetic import get_variants
@@ -184,6 +196,41 @@ def to_build_tree(ydoc, variants, config, cbc, selected_features):
     return final_outputs
 
 
+def _prefetch_source(m, source_dict, cache):
+    try:
+        fetch_source(m, source_dict, cache)
+    except Exception as e:
+        # the build downloads it again and reports the error
+        console.print(f"[yellow]Could not prefetch {source_dict['url']}: {e}")
+
+
+def prefetch_sources(graph, recipe_path, outputs):
+    """Add tasks downloading the url sources of ``outputs`` into the source
+    cache to ``graph``. Returns the names of the download tasks by output index."""
+    cache = SourceCache()
+    tasks = {}
+    by_source = {}
+    for i, o in enumerate(outputs):
+        if o.skip():
+            continue
+        m = MetaData(recipe_path, o)
+        for source_dict in m.get_section("source"):
+            if not source_dict.get("url"):
+                continue
+            # the same archive can be listed with other patches or folders
+            key = src_cache_fn(source_dict) or str(source_dict["url"])
+            if key not in by_source:
+                by_source[key] = graph.add(
+                    f"download {len(by_source)} {o.name}",
+                    _prefetch_source,
+                    m,
+                    source_dict,
+                    cache,
+                )
+            tasks.setdefault(i, []).append(by_source[key])
+    return tasks
+
+
 def build_recipe(
     command,
     recipe_path,
@@ -197,8 +244,13 @@ def build_recipe(
     continue_on_failure: bool = False,
     rerun_build: bool = False,
     pyproject_recipes=False,
+    test_jobs: int = 1,
+    cpu_executor=None,
+    test_argv=(),
+    extra_deps=None,
 ):
-    ydoc = render(recipe_path, config=config, is_pyproject_recipe=pyproject_recipes)
+    with profiler.phase("render", recipe=recipe_path):
+        ydoc = render(recipe_path, config=config, is_pyproject_recipe=pyproject_recipes)
     # We need to assemble the variants for each output
     variants = {}
     # if we have a outputs section, use that order the outputs
@@ -223,7 +275,8 @@ def build_recipe(
 
     # this takes in all variants and outputs, builds a dependency tree and returns
     # the final metadata
-    sorted_outputs = to_build_tree(ydoc, variants, config, cbc, selected_features)
+    with profiler.phase("variant_expansion", recipe=recipe_path):
+        sorted_outputs = to_build_tree(ydoc, variants, config, cbc, selected_features)
 
     # then we need to solve and build from the bottom up
     # we can't first solve all packages without finalizing everything
@@ -257,25 +310,18 @@ def build_recipe(
 
     full_render = command == "full-render"
 
-    if skip_fast:
-        build_pkgs = []
-
-        archs = [o0.variant["target_platform"], "noarch"]
-        for arch in archs:
-            build_pkgs += [
-                os.path.basename(x.rsplit("-", 1)[0])
-                for x in glob.glob(
-                    os.path.join(
-                        o0.config.output_folder,
-                        arch,
-                        "*.tar.bz2",
-                    )
-                )
-            ]
+    existing_packages = None
+    if skip_existing:
+        existing_packages = ExistingPackages(
+            o0.config.output_folder, [o0.variant["target_platform"], "noarch"]
+        )
 
+    if skip_fast:
         del_idx = []
         for i in range(len(sorted_outputs)):
-            if f"{sorted_outputs[i].name}-{sorted_outputs[i].version}" in build_pkgs:
+            if existing_packages.has_version(
+                sorted_outputs[i].name, sorted_outputs[i].version
+            ):
                 del_idx.append(i)
 
         for idx in del_idx[::-1]:
@@ -284,48 +330,86 @@ def build_recipe(
             )
             del sorted_outputs[idx]
 
+    source_trees = SourceTreeCache(config)
+    work_dir_sources = WorkDirSources(
+        source_trees, lambda m: download_source(m, interactive)
+    )
+
     # Do not download source if we might skip
     if not (skip_existing or full_render) and not rerun_build:
         console.print("\n[yellow]Downloading source[/yellow]\n")
-        download_source(MetaData(recipe_path, o0), interactive)
-        cached_source = o0.sections["source"]
-    else:
-        cached_source = {}
+        m0 = MetaData(recipe_path, o0)
+        rm_rf(o0.config.work_dir)
+        download_source(m0, interactive)
+        work_dir_sources.provided(m0)
+        source_key = source_trees.key(m0)
+        if source_key:
+            source_trees.store(source_key, o0.config.work_dir)
 
     failed_outputs = []
 
-    for o in sorted_outputs:
+    # the stored environments are only valid for the test prefix of this build
+    test_envs = TestEnvCache(o0.config)
+    test_scheduler = TestScheduler(test_jobs, test_argv, extra_deps, test_envs)
+    step_cache = StepCache(config) if getattr(config, "use_step_cache", False) else None
+
+    stopped = False
+    # index of the output -> StagedPackage, compressed by package_output
+    staged_packages = {}
+
+    def build_output(i, o):
+        nonlocal stopped
+        if stopped:
+            return
+
         try:
             console.print(
                 f"\n[yellow]Preparing environment for [bold]{o.name}[/bold][/yellow]\n"
             )
-            refresh_solvers()
-
             o.config._build_id = o0.config.build_id
 
+            predicted_build_id = None
+            if skip_existing and not o.skip():
+                predicted_meta = MetaData(recipe_path, o)
+                predicted_build_id = predicted_meta.predict_build_id()
+                predicted_name = f"{o.name}-{o.version}-{predicted_build_id}"
+                if predicted_build_id and existing_packages.has_dist(predicted_name):
+                    # finalized like a solved output, pin_subpackage of the
+                    # following outputs needs the build id and run_exports
+                    o.set_final_build_id(
+                        predicted_meta, sorted_outputs, predicted_build_id
+                    )
+                    console.print(f"\n[green]Skipping existing {predicted_name}\n")
+                    return
+
+            refresh_solvers()
             o.finalize_solve(sorted_outputs)
 
             meta = MetaData(recipe_path, o)
             o.set_final_build_id(meta, sorted_outputs)
 
+            if predicted_build_id and predicted_build_id != o.final_build_id:
+                console.print(
+                    f"[yellow]Predicted build string {predicted_build_id} of {o.name} "
+                    f"differs from the final build string {o.final_build_id}"
+                )
+
             if o.skip() or full_render:
-                continue
+                return
 
             final_name = meta.dist()
 
-            # TODO this doesn't work for noarch!
-            if skip_existing:
-                final_name = meta.dist()
+            if skip_existing and existing_packages.has_dist(final_name):
+                console.print(f"\n[green]Skipping existing {final_name}\n")
+                return
 
-                if os.path.exists(
-                    os.path.join(
-                        o.config.output_folder,
-                        o.variant["target_platform"],
-                        final_name + ".tar.bz2",
-                    )
-                ):
-                    console.print(f"\n[green]Skipping existing {final_name}\n")
-                    continue
+            step_key = None
+            if not o.is_package and step_cache is not None:
+                step_key = step_cache.key(meta)
+                if step_key and step_cache.restore(step_key, step_work_dir(o)):
+                    o.moved_work_dir = step_work_dir(o)
+                    console.print(f"\n[green]Restored step {o.name} from cache\n")
+                    return
 
             if "build" in o.transactions:
                 if os.path.isdir(o.config.build_prefix):
@@ -334,9 +418,10 @@ def build_recipe(
                 try:
                     MambaContext().target_prefix = o.config.build_prefix
                     o.transactions["build"]["transaction"].print()
-                    o.transactions["build"]["transaction"].execute(
-                        PrefixData(o.config.build_prefix),
-                    )
+                    with profiler.phase("link", output=o.name, env="build"):
+                        o.transactions["build"]["transaction"].execute(
+                            PrefixData(o.config.build_prefix),
+                        )
                 except Exception:
                     # This currently enables windows-multi-build...
                     print("Could not instantiate build environment")
@@ -345,39 +430,36 @@ def build_recipe(
                 mkdir_p(os.path.join(o.config.host_prefix, "conda-meta"))
                 MambaContext().target_prefix = o.config.host_prefix
                 o.transactions["host"]["transaction"].print()
-                o.transactions["host"]["transaction"].execute(
-                    PrefixData(o.config.host_prefix)
-                )
+                with profiler.phase("link", output=o.name, env="host"):
+                    o.transactions["host"]["transaction"].execute(
+                        PrefixData(o.config.host_prefix)
+                    )
 
-            if cached_source != o.sections["source"] and not rerun_build:
-                download_source(meta, interactive)
-                cached_source = o.sections["source"]
+            if not rerun_build:
+                work_dir_sources.prepare(meta)
 
             if o.required_steps:
                 console.print(f"\n[red]Reusing steps: {o.required_steps}[/red]")
                 for step in o.required_steps:
-                    # TODO handle variants
-                    for other in sorted_outputs:
-                        if other.name == step:
-                            shutil.copytree(
-                                other.moved_work_dir,
-                                o.config.work_dir,
-                                dirs_exist_ok=True,
-                            )
-                            break
+                    other = get_required_step(o, step, sorted_outputs)
+                    clone_tree(other.moved_work_dir, o.config.work_dir)
 
             console.print(
                 f"\n[yellow]Starting build for [bold]{o.name}[/bold][/yellow]\n"
             )
 
-            final_outputs = build(
+            staged = build(
                 meta,
                 None,
                 allow_interactive=interactive,
                 continue_on_failure=continue_on_failure,
                 provision_only=boa_config.debug,
+                write=False,
             )
 
+            if step_key and getattr(o, "moved_work_dir", None):
+                step_cache.store(step_key, o.moved_work_dir)
+
             if boa_config.debug:
                 console.print("\n[yellow]Stopping for debugging.\n")
 
@@ -388,19 +470,11 @@ def build_recipe(
                 console.print(f"Work directory: {work_dir}")
                 console.print(f"Try building again with {build_cmd}")
 
+                stopped = True
                 return
 
-            stats = {}
-            if final_outputs is not None:
-                for final_out in final_outputs:
-                    if not notest:
-                        run_test(
-                            final_out,
-                            o.config,
-                            stats,
-                            move_broken=False,
-                            provision_only=False,
-                        )
+            if o.is_package and staged:
+                staged_packages[i] = staged
 
         except Exception as e:
             if continue_on_failure:
@@ -415,6 +489,101 @@ def build_recipe(
                 console.print_exception(show_locals=False)
                 exit(1)
 
+    # packages of the outputs that are tested in this process, by index
+    packages_to_test = {}
+
+    def package_output(i, o):
+        staged = staged_packages.pop(i, None)
+        if staged is None:
+            return
+
+        try:
+            final_outputs = write_package(staged)
+        except Exception as e:
+            if continue_on_failure:
+                console.print(
+                    f"[yellow]Ignoring raised exception when packaging {o.name} ({e})"
+                )
+                failed_outputs.append(o)
+                return
+            console.print_exception(show_locals=False)
+            exit(1)
+
+        if notest:
+            return
+        # all formats of an output contain the same files, test only one
+        if test_scheduler.jobs > 1:
+            test_scheduler.submit(o, final_outputs[0], o.config)
+        else:
+            packages_to_test[i] = final_outputs[0]
+
+    def test_output(i, o):
+        if i in packages_to_test:
+            test_scheduler.submit(o, packages_to_test.pop(i), o.config)
+
+    # the package tasks share the state of this process, a custom cpu_executor
+    # has to run them on threads
+    graph = TaskGraph(cpu_executor=cpu_executor)
+    # downloads only, building and solving use process global state
+    prefetch = {}
+    if not (skip_existing or full_render) and not rerun_build:
+        prefetch = prefetch_sources(graph, recipe_path, sorted_outputs)
+
+    # The packages are compressed on the CPU executor from the moved host
+    # prefix while the next output builds, unless it needs one of them (or
+    # the package is tested in this process). They are compressed and indexed
+    # one at a time, in order.
+    previous = []
+    packaged = []
+    for i, o in enumerate(sorted_outputs):
+        needs = {x.name for x in o.all_requirements()} | set(o.required_steps)
+        build_task = graph.add(
+            f"build {i} {o.name}",
+            build_output,
+            i,
+            o,
+            deps=previous
+            + prefetch.get(i, [])
+            + [
+                package_task
+                for other, package_task in zip(sorted_outputs, packaged)
+                if other.name in needs
+            ],
+            kind="serial",
+        )
+        packaged.append(
+            graph.add(
+                f"package {i} {o.name}",
+                package_output,
+                i,
+                o,
+                deps=[build_task] + packaged[-1:],
+                kind="cpu",
+            )
+        )
+        previous = [build_task]
+        if not notest and test_scheduler.jobs == 1:
+            previous = [
+                graph.add(
+                    f"test {i} {o.name}",
+                    test_output,
+                    i,
+                    o,
+                    deps=[build_task, packaged[-1]],
+                    kind="serial",
+                )
+            ]
+    try:
+        graph.run()
+
+        if stopped:
+            return
+
+        failed_tests = test_scheduler.wait()
+    finally:
+        test_envs.remove()
+    failed_outputs += failed_tests
+
     for o in sorted_outputs:
         if o in failed_outputs:
             console.print(f"[red]Failed output: {o.name}")
@@ -422,6 +591,9 @@ def build_recipe(
             print("\n\n")
             console.print(o)
 
+    if failed_tests and not continue_on_failure:
+        exit(1)
+
     return sorted_outputs
 
 
@@ -468,14 +640,21 @@ def run_build(args: argparse.Namespace) -> None:
 
     selected_features = extract_features(args.features)
 
+    profile = getattr(args, "profile", None)
+    if profile:
+        profiler.enable()
+
     folder = args.recipe_dir or os.path.dirname(args.target)
     variant = {"target_platform": args.target_platform or context.subdir}
 
     config = initialize_conda_build_config(args)
 
     if hasattr(args, "conda_pkg_format"):
-        config.conda_pkg_format = args.conda_pkg_format
+        config.pkg_formats = args.conda_pkg_format
+        config.conda_pkg_format = args.conda_pkg_format[0]
         config.zstd_compression_level = args.zstd_compression_level
+        config.compression_threads = args.compression_threads
+        config.use_step_cache = getattr(args, "step_cache", False)
 
     cbc, config = get_config(folder, variant, args.variant_config_files, config=config)
     if config.variant and "cdt_name" in cbc:
@@ -498,35 +677,44 @@ def run_build(args: argparse.Namespace) -> None:
         mkdir_p(config.output_folder)
 
     console.print(f"Updating build index: {(config.output_folder)}\n")
-    update_index(config.output_folder, verbose=config.debug, threads=1)
+    with profiler.phase("index"):
+        update_index(config.output_folder, verbose=config.debug, threads=1)
 
     is_pyproject_recipe = getattr(args, "pyproject_recipes", False)
     all_recipes = find_all_recipes(args.target, config, is_pyproject_recipe)  # [noqa]
 
     console.print("\n[yellow]Assembling all recipes and variants[/yellow]\n")
 
-    rerun_build = False
-    for recipe in all_recipes:
-        while True:
-            try:
-                build_recipe(
-                    args.command,
-                    recipe["recipe_file"],
-                    cbc,
-                    config,
-                    selected_features=selected_features,
-                    notest=getattr(args, "notest", False),
-                    skip_existing=getattr(args, "skip_existing", False) != "default",
-                    interactive=getattr(args, "interactive", False),
-                    skip_fast=getattr(args, "skip_existing", "default") == "fast",
-                    continue_on_failure=getattr(args, "continue_on_failure", False),
-                    rerun_build=rerun_build,
-                    pyproject_recipes=getattr(args, "pyproject_recipes", False),
-                )
-                rerun_build = False
-            except BoaRunBuildException:
-                rerun_build = True
-            except Exception as e:
-                raise e
-            else:
-                break
+    try:
+        rerun_build = False
+        for recipe in all_recipes:
+            while True:
+                try:
+                    build_recipe(
+                        args.command,
+                        recipe["recipe_file"],
+                        cbc,
+                        config,
+                        selected_features=selected_features,
+                        notest=getattr(args, "notest", False),
+                        skip_existing=getattr(args, "skip_existing", False)
+                        != "default",
+                        interactive=getattr(args, "interactive", False),
+                        skip_fast=getattr(args, "skip_existing", "default") == "fast",
+                        continue_on_failure=getattr(args, "continue_on_failure", False),
+                        rerun_build=rerun_build,
+                        pyproject_recipes=getattr(args, "pyproject_recipes", False),
+                        test_jobs=getattr(args, "test_jobs", 1),
+                        test_argv=forwarded_test_args(args, config.output_folder),
+                        extra_deps=getattr(args, "extra_deps", None),
+                    )
+                    rerun_build = False
+                except BoaRunBuildException:
+                    rerun_build = True
+                except Exception as e:
+                    raise e
+                else:
+                    break
+    finally:
+        if profile:
+            profiler.write(profile, getattr(args, "profile_format", "json"))
@@ -3,6 +3,8 @@
 
 import os
 import tempfile
+import time
+from contextlib import contextmanager
 
 from boltons.setutils import IndexedSet
 
@@ -21,8 +23,8 @@ import libmambapy
 
 from boa.core.utils import (
     get_index,
+    get_pkgs_dirs,
     load_channels,
-    pkgs_dirs,
     to_package_record_from_subjson,
 )
 from boa.core.config import boa_config
@@ -37,6 +39,15 @@ def refresh_solvers():
         v.replace_channels()
 
 
+def expire_solvers(max_age):
+    """Drop the solvers created more than ``max_age`` seconds ago (their
+    repodata may be outdated)"""
+    now = time.monotonic()
+    for key, solver in list(solver_cache.items()):
+        if now - solver.created > max_age:
+            del solver_cache[key]
+
+
 def get_solver(subdir, output_folder="local"):
     pkg_cache = PackageCacheData.first_writable().pkgs_dir
     if subdir == "noarch":
@@ -46,10 +57,12 @@ def get_solver(subdir, output_folder="local"):
         if not os.path.exists(pkg_cache):
             os.makedirs(pkg_cache, exist_ok=True)
 
-    if not solver_cache.get(subdir):
-        solver_cache[subdir] = MambaSolver([], subdir, output_folder)
+    # a long running process (boa serve) builds into different output folders
+    key = (subdir, output_folder)
+    if not solver_cache.get(key):
+        solver_cache[key] = MambaSolver([], subdir, output_folder)
 
-    return solver_cache[subdir], pkg_cache
+    return solver_cache[key], pkg_cache
 
 
 def get_url_from_channel(c):
@@ -122,6 +135,7 @@ class MambaSolver:
         self.channels = channels
         self.platform = platform
         self.output_folder = output_folder or "local"
+        self.created = time.monotonic()
         self.pool = libmambapy.Pool()
         self.repos = []
 
@@ -134,6 +148,7 @@ class MambaSolver:
         repo = libmambapy.Repo(self.pool, "installed", installed_json_f.name, "")
         repo.set_installed()
         self.repos.append(repo)
+        self.virtual_packages_repo = repo
 
         self.local_index = []
         self.local_repos = {}
@@ -147,6 +162,19 @@ class MambaSolver:
         prefix_data.load()
         repo = libmambapy.Repo(self.pool, prefix_data)
         repo.set_installed()
+        return repo
+
+    @contextmanager
+    def installed_prefix(self, prefix):
+        """Solve with the packages of ``prefix`` installed, transactions then
+        only contain the changes to ``prefix``. Transactions have to be executed
+        inside of the ``with`` block, they refer to the installed packages."""
+        repo = self.replace_installed(prefix)
+        try:
+            yield
+        finally:
+            repo.clear(True)
+            self.virtual_packages_repo.set_installed()
 
     def replace_channels(self):
         console.print(f"[blue]Reloading output folder: {self.output_folder}")
@@ -235,7 +263,7 @@ class MambaSolver:
 
         if pkg_cache_path is None:
             # use values from conda
-            pkg_cache_path = pkgs_dirs
+            pkg_cache_path = get_pkgs_dirs()
 
         package_cache = libmambapy.MultiPackageCache(pkg_cache_path)
         return libmambapy.Transaction(api_solver, package_cache)
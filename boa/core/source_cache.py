@@ -0,0 +1,225 @@
+# Copyright (C) 2021, QuantStack
+# SPDX-License-Identifier: BSD-3-Clause
+
+"""
+Content addressed store for downloaded sources, shared between croots.
+
+Archives are stored by their sha256 under ``$BOA_SOURCE_CACHE`` (default
+``~/.cache/boa/sources``). Before conda-build unpacks the sources, every
+``url`` source is put into the ``src_cache`` of the current croot, either
+from the store or by downloading it. Downloads of multiple sources run in
+parallel.
+
+The extracted and patched source trees are cached as well, so that the
+variants of a recipe do not unpack and patch the same sources again.
+"""
+
+import hashlib
+import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from conda_build import source, utils
+
+from boa.core.clone import TreeCloner, clone_tree
+from boa.core.step_cache import hash_json, is_pinned_source
+from boa.core.telemetry import metrics
+
+MAX_PARALLEL_DOWNLOADS = 8
+
+
+def source_cache_dir():
+    path = os.environ.get("BOA_SOURCE_CACHE")
+    if not path:
+        cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+            os.path.expanduser("~"), ".cache"
+        )
+        path = os.path.join(cache_home, "boa", "sources")
+    return path
+
+
+def _part_path(path):
+    return f"{path}.{uuid.uuid4().hex}.part"
+
+
+def _link_or_clone(src, dst):
+    # both sides are never modified in place, sharing the inode is fine
+    try:
+        os.link(src, dst)
+    except OSError:
+        TreeCloner().clone_file(src, dst)
+
+
+class SourceCache:
+    def __init__(self, root=None):
+        self.root = root or source_cache_dir()
+
+    def path(self, sha256):
+        return os.path.join(self.root, sha256[:2], sha256)
+
+    def get(self, sha256, dest):
+        """Put the archive with ``sha256`` at ``dest``, returns False if it is not
+        in the store."""
+        cached = self.path(sha256)
+        hit = os.path.isfile(cached)
+        metrics.cache_lookup("source", hit)
+        if not hit:
+            return False
+        tmp = _part_path(dest)
+        _link_or_clone(cached, tmp)
+        os.replace(tmp, dest)
+        return True
+
+    def put(self, sha256, path):
+        cached = self.path(sha256)
+        if os.path.isfile(cached):
+            return
+        os.makedirs(os.path.dirname(cached), exist_ok=True)
+        tmp = _part_path(cached)
+        try:
+            _link_or_clone(path, tmp)
+            os.replace(tmp, cached)
+        except OSError:
+            utils.rm_rf(tmp)
+
+
+def src_cache_fn(source_dict):
+    """File name conda-build uses for ``source_dict`` in its ``src_cache``, or
+    None if it can only be known after downloading (no checksum)."""
+    urls = utils.ensure_list(source_dict["url"])
+    fn = source_dict.get("fn") or os.path.basename(urls[0])
+    # same order as conda_build.source.download_to_cache
+    for hash_type in ("md5", "sha1", "sha256"):
+        if source_dict.get(hash_type):
+            return source.append_hash_to_fn(fn, source_dict[hash_type])
+    return None
+
+
+def fetch_source(m, source_dict, cache):
+    src_cache = m.config.src_cache
+    sha256 = source_dict.get("sha256")
+    fn = src_cache_fn(source_dict)
+    if sha256 and fn:
+        path = os.path.join(src_cache, fn)
+        if os.path.isfile(path) or cache.get(sha256, path):
+            return path
+
+    path, _ = source.download_to_cache(
+        src_cache, m.path, source_dict, verbose=m.config.verbose
+    )
+    if sha256:
+        # download_to_cache verified the checksum
+        cache.put(sha256, path)
+    return path
+
+
+def fetch_sources(m, cache=None):
+    """Make sure all ``url`` sources of ``m`` are in the ``src_cache``, so that
+    ``conda_build.source.provide`` only has to unpack them."""
+    sources = [s for s in m.get_section("source") if s.get("url")]
+    if not sources:
+        return []
+
+    cache = cache or SourceCache()
+    os.makedirs(m.config.src_cache, exist_ok=True)
+    workers = min(len(sources), MAX_PARALLEL_DOWNLOADS)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(lambda s: fetch_source(m, s, cache), sources))
+
+
+class SourceTreeCache:
+    """Extracted and patched source trees, shared by all variants and outputs of
+    a recipe with the same sources.
+
+    Trees are keyed by the source entries and the content of their patches and
+    cloned into the work dir (with reflinks where supported), so every build
+    starts from a pristine tree without unpacking and patching again.
+    """
+
+    def __init__(self, config):
+        self.root = os.path.join(config.croot, "boa_source_trees")
+
+    def key(self, m):
+        sources = [s for s in m.get_section("source") if "step" not in s]
+        if not sources or not all(is_pinned_source(s) for s in sources):
+            return None
+
+        patches = {}
+        for s in sources:
+            for patch in utils.ensure_list(s.get("patches", [])):
+                with open(os.path.join(m.path, patch), "rb") as fi:
+                    patches[patch] = hashlib.sha256(fi.read()).hexdigest()
+
+        return hash_json({"source": sources, "patches": patches})
+
+    def path(self, key):
+        return os.path.join(self.root, key)
+
+    def restore(self, key, work_dir):
+        cached = self.path(key)
+        hit = os.path.isdir(cached)
+        metrics.cache_lookup("source_tree", hit)
+        if not hit:
+            return False
+        utils.rm_rf(work_dir)
+        clone_tree(cached, work_dir)
+        return True
+
+    def store(self, key, work_dir):
+        cached = self.path(key)
+        if os.path.isdir(cached) or not os.path.isdir(work_dir):
+            return
+        tmp = _part_path(cached)
+        try:
+            clone_tree(work_dir, tmp)
+            os.rename(tmp, cached)
+        except OSError:
+            utils.rm_rf(tmp)
+
+
+class WorkDirSources:
+    """The sources in the work dir, which consecutive outputs share.
+
+    Outputs of a recipe build one after the other in the same work dir, and an
+    output can use what the previous outputs left there. The work dir is only
+    replaced when the sources or the variant change from one output to the
+    next, with a tree from ``source_trees`` if the sources are pinned and by
+    calling ``download(m)`` otherwise.
+    """
+
+    def __init__(self, source_trees, download):
+        self.source_trees = source_trees
+        self.download = download
+        self.source = None
+        self.variant = {}
+
+    def changed(self, m):
+        if m.output.sections["source"] != self.source:
+            return True
+        # outputs use different subsets of the variant keys
+        variant = m.output.variant or {}
+        return any(
+            self.variant[k] != v for k, v in variant.items() if k in self.variant
+        )
+
+    def provided(self, m):
+        """Record that the work dir holds the sources of ``m``"""
+        self.source = m.output.sections["source"]
+        self.variant = dict(m.output.variant or {})
+
+    def prepare(self, m):
+        """Provide the sources of ``m`` in its work dir, returns False if the
+        work dir is kept from the previous output."""
+        if not self.changed(m):
+            self.variant.update(m.output.variant or {})
+            return False
+
+        work_dir = m.config.work_dir
+        key = self.source_trees.key(m)
+        if key is None or not self.source_trees.restore(key, work_dir):
+            utils.rm_rf(work_dir)
+            self.download(m)
+            if key is not None:
+                self.source_trees.store(key, work_dir)
+        self.provided(m)
+        return True
@@ -0,0 +1,153 @@
+# Copyright (C) 2021, QuantStack
+# SPDX-License-Identifier: BSD-3-Clause
+
+"""
+Content addressed cache for the work directories of non-package steps.
+
+A step is identified by its sources, build script, variant and the solved
+build and host environments. On a cache hit the stored work directory is
+restored instead of building the step again.
+
+Work directories are not relocated: CMake caches, libtool files and scripts
+contain the absolute paths of the work directory and the prefixes. These
+paths are part of the key, so a step is only restored at the same location.
+The build folders of conda-build contain a timestamp, steps are therefore
+only shared between invocations that use the same build folder (e.g.
+``--build-id-pat ""``).
+"""
+
+import hashlib
+import json
+import os
+import pathlib
+import re
+import tempfile
+
+from conda_build import utils
+
+from boa.core.clone import clone_tree
+from boa.core.config import boa_config
+from boa.core.telemetry import metrics
+
+console = boa_config.console
+
+SCRIPT_FILES = ("build.sh", "bld.bat", "build.py")
+# a branch or tag name can point to another commit tomorrow
+GIT_SHA = re.compile(r"^[0-9a-fA-F]{40}$")
+
+
+def hash_json(data):
+    return hashlib.sha256(
+        json.dumps(data, sort_keys=True, default=str).encode("utf-8")
+    ).hexdigest()
+
+
+def step_work_dir(output):
+    """Location the work directory of a non-package step is moved to after the
+    build. Every variant of a step gets its own directory."""
+    variant_hash = hash_json(getattr(output, "variant", {}))[:10]
+    return (
+        pathlib.Path(output.config.work_dir).parent
+        / f"work_{output.name}_{variant_hash}"
+    )
+
+
+def is_pinned_source(src):
+    """Only sources that can not change without changing the recipe are
+    cacheable (urls with a sha256, git sources at a full commit sha, other
+    steps)."""
+    if "step" in src:
+        return True
+    if "url" in src:
+        return bool(src.get("sha256"))
+    if "git_url" in src:
+        return bool(GIT_SHA.match(str(src.get("git_rev", ""))))
+    return False
+
+
+def get_required_step(output, step, sorted_outputs):
+    """Find the built step ``step`` of the variant matching ``output``"""
+    for other in sorted_outputs:
+        if other.name != step or not getattr(other, "moved_work_dir", None):
+            continue
+        if all(
+            output.variant.get(k) == v
+            for k, v in other.variant.items()
+            if k in output.variant
+        ):
+            return other
+    raise RuntimeError(
+        f"No built variant of the step {step} matches the variant of {output.name}"
+    )
+
+
+class StepCache:
+    def __init__(self, config):
+        self.root = os.path.join(config.croot, "boa_step_cache")
+
+    def key(self, m):
+        """Cache key for the step of ``m`` or None if the step is not cacheable."""
+        output = m.output
+        sources = output.sections["source"]
+        if not all(is_pinned_source(s) for s in sources):
+            return None
+
+        scripts = {}
+        for fn in SCRIPT_FILES:
+            path = os.path.join(m.path, fn)
+            if os.path.isfile(path):
+                with open(path, "rb") as fi:
+                    scripts[fn] = hashlib.sha256(fi.read()).hexdigest()
+
+        environments = {}
+        for env in ("build", "host"):
+            environments[env] = sorted(
+                f"{s.final_name} {s.final_version[0]} {s.final_version[1]}"
+                for s in output.requirements.get(env, [])
+                if hasattr(s, "final_version")
+            )
+
+        return hash_json(
+            {
+                "name": output.name,
+                "source": sources,
+                "build": output.sections["build"],
+                "scripts": scripts,
+                "variant": output.variant,
+                "environments": environments,
+                # the restored tree contains absolute paths
+                "paths": [
+                    m.config.work_dir,
+                    m.config.build_prefix,
+                    m.config.host_prefix,
+                ],
+            }
+        )
+
+    def path(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    def restore(self, key, dest):
+        cached = self.path(key)
+        hit = os.path.isdir(cached)
+        metrics.cache_lookup("step", hit)
+        if not hit:
+            return False
+        utils.rm_rf(str(dest))
+        # a copy (or reflink), the build writes to the restored work dir
+        clone_tree(cached, dest)
+        return True
+
+    def store(self, key, src):
+        cached = self.path(key)
+        if os.path.isdir(cached):
+            return
+        os.makedirs(os.path.dirname(cached), exist_ok=True)
+        tmp = tempfile.mkdtemp(prefix=".tmp-", dir=os.path.dirname(cached))
+        try:
+            clone_tree(src, tmp)
+            os.rename(tmp, cached)
+        except OSError as e:
+            console.print(f"[yellow]Could not store step in cache ({e})")
+        finally:
+            utils.rm_rf(tmp)
@@ -0,0 +1,246 @@
+# Copyright (C) 2021, QuantStack
+# SPDX-License-Identifier: BSD-3-Clause
+
+"""
+Build telemetry in the Prometheus text exposition format (version 0.0.4).
+
+Metrics are collected in memory while boa runs and written to a file when the
+command ends, e.g. into the directory of the node_exporter textfile collector.
+Nothing is sent anywhere.
+"""
+
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from boa.core.profiling import peak_rss, profiler
+
+METRICS_FILE_ENV = "BOA_METRICS_FILE"
+
+SECONDS_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+BYTES_BUCKETS = (1e4, 1e5, 1e6, 1e7, 1e8, 1e9, 1e10)
+RATIO_BUCKETS = (0.25, 0.5, 0.75, 1, 1.5, 2, 3, 4, 6, 8, 12, 16)
+
+# name: (type, help, buckets), counters are exposed as <name>_total
+FAMILIES = {
+    "boa_phase_duration_seconds": (
+        "histogram",
+        "Wall time of the build phases",
+        SECONDS_BUCKETS,
+    ),
+    "boa_cache_requests": (
+        "counter",
+        "Lookups in the caches of boa by cache and result (hit or miss)",
+        None,
+    ),
+    "boa_packages": ("counter", "Packages written by format", None),
+    "boa_package_size_bytes": (
+        "histogram",
+        "Size of the written packages",
+        BYTES_BUCKETS,
+    ),
+    "boa_package_compression_ratio": (
+        "histogram",
+        "Size of the packaged files divided by the size of the package",
+        RATIO_BUCKETS,
+    ),
+    "boa_transmute_size_ratio": (
+        "histogram",
+        "Size of transmuted packages divided by the size of the original package",
+        RATIO_BUCKETS,
+    ),
+    "boa_run_duration_seconds": (
+        "gauge",
+        "Duration of the last run of a command",
+        None,
+    ),
+    "boa_run_timestamp_seconds": (
+        "gauge",
+        "Unix time at which the last run of a command ended",
+        None,
+    ),
+    "boa_run_success": (
+        "gauge",
+        "1 if the last run of a command succeeded, 0 if it failed",
+        None,
+    ),
+    "boa_process_max_rss_bytes": (
+        "gauge",
+        "Peak RSS of the boa process (or of its largest child process) since it "
+        "started, at the end of the last run of a command. Process-wide, not "
+        "per phase",
+        None,
+    ),
+}
+
+
+def _escape(value):
+    return str(value).replace("\\", r"\\").replace('"', r"\"").replace("\n", r"\n")
+
+
+def _escape_help(value):
+    return str(value).replace("\\", r"\\").replace("\n", r"\n")
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels) + "}"
+
+
+def _number(value):
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _package_format(path):
+    for ext in (".tar.bz2", ".conda"):
+        if path.endswith(ext):
+            return ext[1:]
+    return "unknown"
+
+
+class Metrics:
+    def __init__(self):
+        self.enabled = False
+        # name -> {sorted label items: value or histogram state}
+        self._samples = {name: {} for name in FAMILIES}
+        self._lock = threading.Lock()
+
+    def enable(self):
+        self.enabled = True
+
+    def reset(self):
+        """Disable the metrics and drop the collected samples"""
+        self.enabled = False
+        with self._lock:
+            self._samples = {name: {} for name in FAMILIES}
+
+    def inc(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            samples = self._samples[name]
+            samples[key] = samples.get(key, 0) + value
+
+    def set_gauge(self, name, value, **labels):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._samples[name][tuple(sorted(labels.items()))] = value
+
+    def observe(self, name, value, **labels):
+        if not self.enabled:
+            return
+        buckets = FAMILIES[name][2]
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            state = self._samples[name].get(key)
+            if state is None:
+                state = self._samples[name][key] = {
+                    "buckets": [0] * len(buckets),
+                    "count": 0,
+                    "sum": 0.0,
+                }
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    state["buckets"][i] += 1
+            state["count"] += 1
+            state["sum"] += value
+
+    def cache_lookup(self, cache, hit):
+        self.inc("boa_cache_requests", cache=cache, result="hit" if hit else "miss")
+
+    def record_package(self, path, files_size=None):
+        """Record the package at ``path``, ``files_size`` is the total size of
+        the files it contains (if known)."""
+        if not self.enabled:
+            return
+        fmt = _package_format(path)
+        size = os.path.getsize(path)
+        self.inc("boa_packages", format=fmt)
+        self.observe("boa_package_size_bytes", size, format=fmt)
+        if files_size is not None and size:
+            self.observe("boa_package_compression_ratio", files_size / size, format=fmt)
+
+    def record_phases(self, events):
+        """Add the phases recorded by the profiler to the phase histogram"""
+        for event in events:
+            labels = {"phase": event["name"]}
+            if event["labels"].get("env"):
+                labels["env"] = event["labels"]["env"]
+            self.observe("boa_phase_duration_seconds", event["wall_time"], **labels)
+
+    def to_prometheus_text(self):
+        lines = []
+        for name, (kind, help_text, buckets) in FAMILIES.items():
+            samples = self._samples[name]
+            if not samples:
+                continue
+            if kind == "counter":
+                name = f"{name}_total"
+            lines.append(f"# HELP {name} {_escape_help(help_text)}")
+            lines.append(f"# TYPE {name} {kind}")
+            for key, value in sorted(samples.items()):
+                if kind != "histogram":
+                    lines.append(f"{name}{_labels(key)} {_number(value)}")
+                    continue
+                bounds = list(buckets) + [math.inf]
+                counts = value["buckets"] + [value["count"]]
+                for bound, count in zip(bounds, counts):
+                    le = (("le", _number(bound)),)
+                    lines.append(f"{name}_bucket{_labels(key + le)} {count}")
+                lines.append(f"{name}_count{_labels(key)} {value['count']}")
+                lines.append(f"{name}_sum{_labels(key)} {_number(value['sum'])}")
+        return "".join(line + "\n" for line in lines)
+
+    def write(self, path):
+        """Write the metrics to ``path``. The file is replaced atomically, so
+        that collectors never read a partially written file."""
+        path = os.path.abspath(path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as fo:
+            fo.write(self.to_prometheus_text())
+        os.replace(tmp, path)
+
+
+metrics = Metrics()
+
+
+@contextmanager
+def telemetry(command, path=None):
+    """Collect metrics while ``command`` runs and write them to ``path`` (or to
+    ``$BOA_METRICS_FILE``) when it ends, also if it fails."""
+    path = path or os.environ.get(METRICS_FILE_ENV)
+    if not path:
+        yield
+        return
+
+    metrics.enable()
+    # the phase durations come from the profiler
+    profiler.enable()
+    start = time.time()
+    success = False
+    try:
+        yield
+        success = True
+    except SystemExit as e:
+        success = not e.code
+        raise
+    finally:
+        end = time.time()
+        metrics.record_phases(profiler.events)
+        metrics.set_gauge("boa_run_duration_seconds", end - start, command=command)
+        metrics.set_gauge("boa_run_timestamp_seconds", end, command=command)
+        metrics.set_gauge("boa_run_success", int(success), command=command)
+        max_rss = peak_rss()
+        if max_rss is not None:
+            metrics.set_gauge("boa_process_max_rss_bytes", max_rss, command=command)
+        metrics.write(path)
@@ -1,6 +1,7 @@
 # Copyright (C) 2021, QuantStack
 # SPDX-License-Identifier: BSD-3-Clause
 
+import atexit
 import json
 import logging
 import os
@@ -36,10 +37,13 @@ from conda_index.index import update_index
 from conda_build import utils
 from conda_build.environ import clean_pkg_cache
 
-from boa.core.utils import env_path_backup_var_exists, pkgs_dirs, shell_path
+from boa.core.utils import env_path_backup_var_exists, get_pkgs_dirs, get_shell_path
 from boa.core.recipe_output import Output
 from boa.core.metadata import MetaData
 from boa.core import environ
+from boa.core.prefix_index import PrefixIndex
+from boa.helpers.pkgconfig import AmbiguousPkgConfig, PkgConfigResolver
+from boa.core.env_cache import pinned_specs, split_tested_package
 
 from glob import glob
 from rich.console import Console
@@ -149,7 +153,9 @@ def _write_test_run_script(
                     # TODO: Run the test/commands here instead of in run_test.py
                     tf.write(
                         '"{shell_path}" {trace}-e "{test_file}"\n'.format(
-                            shell_path=shell_path, test_file=shell_file, trace=trace
+                            shell_path=get_shell_path(),
+                            test_file=shell_file,
+                            trace=trace,
                         )
                     )
 
@@ -304,8 +310,10 @@ def _construct_metadata_for_test_from_package(package, config):
 
     local_channel = os.path.dirname(local_pkg_location)
 
-    # update indices in the channel
-    update_index(local_channel, verbose=config.debug, threads=1)
+    # update indices in the channel, unless another process (the build that
+    # started this test) keeps it up to date
+    if not is_channel or getattr(config, "update_channel_index", True):
+        update_index(local_channel, verbose=config.debug, threads=1)
 
     recipe_path = os.path.join(info_dir, "recipe", "recipe.yaml")
     try:
@@ -352,6 +360,7 @@ def _construct_metadata_for_test_from_package(package, config):
 
     if metadata.noarch:
         metadata.config.variant["target_platform"] = "noarch"
+        metadata.invalidate()
 
     metadata.config.used_vars = list(hash_input.keys())
     urls = list(utils.ensure_list(metadata.config.channel_urls))
@@ -400,20 +409,22 @@ def determine_win_check():
         return False
 
 
-def check_file_existence(f_paths, check_parent_dir=False):
+def check_file_existence(f_paths, check_parent_dir=False, index=None):
+    isdir = index.isdir if index else os.path.isdir
+    isfile = index.isfile if index else os.path.isfile
     all_exist = True
     for each_f in f_paths:
-        if check_parent_dir and os.path.isdir(Path(each_f).parent):
+        if check_parent_dir and isdir(Path(each_f).parent):
             console.print(
                 f"[green]\N{check mark} {Path(each_f).parent} (directory)[/green]".encode(
                     "utf-8"
                 )
             )
-        if os.path.isdir(each_f):
+        if isdir(each_f):
             console.print(
                 f"[green]\N{check mark} {each_f} (directory)[/green]".encode("utf-8")
             )
-        elif os.path.isfile(each_f):
+        elif isfile(each_f):
             console.print(f"[green]\N{check mark} {each_f}[/green]".encode("utf-8"))
         else:
             console.print(f"[red]\N{multiplication x} {each_f}[/red]".encode("utf-8"))
@@ -421,7 +432,7 @@ def check_file_existence(f_paths, check_parent_dir=False):
     return all_exist
 
 
-def check_site_packages(site_packages_dir, site_packages):
+def check_site_packages(site_packages_dir, site_packages, index=None):
     test_site_packages = True
     if site_packages:
         console.print("[blue]- Checking for site-packages[/blue]")
@@ -429,11 +440,13 @@ def check_site_packages(site_packages_dir, site_packages):
             os.path.join(site_packages_dir, each_pkg, "__init__.py")
             for each_pkg in site_packages
         ]
-        test_site_packages = check_file_existence(sp_files, check_parent_dir=True)
+        test_site_packages = check_file_existence(
+            sp_files, check_parent_dir=True, index=index
+        )
     return test_site_packages
 
 
-def check_lib(lib_dir, bin_dir, lib, target_platform):
+def check_lib(lib_dir, bin_dir, lib, target_platform, index=None):
     ext, win_check = determine_ext_and_win_check(target_platform)
     test_lib = True
     if lib:
@@ -447,27 +460,27 @@ def check_lib(lib_dir, bin_dir, lib, target_platform):
                 os.path.join(lib_dir, each_lib + ".lib") for each_lib in lib
             ]
 
-            test_bin_files = check_file_existence(bin_files)
-            test_lib_win_files = check_file_existence(lib_win_files)
+            test_bin_files = check_file_existence(bin_files, index=index)
+            test_lib_win_files = check_file_existence(lib_win_files, index=index)
 
             test_lib = test_lib and test_bin_files and test_lib_win_files
 
-        test_lib_files = check_file_existence(lib_files)
+        test_lib_files = check_file_existence(lib_files, index=index)
 
         test_lib = test_lib and test_lib_files
     return test_lib
 
 
-def check_include(include_dir, include):
+def check_include(include_dir, include, index=None):
     test_include = True
     if include:
         console.print("[blue]- Checking for include[/blue]")
         include_files = [os.path.join(include_dir, fname) for fname in include]
-        test_include = check_file_existence(include_files)
+        test_include = check_file_existence(include_files, index=index)
     return test_include
 
 
-def check_bin(bin_dir, bin_paths, target_platform):
+def check_bin(bin_dir, bin_paths, target_platform, index=None):
     test_bin = True
     if bin_paths:
         console.print("[blue]- Checking for bin[/blue]")
@@ -477,10 +490,82 @@ def check_bin(bin_dir, bin_paths, target_platform):
             bin_files = [os.path.join(bin_dir, f"{fname}.exe") for fname in bin_paths]
         else:
             bin_files = [os.path.join(bin_dir, fname) for fname in bin_paths]
-        test_bin = check_file_existence(bin_files)
+        test_bin = check_file_existence(bin_files, index=index)
     return test_bin
 
 
+# build dirs of the cmake probe projects by cmake executable, reused so that
+# the compilers are only detected once per test environment
+_cmake_probe_dirs = {}
+
+
+def _prefix_state(prefix):
+    # test prefixes are recreated at the same path for every package
+    try:
+        st = os.stat(os.path.join(prefix, "conda-meta"))
+    except OSError:
+        return None
+    return st.st_ino, st.st_mtime_ns
+
+
+def _cmake_probe_dir(cmake_cmd, prefix):
+    state = _prefix_state(prefix)
+    probe_dir = None
+    if cmake_cmd in _cmake_probe_dirs:
+        cached_state, probe_dir = _cmake_probe_dirs[cmake_cmd]
+        if state is None or cached_state != state:
+            # another environment at the same path, detect everything again
+            shutil.rmtree(probe_dir, True)
+            probe_dir = None
+
+    if probe_dir is None:
+        probe_dir = tempfile.mkdtemp(prefix="boa-cmake-")
+        os.makedirs(os.path.join(probe_dir, "src"))
+        os.makedirs(os.path.join(probe_dir, "build"))
+        atexit.register(shutil.rmtree, probe_dir, True)
+        _cmake_probe_dirs[cmake_cmd] = (state, probe_dir)
+    else:
+        # forget the results of find_package, keep the toolchain detection
+        cache = os.path.join(probe_dir, "build", "CMakeCache.txt")
+        if os.path.isfile(cache):
+            with open(cache) as fi:
+                lines = [x for x in fi if x.startswith("CMAKE_")]
+            with open(cache, "w") as fo:
+                fo.writelines(lines)
+    return probe_dir
+
+
+def _cmake_find_packages(cmake_cmd, prefix, packages):
+    """Configure one project calling find_package for all ``packages``.
+    Returns whether the configure succeeded and the set of packages that were
+    found."""
+    probe_dir = _cmake_probe_dir(cmake_cmd, prefix)
+    result_file = os.path.join(probe_dir, "build", "boa_found.txt")
+    cmake_content = ["project(boatest)\n", "\n", f'file(WRITE "{result_file}" "")\n']
+    for each_f in packages:
+        cmake_content += [
+            f"find_package({each_f} QUIET)\n",
+            f"if({each_f}_FOUND OR {each_f.upper()}_FOUND)\n",
+            f'  file(APPEND "{result_file}" "{each_f}\\n")\n',
+            "endif()\n",
+        ]
+    with open(os.path.join(probe_dir, "src", "CMakeLists.txt"), "w") as ftemp:
+        ftemp.writelines(cmake_content)
+    utils.rm_rf(result_file)
+
+    cmake_check = subprocess.run(
+        [cmake_cmd, os.path.join(probe_dir, "src")],
+        cwd=os.path.join(probe_dir, "build"),
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    found = set()
+    if os.path.isfile(result_file):
+        with open(result_file) as fi:
+            found = {x.strip() for x in fi if x.strip()}
+    return cmake_check.returncode == 0, found
+
+
 def check_cmake(prefix, cmake_find):
     win_check = determine_win_check()
     test_cmake = True
@@ -490,65 +575,83 @@ def check_cmake(prefix, cmake_find):
             cmake_cmd = os.path.join(prefix, "Library", "bin", "cmake.exe")
         else:
             cmake_cmd = os.path.join(prefix, "bin", "cmake")
+
+        # Probe all packages with a single configure. find_package is QUIET,
+        # so that one missing package does not hide the others, and the
+        # <name>_FOUND variables say what was found (the same condition
+        # REQUIRED checks). If the configure fails, e.g. because a package
+        # config raised an error, every package is probed on its own and
+        # only counts as found if its configure succeeds, like a
+        # find_package(... REQUIRED) project did before.
+        success, found = _cmake_find_packages(cmake_cmd, prefix, cmake_find)
+        if not success:
+            found = set()
+            for each_f in cmake_find:
+                ok, found_one = _cmake_find_packages(cmake_cmd, prefix, [each_f])
+                if ok:
+                    found |= found_one
+
         for each_f in cmake_find:
-            cmake_content = [
-                "project(boatest)\n",
-                "\n",
-                f"find_package({each_f} REQUIRED)\n",
-            ]
-            with tempfile.TemporaryDirectory() as tempdir:
-                tempdir_path = str(Path(tempdir))
-                with open(os.path.join(tempdir_path, "CMakeLists.txt"), "w") as ftemp:
-                    ftemp.writelines(cmake_content)
-                if win_check:
-                    with open(os.devnull, "w") as tempnull:
-                        cmake_check = subprocess.run(
-                            [cmake_cmd, "."],
-                            cwd=tempdir_path,
-                            stdout=tempnull,
-                            stderr=tempnull,
-                        )
-                else:
-                    cmake_check = subprocess.run(
-                        [cmake_cmd, "."],
-                        cwd=tempdir_path,
-                        stdout=subprocess.DEVNULL,
-                        stderr=subprocess.DEVNULL,
-                    )
-                if cmake_check.returncode == 0:
-                    console.print(
-                        f"[green]\N{check mark} {each_f}[/green]".encode("utf-8")
-                    )
-                else:
-                    console.print(
-                        f"[red]\N{multiplication x} {each_f}[/red]".encode("utf-8")
-                    )
-                    test_cmake = False
+            if each_f in found:
+                console.print(f"[green]\N{check mark} {each_f}[/green]".encode("utf-8"))
+            else:
+                console.print(
+                    f"[red]\N{multiplication x} {each_f}[/red]".encode("utf-8")
+                )
+                test_cmake = False
     return test_cmake
 
 
-def check_pkg_config(prefix, pkg_config):
+def _check_pkg_config_binary(pkg_config_cmd, prefix, each_f):
+    p_env = os.environ.copy()
+    p_env["CONDA_PREFIX"] = prefix
+    pkg_config_exists = subprocess.run([pkg_config_cmd, each_f, "--exists"], env=p_env)
+    pkg_config_validate = subprocess.run(
+        [pkg_config_cmd, each_f, "--validate"], env=p_env
+    )
+    return pkg_config_exists.returncode == 0 and pkg_config_validate.returncode == 0
+
+
+def check_pkg_config(prefix, pkg_config, install_pkg_config=None):
+    """Check the pkg-config modules ``pkg_config`` in ``prefix``. The modules
+    the resolver can not decide on its own are checked with the pkg-config
+    binary of the prefix, ``install_pkg_config`` is called to add it first
+    where it is missing."""
     win_check = determine_win_check()
     test_pkg_config = True
     if pkg_config:
-        p_env = os.environ.copy()
-        p_env["CONDA_PREFIX"] = prefix
         if win_check:
-            pkg_config_cmd = os.path.join(prefix, "Library", "bin", "pkg-config.exe")
+            library_dir = os.path.join(prefix, "Library")
+            pkg_config_cmd = os.path.join(library_dir, "bin", "pkg-config.exe")
         else:
+            library_dir = prefix
             pkg_config_cmd = os.path.join(prefix, "bin", "pkg-config")
+        search_dirs = [
+            x for x in os.environ.get("PKG_CONFIG_PATH", "").split(os.pathsep) if x
+        ]
+        search_dirs += [
+            os.path.join(library_dir, "lib", "pkgconfig"),
+            os.path.join(library_dir, "share", "pkgconfig"),
+        ]
+        resolver = PkgConfigResolver(search_dirs)
+
         console.print("[blue]- Checking for pkgconfig[/blue]")
         for each_f in pkg_config:
-            pkg_config_exists = subprocess.run(
-                [pkg_config_cmd, each_f, "--exists"], env=p_env
-            )
-            pkg_config_validate = subprocess.run(
-                [pkg_config_cmd, each_f, "--validate"], env=p_env
-            )
-            if (
-                pkg_config_exists.returncode == 0
-                and pkg_config_validate.returncode == 0
-            ):
+            try:
+                valid = resolver.validate(each_f)
+            except AmbiguousPkgConfig as e:
+                # only spawn pkg-config for what the resolver can not decide
+                if not os.path.isfile(pkg_config_cmd) and install_pkg_config:
+                    console.print(
+                        f"[yellow]{e}, adding pkg-config to the test environment"
+                    )
+                    install_pkg_config()
+                if os.path.isfile(pkg_config_cmd):
+                    valid = _check_pkg_config_binary(pkg_config_cmd, prefix, each_f)
+                else:
+                    console.print(f"[red]{e}, pkg-config is needed to check it")
+                    valid = False
+            if valid:
                 console.print(f"[green]\N{check mark} {each_f}[/green]".encode("utf-8"))
             else:
                 console.print(
@@ -558,23 +661,24 @@ def check_pkg_config(prefix, pkg_config):
     return test_pkg_config
 
 
-def check_files(prefix, files):
+def check_files(prefix, files, index=None):
     test_files = True
     if files:
         console.print("[blue]- Checking for files[/blue]")
         files_list = [os.path.join(prefix, each_f) for each_f in files]
-        test_files = check_file_existence(files_list)
+        test_files = check_file_existence(files_list, index=index)
     return test_files
 
 
-def check_glob(prefix, glob_paths):
+def check_glob(prefix, glob_paths, index=None):
     test_glob = True
     if glob_paths:
         console.print("[blue]- Checking for glob[/blue]")
         for each_f in glob_paths:
             each_glob_path = os.path.join(prefix, each_f)
-            if glob(each_glob_path):
-                for each_gp in glob(each_glob_path):
+            matches = index.glob(each_glob_path) if index else glob(each_glob_path)
+            if matches:
+                for each_gp in matches:
                     console.print(
                         f"[green]\N{check mark} {each_gp}[/green]".encode("utf-8")
                     )
@@ -586,16 +690,19 @@ def check_glob(prefix, glob_paths):
     return test_glob
 
 
-def test_exists(prefix, exists, py_ver, target_platform):
+def test_exists(prefix, exists, py_ver, target_platform, install_pkg_config=None):
     if not exists:
         return True
 
+    # all checks share the directory listings of the prefix
+    index = PrefixIndex(prefix)
+
     # site-packages
     sp_check = True
     if py_ver:
         site_packages_dir = get_site_packages(prefix, py_ver)
         site_packages = exists.get("site_packages")
-        sp_check = check_site_packages(site_packages_dir, site_packages)
+        sp_check = check_site_packages(site_packages_dir, site_packages, index)
 
     # lib
     if target_platform.startswith("win"):
@@ -612,7 +719,7 @@ def test_exists(prefix, exists, py_ver, target_platform):
     if target_platform == "noarch" and lib:
         raise Exception("lib checks cannot be used with a noarch package")
     else:
-        lib_check = check_lib(lib_dir, bin_dir, lib, target_platform)
+        lib_check = check_lib(lib_dir, bin_dir, lib, target_platform, index)
 
     # include
     if target_platform.startswith("win") or (
@@ -622,11 +729,11 @@ def test_exists(prefix, exists, py_ver, target_platform):
     else:
         include_dir = os.path.join(prefix, "include")
     include = exists.get("include")
-    include_check = check_include(include_dir, include)
+    include_check = check_include(include_dir, include, index)
 
     # bin
     bin_paths = exists.get("bin")
-    bin_check = check_bin(bin_dir, bin_paths, target_platform)
+    bin_check = check_bin(bin_dir, bin_paths, target_platform, index)
 
     # cmake_find
     cmake_find = exists.get("cmake_find")
@@ -634,15 +741,15 @@ def test_exists(prefix, exists, py_ver, target_platform):
 
     # pkg_config
     pkg_config = exists.get("pkg_config")
-    pkg_config_check = check_pkg_config(prefix, pkg_config)
+    pkg_config_check = check_pkg_config(prefix, pkg_config, install_pkg_config)
 
     # file
     files = exists.get("file")
-    files_check = check_files(prefix, files)
+    files_check = check_files(prefix, files, index)
 
     # glob
     glob_paths = exists.get("glob")
-    glob_check = check_glob(prefix, glob_paths)
+    glob_check = check_glob(prefix, glob_paths, index)
 
     if (
         sp_check
@@ -659,6 +766,53 @@ def test_exists(prefix, exists, py_ver, target_platform):
         return False
 
 
+def _link(transaction, prefix):
+    if not transaction.fetch_extract_packages():
+        raise RuntimeError("Did not succeed in downloading packages.")
+    mkdir_p(os.path.join(prefix, "conda-meta"))
+    transaction.execute(PrefixData(prefix))
+
+
+def create_test_env(metadata, solver, specs, pkg_cache_path, test_envs=None):
+    """Create the test environment of ``metadata`` from ``specs``.
+
+    Where the test environment cache ``test_envs`` is available, the
+    environment without the tested package comes from the cache (or is linked
+    and stored first) and only the tested package is fetched and linked on
+    top. Returns the transaction of the whole environment.
+    """
+    prefix = metadata.config.test_prefix
+    transaction = solver.solve(specs, [pkg_cache_path])
+
+    env_key = None
+    if test_envs is not None and test_envs.enabled:
+        _, to_link, _ = transaction.to_conda()
+        tested, env_to_link = split_tested_package(to_link, metadata.name())
+        if tested:
+            env_key = test_envs.key(prefix, env_to_link)
+
+    if env_key is None:
+        _link(transaction, prefix)
+        return transaction
+
+    try:
+        if not test_envs.restore(env_key, prefix):
+            env_transaction = solver.solve(pinned_specs(env_to_link), [pkg_cache_path])
+            _, env_link, _ = env_transaction.to_conda()
+            if test_envs.key(prefix, env_link) != env_key:
+                raise RuntimeError("the pinned packages resolve differently")
+            _link(env_transaction, prefix)
+            test_envs.store(env_key, prefix)
+
+        with solver.installed_prefix(prefix):
+            _link(solver.solve(specs, [pkg_cache_path]), prefix)
+    except Exception as e:
+        console.print(f"[yellow]Could not use the test environment cache ({e})")
+        utils.rm_rf(prefix)
+        _link(transaction, prefix)
+    return transaction
+
+
 def run_test(
     recipedir_or_package_or_metadata,
     config,
@@ -667,6 +821,7 @@ def run_test(
     provision_only=False,
     solver=None,
     extra_deps=None,
+    test_envs=None,
 ):
     """
     Execute any test scripts for the given package.
@@ -712,7 +867,7 @@ def run_test(
         and recipedir_or_package_or_metadata.endswith(CONDA_PACKAGE_EXTENSIONS)
         and any(
             os.path.dirname(recipedir_or_package_or_metadata) in pkgs_dir
-            for pkgs_dir in pkgs_dirs
+            for pkgs_dir in get_pkgs_dirs()
         )
     )
     if not in_pkg_cache:
@@ -777,11 +932,8 @@ def run_test(
     tests_metadata = metadata.output.data.get("test")
     exists_metadata = tests_metadata.get("exists", {})
     cmake_find = exists_metadata.get("cmake_find", [])
-    pkg_config = exists_metadata.get("pkg_config", [])
     if cmake_find:
         specs.append("cmake")
-    if pkg_config:
-        specs.append("pkg-config")
 
     with utils.path_prepended(metadata.config.test_prefix):
         env = dict(os.environ.copy())
@@ -813,23 +965,27 @@ def run_test(
     utils.rm_rf(metadata.config.test_prefix)
 
     if solver is None:
-        solver, pkg_cache_path = get_solver(metadata.config.host_subdir)
+        # the solver of the build, its local channel is the output folder
+        solver, pkg_cache_path = get_solver(
+            metadata.config.host_subdir, output_folder=metadata.config.output_folder
+        )
     else:
         pkg_cache_path = PackageCacheData.first_writable().pkgs_dir
 
     solver.replace_channels()
     MambaContext().target_prefix = metadata.config.test_prefix
-    transaction = solver.solve(specs, [pkg_cache_path])
-
-    downloaded = transaction.fetch_extract_packages()
-    if not downloaded:
-        raise RuntimeError("Did not succeed in downloading packages.")
-
-    mkdir_p(os.path.join(metadata.config.test_prefix, "conda-meta"))
-    transaction.execute(
-        PrefixData(metadata.config.test_prefix),
+    transaction = create_test_env(
+        metadata, solver, specs, pkg_cache_path, test_envs=test_envs
     )
 
+    def install_pkg_config():
+        # pkg-config is only linked when an exists/pkg_config check needs it
+        with solver.installed_prefix(metadata.config.test_prefix):
+            _link(
+                solver.solve(specs + ["pkg-config"], [pkg_cache_path]),
+                metadata.config.test_prefix,
+            )
+
     with utils.path_prepended(metadata.config.test_prefix):
         env = dict(os.environ.copy())
         env.update(environ.get_dict(m=metadata, prefix=metadata.config.test_prefix))
@@ -862,7 +1018,7 @@ def run_test(
         cmd = [os.environ.get("COMSPEC", "cmd.exe"), "/d", "/c", test_script]
     else:
         cmd = (
-            [shell_path]
+            [get_shell_path()]
             + (["-x"] if metadata.config.debug else [])
             + ["-o", "errexit", test_script]
         )
@@ -902,6 +1058,7 @@ def run_test(
                 exists_metadata,
                 py_ver,
                 metadata.config.variant["target_platform"],
+                install_pkg_config,
             )
             if not check_exists_section:
                 raise Exception("existence tests fail")
@@ -4,6 +4,7 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
 import collections
+import functools
 import sys
 import os
 import typing
@@ -33,14 +34,30 @@ if typing.TYPE_CHECKING:
 console = boa_config.console
 
 env_path_backup_var_exists = os.environ.get("CONDA_PATH_BACKUP", None)
-pkgs_dirs = list(context.pkgs_dirs)
-
-if "bsd" in sys.platform:
-    shell_path = "/bin/sh"
-elif utils.on_win:
-    shell_path = "bash"
-else:
-    shell_path = "/bin/bash"
+
+
+@functools.lru_cache(maxsize=None)
+def get_pkgs_dirs():
+    """Package cache directories of conda, read from the context on first use"""
+    return list(context.pkgs_dirs)
+
+
+@functools.lru_cache(maxsize=None)
+def get_shell_path():
+    if "bsd" in sys.platform:
+        return "/bin/sh"
+    elif utils.on_win:
+        return "bash"
+    return "/bin/bash"
+
+
+def __getattr__(name):
+    # the module level values these accessors replace
+    if name == "pkgs_dirs":
+        return get_pkgs_dirs()
+    if name == "shell_path":
+        return get_shell_path()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 def get_config(
@@ -0,0 +1,79 @@
+import fnmatch
+import os
+import posixpath
+import re
+
+_normcase = None if os.path is posixpath else os.path.normcase
+
+
+def _literal_prefix(pattern):
+    m = re.search(r"[*?\[]", pattern)
+    return pattern[: m.start()] if m else pattern
+
+
+class GlobMatcher:
+    """Match paths against many ``fnmatch`` patterns at once.
+
+    All patterns are compiled into one regular expression. The literal part of
+    every pattern before its first wildcard is checked with a single
+    ``str.startswith`` first, so paths outside of all pattern directories are
+    rejected without running the regex.
+    """
+
+    def __init__(self, patterns):
+        patterns = list(patterns)
+        if _normcase:
+            patterns = [_normcase(p) for p in patterns]
+        self.patterns = patterns
+
+        prefixes = tuple(_literal_prefix(p) for p in patterns)
+        # an empty literal prefix (e.g. "*.h") can match anything
+        self._prefixes = prefixes if all(prefixes) else None
+        self._match = re.compile(
+            "|".join(f"(?:{fnmatch.translate(p)})" for p in patterns) or "(?!)"
+        ).match
+
+    def __call__(self, path):
+        if _normcase:
+            path = _normcase(path)
+        if self._prefixes is not None and not path.startswith(self._prefixes):
+            return False
+        return self._match(path) is not None
+
+
+class FileSelector:
+    """Include/exclude selection of files, equivalent to filtering with
+    ``fnmatch.filter`` for every include and exclude pattern."""
+
+    def __init__(self, include=None, exclude=None):
+        self.include = GlobMatcher(include) if include else None
+        self.exclude = GlobMatcher(exclude) if exclude else None
+
+    def __call__(self, path):
+        if self.include is not None and not self.include(path):
+            return False
+        return self.exclude is None or not self.exclude(path)
+
+    def select(self, files):
+        return {f for f in files if self(f)}
+
+
+def classify_files(files, selectors):
+    """Assign files to several outputs in a single pass.
+
+    ``selectors`` maps output names to ``FileSelector`` objects, the result maps
+    the same names to the set of selected files. A file can be selected by any
+    number of outputs.
+
+    ``bundle_conda`` does not use this: boa packages every output from its own
+    host prefix, after its own build script, so it selects the files of one
+    output at a time with a ``FileSelector``. This is for splitting the files
+    of a single prefix between outputs.
+    """
+    result = {name: set() for name in selectors}
+    selectors = list(selectors.items())
+    for f in files:
+        for name, selector in selectors:
+            if selector(f):
+                result[name].add(f)
+    return result
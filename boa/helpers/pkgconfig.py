@@ -0,0 +1,163 @@
+import os
+import re
+
+_VARIABLE = re.compile(r"\$\{([^}]*)\}")
+_OPERATORS = {
+    "=": lambda c: c == 0,
+    "!=": lambda c: c != 0,
+    "<": lambda c: c < 0,
+    "<=": lambda c: c <= 0,
+    ">": lambda c: c > 0,
+    ">=": lambda c: c >= 0,
+}
+_SEGMENT = re.compile(r"[0-9]+|[a-zA-Z]+")
+_REQUIRES_TOKEN = re.compile(r"[<>!]=?|=|[^\s,<>!=]+")
+
+
+class PkgConfigError(Exception):
+    pass
+
+
+class AmbiguousPkgConfig(Exception):
+    """The result depends on features of pkg-config that are not implemented
+    here, the pkg-config binary has to decide."""
+
+
+def rpmvercmp(a, b):
+    """Version comparison of pkg-config (a port of ``rpmvercmp``)"""
+    if a == b:
+        return 0
+    segments_a = _SEGMENT.findall(a)
+    segments_b = _SEGMENT.findall(b)
+    for seg_a, seg_b in zip(segments_a, segments_b):
+        a_num, b_num = seg_a.isdigit(), seg_b.isdigit()
+        if a_num != b_num:
+            # numeric segments are newer than alpha segments
+            return 1 if a_num else -1
+        if a_num:
+            seg_a, seg_b = seg_a.lstrip("0"), seg_b.lstrip("0")
+            if len(seg_a) != len(seg_b):
+                return 1 if len(seg_a) > len(seg_b) else -1
+        if seg_a != seg_b:
+            return 1 if seg_a > seg_b else -1
+    if len(segments_a) == len(segments_b):
+        return 0
+    return 1 if len(segments_a) > len(segments_b) else -1
+
+
+def parse_requires(value):
+    """Parse a ``Requires`` field into a list of (name, operator, version)"""
+    tokens = _REQUIRES_TOKEN.findall(value)
+    result = []
+    i = 0
+    while i < len(tokens):
+        name, op, version = tokens[i], None, None
+        if name in _OPERATORS:
+            raise PkgConfigError(f"missing package name before {name}")
+        if i + 1 < len(tokens) and tokens[i + 1] in _OPERATORS:
+            if i + 2 >= len(tokens) or tokens[i + 2] in _OPERATORS:
+                raise PkgConfigError(f"missing version after {name} {tokens[i + 1]}")
+            op, version = tokens[i + 1], tokens[i + 2]
+            i += 3
+        else:
+            i += 1
+        result.append((name, op, version))
+    return result
+
+
+def parse_pc(path, sysroot="/"):
+    """Parse a ``.pc`` file into (variables, fields), expanding variables"""
+    variables = {
+        "pcfiledir": os.path.dirname(os.path.abspath(path)),
+        "pc_sysrootdir": sysroot,
+    }
+    fields = {}
+
+    def expand(value):
+        def replace(match):
+            name = match.group(1)
+            if name not in variables:
+                raise PkgConfigError(f"Variable '{name}' not defined in '{path}'")
+            return variables[name]
+
+        return _VARIABLE.sub(replace, value)
+
+    with open(path, encoding="utf-8", errors="replace") as fi:
+        content = fi.read().replace("\\\n", "")
+
+    for line in content.splitlines():
+        line = line.split("#", 1)[0].strip()
+        if not line:
+            continue
+        m = re.match(r"^([A-Za-z0-9_.]+)\s*([:=])\s*(.*)$", line)
+        if not m:
+            # pkg-config ignores lines it does not understand
+            continue
+        key, sep, value = m.groups()
+        if sep == "=":
+            variables[key] = expand(value.strip())
+        else:
+            fields[key] = expand(value.strip())
+    return variables, fields
+
+
+class PkgConfigResolver:
+    """Small in-process replacement of ``pkg-config --exists`` and
+    ``pkg-config --validate``, working on the ``.pc`` files of ``search_dirs``.
+
+    Only one directory listing per search directory is done; the ``.pc`` files
+    are parsed at most once.
+    """
+
+    def __init__(self, search_dirs):
+        self.pc_files = {}
+        for d in search_dirs:
+            try:
+                names = sorted(os.listdir(d))
+            except OSError:
+                continue
+            for fn in names:
+                if fn.endswith(".pc"):
+                    # the first directory in the search path wins
+                    self.pc_files.setdefault(fn[: -len(".pc")], os.path.join(d, fn))
+        self._parsed = {}
+
+    def _load(self, name):
+        if name not in self._parsed:
+            path = self.pc_files.get(name)
+            if path is None:
+                raise PkgConfigError(f"Package {name} was not found")
+            variables, fields = parse_pc(path)
+            for required in ("Name", "Description", "Version"):
+                if required not in fields:
+                    raise PkgConfigError(f"Package '{name}' has no {required}: field")
+            if fields.get("Conflicts"):
+                raise AmbiguousPkgConfig(f"Package '{name}' has conflicts")
+            self._parsed[name] = fields
+        return self._parsed[name]
+
+    def validate(self, spec):
+        """Returns True if the modules of ``spec`` (e.g. ``zlib >= 1.2``) and their
+        dependencies exist and are valid, False if not. Raises
+        ``AmbiguousPkgConfig`` if it can not be decided here."""
+        try:
+            seen = set()
+            for name, op, version in parse_requires(spec):
+                self._resolve(name, op, version, seen)
+        except PkgConfigError:
+            return False
+        return True
+
+    def _resolve(self, name, op, version, seen):
+        fields = self._load(name)
+        if op is not None and not _OPERATORS[op](rpmvercmp(fields["Version"], version)):
+            raise PkgConfigError(
+                f"Requested '{name} {op} {version}' "
+                f"but version of {name} is {fields['Version']}"
+            )
+        if name in seen:
+            return
+        seen.add(name)
+        for key in ("Requires", "Requires.private"):
+            for dep in parse_requires(fields.get(key, "")):
+                self._resolve(*dep, seen)
@@ -18,7 +18,6 @@ deps = [
     "json5",
     "watchgod",
     "prompt-toolkit",
-    "joblib",
     "beautifulsoup4",
     "boltons",
 ]
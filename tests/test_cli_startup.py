@@ -0,0 +1,56 @@
+import os
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import pytest
+
+# seconds `boa --help` may take, can be raised for slow machines
+STARTUP_BUDGET = float(os.environ.get("BOA_STARTUP_BUDGET", "1.0"))
+
+HEAVY_MODULES = ("conda", "conda_build", "libmambapy", "rich", "boa.core.utils")
+
+recipes_dir = Path(__file__).parent / "recipes"
+
+LOADED_MODULES = """
+import runpy, sys
+sys.argv = ["boa"] + sys.argv[1:]
+try:
+    runpy.run_module("boa.cli.boa", run_name="__main__")
+except SystemExit:
+    pass
+print("loaded:" + ",".join(m for m in {modules!r} if m in sys.modules))
+"""
+
+
+def loaded_heavy_modules(*args):
+    code = LOADED_MODULES.format(modules=HEAVY_MODULES)
+    out = subprocess.check_output([sys.executable, "-c", code, *args], text=True)
+    loaded = out.strip().splitlines()[-1][len("loaded:") :]
+    return [m for m in loaded.split(",") if m]
+
+
+def test_help_startup_time():
+    timings = []
+    # best of three, a single slow start should not fail the test
+    for _ in range(3):
+        start = time.perf_counter()
+        subprocess.run(
+            [sys.executable, "-m", "boa.cli.boa", "--help"],
+            check=True,
+            stdout=subprocess.DEVNULL,
+        )
+        timings.append(time.perf_counter() - start)
+    assert min(timings) < STARTUP_BUDGET
+
+
+@pytest.mark.parametrize("args", [["--help"], ["--version"], ["build", "--help"]])
+def test_no_heavy_imports(args):
+    assert loaded_heavy_modules(*args) == []
+
+
+def test_convert_no_heavy_imports():
+    pytest.importorskip("ruamel.yaml")
+    recipe = str(recipes_dir / "jedi" / "meta.yaml")
+    assert loaded_heavy_modules("convert", recipe) == []
@@ -0,0 +1,53 @@
+import filecmp
+import os
+
+from boa.core.clone import TreeCloner, clone_tree, supports_reflinks
+
+
+def make_tree(root):
+    os.makedirs(root / "sub" / "deeper")
+    (root / "a.txt").write_text("a")
+    (root / "sub" / "b.bin").write_bytes(os.urandom(4096))
+    (root / "sub" / "deeper" / "c").write_text("c")
+    os.symlink("a.txt", root / "link")
+    os.symlink("sub", root / "dirlink")
+
+
+def test_clone_tree(tmp_path):
+    src = tmp_path / "src"
+    dst = tmp_path / "dst"
+    make_tree(src)
+    os.makedirs(dst)
+    (dst / "existing").write_text("keep")
+    (dst / "a.txt").write_text("overwritten")
+
+    clone_tree(src, dst)
+
+    assert (dst / "existing").read_text() == "keep"
+    assert (dst / "a.txt").read_text() == "a"
+    assert os.readlink(dst / "link") == "a.txt"
+    assert os.readlink(dst / "dirlink") == "sub"
+    assert filecmp.cmp(src / "sub" / "b.bin", dst / "sub" / "b.bin", shallow=False)
+    assert (dst / "sub" / "deeper" / "c").read_text() == "c"
+
+    # clones are independent of the source
+    (dst / "sub" / "deeper" / "c").write_text("changed")
+    assert (src / "sub" / "deeper" / "c").read_text() == "c"
+
+
+def test_clone_tree_without_reflinks(tmp_path):
+    src = tmp_path / "src"
+    dst = tmp_path / "dst"
+    make_tree(src)
+
+    TreeCloner(use_reflinks=False).clone_tree(str(src), str(dst))
+    assert (dst / "sub" / "deeper" / "c").read_text() == "c"
+    assert os.stat(dst / "a.txt").st_ino != os.stat(src / "a.txt").st_ino
+
+
+def test_supports_reflinks(tmp_path):
+    directory = str(tmp_path / "cache")
+    supported = supports_reflinks(directory)
+    assert isinstance(supported, bool)
+    # the probe files are removed
+    assert os.listdir(directory) == []
@@ -0,0 +1,83 @@
+import os
+import shutil
+
+import pytest
+
+pytest.importorskip("libmambapy")
+pytest.importorskip("conda_build")
+
+from boa.core import test as boa_test  # noqa: E402
+
+
+@pytest.fixture
+def prefix(tmp_path, monkeypatch):
+    monkeypatch.setattr(boa_test, "_cmake_probe_dirs", {})
+    prefix = tmp_path / "test_env"
+    (prefix / "conda-meta").mkdir(parents=True)
+    return str(prefix)
+
+
+def test_cmake_probe_dir(prefix):
+    probe_dir = boa_test._cmake_probe_dir("cmake", prefix)
+    cache = os.path.join(probe_dir, "build", "CMakeCache.txt")
+    with open(cache, "w") as fo:
+        fo.write("CMAKE_C_COMPILER:FILEPATH=/usr/bin/cc\nFoo_DIR:PATH=/foo\n")
+
+    # the same environment keeps the toolchain and forgets the packages
+    assert boa_test._cmake_probe_dir("cmake", prefix) == probe_dir
+    with open(cache) as fi:
+        assert fi.read() == "CMAKE_C_COMPILER:FILEPATH=/usr/bin/cc\n"
+
+    # the environment of the next package is created at the same path
+    shutil.rmtree(os.path.join(prefix, "conda-meta"))
+    os.makedirs(os.path.join(prefix, "conda-meta"))
+    os.utime(os.path.join(prefix, "conda-meta"), ns=(0, 0))
+    new_probe_dir = boa_test._cmake_probe_dir("cmake", prefix)
+    assert new_probe_dir != probe_dir
+    assert not os.path.exists(probe_dir)
+    assert not os.path.exists(os.path.join(new_probe_dir, "build", "CMakeCache.txt"))
+
+
+def _has_cmake_toolchain():
+    cmake = shutil.which("cmake")
+    if cmake is None or os.name == "nt":
+        return False
+    return any(shutil.which(cc) for cc in ("cc", "gcc", "clang")) and any(
+        shutil.which(cxx) for cxx in ("c++", "g++", "clang++")
+    )
+
+
+@pytest.mark.skipif(not _has_cmake_toolchain(), reason="needs cmake and compilers")
+def test_check_cmake(prefix, tmp_path, monkeypatch):
+    os.makedirs(os.path.join(prefix, "bin"))
+    os.symlink(shutil.which("cmake"), os.path.join(prefix, "bin", "cmake"))
+
+    packages = tmp_path / "packages"
+    packages.mkdir()
+    (packages / "FooConfig.cmake").write_text("set(Foo_FOUND TRUE)\n")
+    (packages / "BrokenConfig.cmake").write_text('message(FATAL_ERROR "broken")\n')
+    # found, but the configure fails like it did with find_package(... REQUIRED)
+    (packages / "ErrorConfig.cmake").write_text(
+        'message(SEND_ERROR "error")\nset(Error_FOUND TRUE)\n'
+    )
+    monkeypatch.setenv("CMAKE_PREFIX_PATH", str(packages))
+
+    assert boa_test.check_cmake(prefix, ["Foo"])
+    assert not boa_test.check_cmake(prefix, ["Foo", "Missing"])
+    assert not boa_test.check_cmake(prefix, ["Missing", "Foo"])
+
+    # a failing configure only fails the package that broke it
+    assert not boa_test.check_cmake(prefix, ["Foo", "Broken"])
+    cmake_cmd = os.path.join(prefix, "bin", "cmake")
+    assert boa_test._cmake_find_packages(cmake_cmd, prefix, ["Foo"]) == (
+        True,
+        {"Foo"},
+    )
+    ok, _ = boa_test._cmake_find_packages(cmake_cmd, prefix, ["Broken"])
+    assert not ok
+    assert boa_test._cmake_find_packages(cmake_cmd, prefix, ["Error"]) == (
+        False,
+        {"Error"},
+    )
+    assert not boa_test.check_cmake(prefix, ["Error"])
+    assert not boa_test.check_cmake(prefix, ["Foo", "Error"])
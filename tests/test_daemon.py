@@ -0,0 +1,133 @@
+import os
+import socket
+import subprocess
+import sys
+import threading
+
+import pytest
+
+from boa.core.daemon_socket import daemon_supported
+
+if not daemon_supported():
+    pytest.skip("the daemon needs Unix sockets", allow_module_level=True)
+
+from boa.cli import boa as boa_cli  # noqa: E402
+from boa.cli.boa import run_in_daemon  # noqa: E402
+from boa.core import monkey_patch_emscripten  # noqa: E402
+from boa.core import daemon  # noqa: E402
+from boa.core.daemon import BuildServer, _recv_fds, _send_fds  # noqa: E402
+from boa.core.daemon_socket import SOCKET_ENV, default_socket_path  # noqa: E402
+
+
+def fake_build(argv):
+    # the daemon redirects the file descriptors, pytest replaces sys.stdout
+    print("argv", " ".join(argv), file=sys.__stdout__, flush=True)
+    # the output of subprocesses goes to the client as well
+    subprocess.run(["echo", "cwd", os.getcwd(), os.environ["BOA_TEST_VALUE"]])
+    if "--fail" in argv:
+        raise RuntimeError("build failed")
+    return 0
+
+
+def submit(socket_path, cwd, *argv):
+    code = (
+        "import sys; from boa.core.daemon import submit; "
+        f"sys.exit(submit(sys.argv[1:], {str(socket_path)!r}))"
+    )
+    env = dict(os.environ, BOA_TEST_VALUE="from-client")
+    env["PYTHONPATH"] = os.pathsep.join(sys.path)
+    return subprocess.run(
+        [sys.executable, "-c", code, *argv],
+        cwd=cwd,
+        env=env,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True,
+    )
+
+
+def test_daemon(tmp_path):
+    socket_path = tmp_path / "boa.sock"
+    server = BuildServer(str(socket_path), fake_build)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        result = submit(socket_path, tmp_path, "build", "recipe")
+        assert result.returncode == 0
+        assert result.stdout.splitlines() == [
+            "argv build recipe",
+            f"cwd {tmp_path} from-client",
+        ]
+
+        result = submit(socket_path, tmp_path, "build", "--fail")
+        assert result.returncode == 1
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+    assert "BOA_TEST_VALUE" not in os.environ
+
+
+def test_send_fds(tmp_path):
+    left, right = socket.socketpair()
+    with left, right, open(tmp_path / "out.txt", "w") as fo:
+        _send_fds(left, b"\0", [fo.fileno(), fo.fileno()])
+        msg, fds = _recv_fds(right, 1, 2)
+        assert msg == b"\0" and len(fds) == 2
+        os.write(fds[0], b"through the passed descriptor\n")
+        for fd in fds:
+            os.close(fd)
+    assert (tmp_path / "out.txt").read_text() == "through the passed descriptor\n"
+
+
+def test_emscripten_builds_need_a_patched_daemon(monkeypatch, capsys):
+    monkeypatch.setattr(monkey_patch_emscripten, "_patched", False)
+    argv = ["build", "recipe", "--target-platform", "emscripten-32"]
+    assert run_in_daemon(argv) == 2
+    assert "boa serve --emscripten" in capsys.readouterr().err
+
+
+@pytest.mark.parametrize("argv", [["serve"], ["build", "recipe", "--daemon"]])
+def test_unsupported_platform(monkeypatch, capsys, argv):
+    monkeypatch.setattr(boa_cli, "daemon_supported", lambda: False)
+    monkeypatch.setattr(sys, "argv", ["boa"] + argv)
+    with pytest.raises(SystemExit) as e:
+        boa_cli.main()
+    assert e.value.code == 1
+    assert "Unix sockets" in capsys.readouterr().err
+
+
+def test_socket_is_private(tmp_path, monkeypatch):
+    monkeypatch.delenv(SOCKET_ENV, raising=False)
+    monkeypatch.setenv("XDG_RUNTIME_DIR", str(tmp_path))
+    socket_dir = os.path.dirname(default_socket_path())
+    daemon._make_private_dir(socket_dir)
+    assert os.stat(socket_dir).st_mode & 0o777 == 0o700
+
+    os.chmod(socket_dir, 0o755)
+    with pytest.raises(RuntimeError, match="0700"):
+        daemon._make_private_dir(socket_dir)
+
+    socket_path = tmp_path / "boa.sock"
+    server = BuildServer(str(socket_path), fake_build)
+    try:
+        # created with mode 0600, not changed afterwards
+        assert socket_path.stat().st_mode & 0o777 == 0o600
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(str(socket_path))
+            daemon._check_daemon_owner(sock, str(socket_path))
+            if hasattr(socket, "SO_PEERCRED"):
+                assert daemon._peer_uid(sock) == os.getuid()
+    finally:
+        server.server_close()
+
+
+def test_submit_checks_the_daemon_owner(tmp_path, monkeypatch, capsys):
+    socket_path = tmp_path / "boa.sock"
+    server = BuildServer(str(socket_path), fake_build)
+    monkeypatch.setattr(daemon, "_peer_uid", lambda sock: os.getuid() + 1)
+    try:
+        assert daemon.submit(["build", "recipe"], str(socket_path)) == 1
+    finally:
+        server.server_close()
+    assert "not run by the current user" in capsys.readouterr().err
@@ -0,0 +1,62 @@
+import json
+import os
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("conda_build")
+
+from boa.core import env_cache  # noqa: E402
+
+
+def _entry(name, version="1.0", build="0", sha256=None):
+    record = {"name": name, "version": version, "build": build}
+    if sha256:
+        record["sha256"] = sha256
+    return (
+        "https://conda.anaconda.org/conda-forge/linux-64",
+        f"{name}.conda",
+        json.dumps(record),
+    )
+
+
+def test_split_and_pin():
+    to_link = [_entry("python", "3.9.7", "h1234_0"), _entry("foo"), _entry("zlib")]
+    tested, env = env_cache.split_tested_package(to_link, "foo")
+    assert tested == [to_link[1]]
+    assert env == [to_link[0], to_link[2]]
+    assert env_cache.pinned_specs(env) == ["python 3.9.7 h1234_0", "zlib 1.0 0"]
+
+
+def test_test_env_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(env_cache, "supports_reflinks", lambda directory: True)
+    cache = env_cache.TestEnvCache(SimpleNamespace(build_folder=str(tmp_path)))
+    assert cache.enabled
+
+    prefix = str(tmp_path / "test_prefix")
+    env = [_entry("python", sha256="a" * 64), _entry("zlib", sha256="b" * 64)]
+    key = cache.key(prefix, env)
+    assert key == cache.key(prefix, env[::-1])
+    assert key != cache.key(str(tmp_path / "other_prefix"), env)
+    assert key != cache.key(prefix, env[:1] + [_entry("zlib", sha256="c" * 64)])
+
+    assert not cache.restore(key, prefix)
+    (tmp_path / "test_prefix" / "conda-meta").mkdir(parents=True)
+    (tmp_path / "test_prefix" / "conda-meta" / "zlib.json").write_text("{}")
+    cache.store(key, prefix)
+
+    (tmp_path / "test_prefix" / "tested-file").write_text("from the tested package")
+    assert cache.restore(key, prefix)
+    assert not (tmp_path / "test_prefix" / "tested-file").exists()
+    assert (tmp_path / "test_prefix" / "conda-meta" / "zlib.json").exists()
+
+    # removed with the build
+    cache.remove()
+    assert not os.path.exists(cache.root)
+    assert not cache.restore(key, prefix)
+
+
+def test_test_env_cache_needs_reflinks(tmp_path, monkeypatch):
+    monkeypatch.setattr(env_cache, "supports_reflinks", lambda directory: False)
+    config = SimpleNamespace(build_folder=str(tmp_path))
+    assert not env_cache.TestEnvCache(config).enabled
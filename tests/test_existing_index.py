@@ -0,0 +1,40 @@
+import json
+
+from boa.core.existing_index import ExistingPackages
+
+
+def test_existing_packages(tmp_path):
+    linux = tmp_path / "linux-64"
+    noarch = tmp_path / "noarch"
+    linux.mkdir()
+    noarch.mkdir()
+
+    (linux / "foo-1.0-h1234567_0.tar.bz2").write_bytes(b"")
+    (linux / "bar-2.0-py39_1.conda").write_bytes(b"")
+    (noarch / "baz-0.1-pyhd8ed1ab_0.conda").write_bytes(b"")
+    # not package file names, skipped
+    (linux / "current_repodata.tar.bz2").write_bytes(b"")
+    (noarch / "foo-1.0.conda").write_bytes(b"")
+    repodata = {
+        "packages": {
+            "foo-1.0-h1234567_0.tar.bz2": {
+                "name": "foo",
+                "version": "1.0",
+                "build": "h1234567_0",
+            },
+            # removed after indexing
+            "gone-1.0-0.tar.bz2": {"name": "gone", "version": "1.0", "build": "0"},
+        },
+        "packages.conda": {},
+    }
+    (linux / "repodata.json").write_text(json.dumps(repodata))
+
+    index = ExistingPackages(str(tmp_path), ["linux-64", "noarch", "osx-64"])
+    assert index.has_dist("foo-1.0-h1234567_0")
+    assert index.has_dist("bar-2.0-py39_1")
+    assert index.has_dist("baz-0.1-pyhd8ed1ab_0")
+    assert not index.has_dist("gone-1.0-0")
+    assert len(index.packages) == 3
+    assert index.has_version("bar", "2.0")
+    assert not index.has_version("bar", "2.1")
+    assert index.builds("foo", "1.0") == {"h1234567_0"}
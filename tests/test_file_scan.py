@@ -0,0 +1,156 @@
+import hashlib
+import json
+import os
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("conda_build")
+
+from boa.core.file_scan import (  # noqa: E402
+    EMPTY_SHA256,
+    create_info_files_json_v1,
+    get_files_with_prefix,
+    scan_files,
+)
+
+PREFIX_PLACEHOLDER = "/opt/anaconda1anaconda2anaconda3"
+
+
+def _sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+@pytest.fixture
+def prefix(tmp_path):
+    prefix = str(tmp_path / "host")
+    os.makedirs(os.path.join(prefix, "bin"))
+    os.makedirs(os.path.join(prefix, "lib"))
+
+    def write(f, data):
+        with open(os.path.join(prefix, f), "wb") as fo:
+            fo.write(data)
+
+    write("bin/script", f"#!{prefix}/bin/python\n".encode())
+    write("lib/libfoo.so", b"\x7fELF\x00\x00" + prefix.encode() + b"\x00")
+    write("lib/placeholder.txt", PREFIX_PLACEHOLDER.encode())
+    write("lib/plain.txt", b"nothing to see here\n")
+    write("lib/empty", b"")
+    write("lib/module.pyc", prefix.encode())
+    os.link(
+        os.path.join(prefix, "lib/libfoo.so"), os.path.join(prefix, "lib/libfoo.so.1")
+    )
+    os.symlink("libfoo.so", os.path.join(prefix, "lib/libfoo.so.2"))
+    os.symlink("missing", os.path.join(prefix, "lib/broken"))
+    return prefix
+
+
+def _files(prefix):
+    return [
+        os.path.relpath(os.path.join(root, f), prefix)
+        for root, _, files in os.walk(prefix)
+        for f in files
+    ]
+
+
+def test_scan_files(prefix):
+    files = _files(prefix)
+    scans = scan_files(prefix, files, [prefix, PREFIX_PLACEHOLDER, prefix], threads=2)
+    assert sorted(scans) == sorted(files)
+
+    for f, scan in scans.items():
+        path = os.path.join(prefix, f)
+        if os.path.exists(path):
+            with open(path, "rb") as fi:
+                data = fi.read()
+            assert scan.sha256 == _sha256(data), f
+            assert scan.size == len(data), f
+
+    script = scans["bin/script"]
+    assert script.prefixes == [prefix] and not script.is_binary
+
+    lib = scans["lib/libfoo.so"]
+    assert lib.prefixes == [prefix] and lib.is_binary
+    assert lib.nlink == 2 and lib.inode == scans["lib/libfoo.so.1"].inode
+
+    assert scans["lib/placeholder.txt"].prefixes == [PREFIX_PLACEHOLDER]
+    assert scans["lib/plain.txt"].prefixes == []
+    assert scans["lib/empty"].sha256 == EMPTY_SHA256
+
+    # excluded from prefix detection, but still hashed
+    assert scans["lib/module.pyc"].prefixes == []
+    assert scans["lib/libfoo.so.2"].is_symlink
+    assert scans["lib/libfoo.so.2"].prefixes == []
+
+    broken = scans["lib/broken"]
+    assert broken.is_symlink and broken.sha256 == EMPTY_SHA256
+
+
+class FakeMetaData:
+    def __init__(self, ignore_prefix_files=False, values=None, noarch_python=False):
+        self._ignore_prefix_files = ignore_prefix_files
+        self._values = values or {}
+        self.noarch = None
+        self.noarch_python = noarch_python
+        self.config = SimpleNamespace(verbose=False)
+
+    def ignore_prefix_files(self):
+        return self._ignore_prefix_files
+
+    def get_value(self, key, default=None):
+        return self._values.get(key, default)
+
+
+def test_get_files_with_prefix(prefix):
+    files = _files(prefix)
+    scans = scan_files(prefix, files, [prefix, PREFIX_PLACEHOLDER])
+
+    assert get_files_with_prefix(FakeMetaData(), files, prefix, scans) == sorted(
+        [
+            (PREFIX_PLACEHOLDER, "text", "lib/placeholder.txt"),
+            (prefix, "binary", "lib/libfoo.so"),
+            (prefix, "binary", "lib/libfoo.so.1"),
+            (prefix, "text", "bin/script"),
+        ]
+    )
+
+    m = FakeMetaData(
+        ignore_prefix_files=["bin/script"],
+        values={"build/detect_binary_files_with_prefix": False},
+    )
+    assert get_files_with_prefix(m, files, prefix, scans) == [
+        (PREFIX_PLACEHOLDER, "text", "lib/placeholder.txt"),
+    ]
+
+    m = FakeMetaData(ignore_prefix_files=True)
+    assert get_files_with_prefix(m, files, prefix, scans) == []
+
+
+def test_create_info_files_json_v1(prefix, tmp_path):
+    files = _files(prefix)
+    scans = scan_files(prefix, files, [prefix, PREFIX_PLACEHOLDER])
+    m = FakeMetaData()
+    files_with_prefix = get_files_with_prefix(m, files, prefix, scans)
+    info_dir = tmp_path / "info"
+    info_dir.mkdir()
+
+    checksums = create_info_files_json_v1(
+        m, str(info_dir), prefix, files, files_with_prefix, scans
+    )
+    assert checksums == {f: scans[f].sha256 for f in files}
+    with open(info_dir / "paths.json") as fi:
+        paths = {p["_path"]: p for p in json.load(fi)["paths"]}
+    assert paths["bin/script"]["prefix_placeholder"] == prefix
+    assert paths["lib/libfoo.so"]["inode_paths"] == ["lib/libfoo.so", "lib/libfoo.so.1"]
+    assert paths["lib/libfoo.so.2"]["path_type"] == "softlink"
+
+    # old style noarch python packages have no paths.json
+    (info_dir / "paths.json").unlink()
+    m = FakeMetaData(noarch_python=True)
+    assert (
+        create_info_files_json_v1(
+            m, str(info_dir), prefix, files, files_with_prefix, scans
+        )
+        == checksums
+    )
+    assert not (info_dir / "paths.json").exists()
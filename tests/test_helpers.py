@@ -1,4 +1,10 @@
+import fnmatch
+
+import pytest
+
 from boa.helpers.ast_extract_syms import ast_extract_syms
+from boa.helpers.glob_matcher import FileSelector, GlobMatcher, classify_files
+from boa.helpers.pkgconfig import AmbiguousPkgConfig, PkgConfigResolver, rpmvercmp
 
 
 def test_helpers():
@@ -7,3 +13,95 @@ def test_helpers():
     assert ast_extract_syms("somevar==(3,6)") == ["somevar"]
     assert ast_extract_syms("somevar<=linux") == ["somevar", "linux"]
     assert ast_extract_syms("target_platform == 'linux'") == ["target_platform"]
+
+
+def test_glob_matcher():
+    files = [
+        "lib/libfoo.so",
+        "lib/libfoo.so.1.2",
+        "lib/libfoo.a",
+        "lib/pkgconfig/foo.pc",
+        "include/foo/foo.h",
+        "include/foo/detail/impl.hpp",
+        "share/doc/foo/README",
+        "bin/foo",
+        "info/index.json",
+    ]
+
+    def reference(files, include, exclude):
+        to_include = set()
+        for f in include or ["*"]:
+            to_include |= set(fnmatch.filter(files, f))
+        to_exclude = set()
+        for f in exclude or []:
+            to_exclude |= set(fnmatch.filter(to_include, f))
+        return to_include - to_exclude
+
+    selectors = {
+        "libfoo": (["lib/libfoo.so*", "bin/*"], None),
+        "libfoo-dev": (["include/*", "lib/pkgconfig/*"], ["*.hpp"]),
+        "libfoo-static": (["lib/*.a"], None),
+        "libfoo-all": (None, ["info/*", "share/*"]),
+        "headers": (["*.h", "*.hpp"], None),
+    }
+    for include, exclude in selectors.values():
+        assert FileSelector(include, exclude).select(files) == reference(
+            files, include, exclude
+        )
+
+    classified = classify_files(
+        files, {k: FileSelector(*v) for k, v in selectors.items()}
+    )
+    for name, (include, exclude) in selectors.items():
+        assert classified[name] == reference(files, include, exclude)
+
+    assert not GlobMatcher([])("lib/libfoo.so")
+    assert GlobMatcher(["lib/[lm]ib*"])("lib/libfoo.so")
+    assert not GlobMatcher(["lib/[!l]ib*"])("lib/libfoo.so")
+
+
+def test_pkgconfig_resolver(tmp_path):
+    assert rpmvercmp("1.10", "1.9") == 1
+    assert rpmvercmp("1.0", "1.0.1") == -1
+    assert rpmvercmp("1.01", "1.1") == 0
+    assert rpmvercmp("2.0a", "2.0") == 1
+
+    lib = tmp_path / "lib" / "pkgconfig"
+    share = tmp_path / "share" / "pkgconfig"
+    lib.mkdir(parents=True)
+    share.mkdir(parents=True)
+
+    (lib / "zlib.pc").write_text(
+        "prefix=/opt/conda\n"
+        "libdir=${prefix}/lib\n"
+        "\n"
+        "Name: zlib\n"
+        "Description: zlib compression library\n"
+        "Version: 1.2.13\n"
+        "Libs: -L${libdir} -lz\n"
+    )
+    (share / "foo.pc").write_text(
+        "Name: foo\nDescription: foo\nVersion: 2.0\nRequires: zlib >= 1.2.11\n"
+    )
+    (share / "bar.pc").write_text(
+        "Name: bar\nDescription: bar\nVersion: 1.0\nRequires.private: missing\n"
+    )
+    (share / "baz.pc").write_text("Name: baz\nVersion: 1.0\n")
+    (share / "qux.pc").write_text(
+        "Name: qux\nDescription: qux\nVersion: 1.0\nLibs: ${undefined}\n"
+    )
+    (share / "conflicts.pc").write_text(
+        "Name: c\nDescription: c\nVersion: 1.0\nConflicts: zlib < 1.0\n"
+    )
+
+    resolver = PkgConfigResolver([str(lib), str(share)])
+    assert resolver.validate("zlib")
+    assert resolver.validate("foo")
+    assert resolver.validate("zlib >= 1.2")
+    assert not resolver.validate("zlib > 1.2.13")
+    assert not resolver.validate("bar")
+    assert not resolver.validate("baz")
+    assert not resolver.validate("qux")
+    assert not resolver.validate("nonexistent")
+    with pytest.raises(AmbiguousPkgConfig):
+        resolver.validate("conflicts")
@@ -0,0 +1,52 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+# seconds boa's own modules may spend at import, dependencies not included
+IMPORT_BUDGET = float(os.environ.get("BOA_IMPORT_BUDGET", "0.25"))
+
+
+def import_times(module):
+    """Self import time in seconds of boa's own modules and of its dependencies,
+    as reported by ``python -X importtime``"""
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        stderr=subprocess.PIPE,
+        text=True,
+    )
+    lines = proc.stderr.splitlines()
+    if proc.returncode != 0:
+        pytest.skip(f"{module} can not be imported: {lines[-1]}")
+
+    own = dependencies = 0
+    for line in lines:
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, _, name = line[len("import time:") :].split("|")
+        name = name.strip()
+        if name == "boa" or name.startswith("boa."):
+            own += int(self_us)
+        else:
+            dependencies += int(self_us)
+    return own / 1e6, dependencies / 1e6
+
+
+@pytest.mark.parametrize(
+    "module", ["boa.cli.boa", "boa.core.utils", "boa.core.run_build"]
+)
+def test_import_time(module):
+    own, dependencies = import_times(module)
+    print(f"{module}: boa {own:.3f}s, dependencies {dependencies:.3f}s")
+    assert own < IMPORT_BUDGET
+
+
+def test_emscripten_patch_is_lazy():
+    code = (
+        "import sys; sys.argv += ['--target-platform', 'emscripten-32']; "
+        "import boa.cli.boa; "
+        "print('boa.core.monkey_patch_emscripten' in sys.modules)"
+    )
+    out = subprocess.check_output([sys.executable, "-c", code], text=True)
+    assert out.strip() == "False"
@@ -0,0 +1,143 @@
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("conda_build")
+
+from boa.core.conda_build_spec import CondaBuildSpec  # noqa: E402
+from boa.core.metadata import MetaData, _exclude_pattern, _hash_pattern  # noqa: E402
+
+
+def make_metadata(tmp_path, requirements, variant, build=None):
+    requirements = {
+        env: [CondaBuildSpec(spec) for spec in requirements.get(env, [])]
+        for env in ("build", "host", "run")
+    }
+    build = build or {"number": 0}
+    output = SimpleNamespace(
+        name="foo",
+        version="1.0",
+        build_number=build.get("number", 0),
+        build_string=build.get("string"),
+        data={"build": build, "requirements": {}},
+        sections={"build": build},
+        requirements=requirements,
+        revision=0,
+        config=SimpleNamespace(
+            variant=dict(variant, target_platform="linux-64"),
+            filename_hashing=True,
+            hash_length=7,
+        ),
+    )
+    return MetaData(str(tmp_path), output)
+
+
+def test_predict_build_id(tmp_path):
+    # python in the variant and an explicit run dependency
+    m = make_metadata(
+        tmp_path, {"host": ["python"], "run": ["python"]}, {"python": "3.9"}
+    )
+    assert m.predict_build_id() == m.build_id()
+    assert m.predict_build_id().startswith("py39h")
+
+    m = make_metadata(tmp_path, {"host": ["zlib"], "run": ["zlib"]}, {})
+    assert m.predict_build_id() == m.build_id()
+
+    m = make_metadata(
+        tmp_path, {"host": ["python"]}, {"python": "3.9"}, {"string": "custom_0"}
+    )
+    assert m.predict_build_id() == "custom_0"
+
+
+@pytest.mark.parametrize(
+    "requirements, variant",
+    [
+        # the solved python version ends up in the hash
+        ({"host": ["python"], "run": ["python"]}, {}),
+        # python or numpy could be added to run through run_exports
+        ({"host": ["python"]}, {"python": "3.9"}),
+        ({"build": ["numpy"], "run": ["python"]}, {"python": "3.9"}),
+    ],
+)
+def test_predict_build_id_depends_on_the_solve(tmp_path, requirements, variant):
+    m = make_metadata(tmp_path, requirements, variant)
+    assert m.predict_build_id() is None
+
+
+def test_build_id_cache_invalidation(tmp_path, monkeypatch):
+    m = make_metadata(
+        tmp_path, {"host": ["python"], "run": ["python"]}, {"python": "3.9"}
+    )
+    calls = []
+    compute = m._compute_build_id
+
+    def counting_compute():
+        calls.append(1)
+        return compute()
+
+    monkeypatch.setattr(m, "_compute_build_id", counting_compute)
+
+    build_id = m.build_id()
+    assert m.build_id() == build_id
+    assert m.dist() == f"foo-1.0-{build_id}"
+    assert len(calls) == 1
+
+    # the variant is replaced
+    m.config.variant = dict(m.config.variant, python="3.10")
+    assert m.build_id().startswith("py310h")
+    assert len(calls) == 2
+
+    # finalize_solve changes the variant in place and bumps the revision
+    m.config.variant["python"] = "3.11"
+    m.output.revision += 1
+    assert m.build_id().startswith("py311h")
+    assert len(calls) == 3
+
+    m.config.hash_length = 5
+    assert len(m.build_id().split("_")[0]) == len("py311") + 6
+    assert len(calls) == 4
+
+    m.invalidate()
+    m.build_id()
+    assert len(calls) == 5
+
+
+def test_get_value_keys(tmp_path):
+    m = make_metadata(tmp_path, {}, {}, {"number": 3, "noarch": "python"})
+    m.meta["source"] = [{"url": "a"}, {"url": "b"}]
+    assert m.get_value("build/number") == 3
+    assert m.get_value("build/noarch") == "python"
+    assert m.get_value("build/missing", "default") == "default"
+    assert m.get_value("source/1/url") == "b"
+    assert m.get_value("source/url") == "a"
+
+
+def test_hash_contents_cache(tmp_path):
+    m = make_metadata(
+        tmp_path,
+        {"host": ["python", "zlib"], "run": ["python"]},
+        {"python": "3.9", "zlib": "1.2"},
+    )
+    contents = m.get_hash_contents()
+    assert contents == {"python": "3.9", "zlib": "1.2", "target_platform": "linux-64"}
+    # callers get a copy of the cached value
+    contents["zlib"] = "changed"
+    assert m.get_hash_contents()["zlib"] == "1.2"
+
+    hash_ = m.hash_dependencies()
+    assert hash_.startswith("h") and len(hash_) == 8
+    m.config.variant["zlib"] = "1.3"
+    m.invalidate()
+    assert m.get_hash_contents()["zlib"] == "1.3"
+    assert m.hash_dependencies() != hash_
+
+
+def test_compiled_patterns():
+    assert _hash_pattern(7) is _hash_pattern(7)
+    assert _hash_pattern(7).search("py39h1234567_0")
+    assert not _hash_pattern(7).search("py39h12345_0")
+
+    pattern = _exclude_pattern(("python", "perl"))
+    assert pattern is _exclude_pattern(("python", "perl"))
+    assert pattern.match("python") and pattern.match("perl 5")
+    assert not pattern.match("zlib")
@@ -0,0 +1,117 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from boa.core.orchestrator import DependencyFailed, TaskGraph
+
+
+def test_task_graph_order_and_overlap():
+    graph = TaskGraph()
+    events = []
+    threads = {}
+    downloaded = threading.Event()
+
+    def download():
+        events.append("download")
+        downloaded.set()
+
+    def build(name, wait=False):
+        # the download of the next output runs while this one builds
+        if wait:
+            assert downloaded.wait(5)
+        threads[name] = threading.current_thread()
+        events.append(name)
+        return name
+
+    graph.add("build 0", build, "build 0", True, kind="serial")
+    graph.add("download 1", download)
+    graph.add(
+        "build 1", build, "build 1", deps=["build 0", "download 1"], kind="serial"
+    )
+    graph.add("package 1", len, "build 1", deps=["build 1"])
+    results = graph.run()
+
+    assert events == ["download", "build 0", "build 1"]
+    assert results["build 1"] == "build 1"
+    assert results["package 1"] == len("build 1")
+    # serial tasks run on the calling thread
+    assert set(threads.values()) == {threading.current_thread()}
+
+
+def test_task_graph_serial_failure_is_raised_right_away():
+    graph = TaskGraph(io_workers=1)
+    ran = []
+    release = threading.Event()
+
+    def fail():
+        raise SystemExit(1)
+
+    graph.add("slow", release.wait, 5)
+    graph.add("pending", ran.append, "pending")
+    graph.add("a", fail, kind="serial")
+    graph.add("b", ran.append, "b", deps=["a"], kind="serial")
+    try:
+        with pytest.raises(SystemExit):
+            graph.run()
+    finally:
+        release.set()
+    # the download that did not start yet is cancelled
+    assert ran == []
+
+    with pytest.raises(ValueError):
+        graph.add("d", ran.append, "d", deps=["unknown"])
+    with pytest.raises(ValueError):
+        graph.add("d", ran.append, "d", kind="gpu")
+
+
+def test_task_graph_io_failure():
+    graph = TaskGraph()
+    ran = []
+
+    def fail():
+        raise RuntimeError("download failed")
+
+    graph.add("download", fail)
+    graph.add("extract", ran.append, "extract", deps=["download"])
+    graph.add("other", ran.append, "other", kind="serial")
+    with pytest.raises(RuntimeError, match="download failed"):
+        graph.run()
+    # tasks depending on a failed task do not run, the others do
+    assert ran == ["other"]
+
+    graph = TaskGraph()
+    graph.add("download", fail)
+    graph.add("extract", ran.append, "extract", deps=["download"])
+    graph.add("build", ran.append, "build", deps=["extract"], kind="serial")
+    with pytest.raises(DependencyFailed) as e:
+        graph.run()
+    assert isinstance(e.value.__cause__, RuntimeError)
+
+
+def test_task_graph_cpu_executor():
+    events = []
+    packaged = threading.Event()
+
+    def package(name):
+        events.append(name)
+        packaged.set()
+        return threading.current_thread().name
+
+    def build(name):
+        # the next output builds while the previous one is compressed
+        assert packaged.wait(5)
+        events.append(name)
+
+    with ThreadPoolExecutor(1, thread_name_prefix="custom-cpu") as executor:
+        graph = TaskGraph(cpu_executor=executor)
+        graph.add("build 0", events.append, "build 0", kind="serial")
+        graph.add("package 0", package, "package 0", deps=["build 0"], kind="cpu")
+        graph.add("build 1", build, "build 1", deps=["build 0"], kind="serial")
+        results = graph.run()
+
+        # the executor is not shut down by the graph
+        assert executor.submit(len, "abc").result() == 3
+
+    assert events == ["build 0", "package 0", "build 1"]
+    assert results["package 0"].startswith("custom-cpu")
@@ -0,0 +1,87 @@
+import bz2
+import io
+import json
+import os
+import tarfile
+import zipfile
+
+import pytest
+
+from boa.core.packaging import ParallelBZ2Writer, create_packages, create_tar_bz2
+
+
+def test_parallel_bz2_roundtrip():
+    data = os.urandom(100_000) + b"boa" * 1_000_000
+    out = io.BytesIO()
+    writer = ParallelBZ2Writer(out, threads=4, chunk_size=256 * 1024)
+    writer.write(data)
+    writer.close()
+    assert bz2.decompress(out.getvalue()) == data
+
+    out = io.BytesIO()
+    writer = ParallelBZ2Writer(out, threads=2)
+    writer.close()
+    assert bz2.decompress(out.getvalue()) == b""
+
+
+def test_create_tar_bz2(tmp_path):
+    prefix = tmp_path / "prefix"
+    (prefix / "info").mkdir(parents=True)
+    (prefix / "lib").mkdir()
+    (prefix / "info" / "index.json").write_text("{}")
+    (prefix / "lib" / "libfoo.so").write_bytes(b"\0foo" * 500_000)
+
+    out = create_tar_bz2(
+        str(prefix),
+        ["lib/libfoo.so", "info/index.json"],
+        str(tmp_path / "foo-1.0-0.tar.bz2"),
+        threads=3,
+    )
+    with tarfile.open(out) as tar:
+        members = tar.getmembers()
+        assert [m.name for m in members] == ["info/index.json", "lib/libfoo.so"]
+        assert all(m.uid == 0 and m.gid == 0 for m in members)
+        assert tar.extractfile("lib/libfoo.so").read() == b"\0foo" * 500_000
+
+
+def test_create_packages_both_formats(tmp_path):
+    # writing .conda packages needs zstandard
+    zstandard = pytest.importorskip("zstandard")
+    prefix = tmp_path / "prefix"
+    (prefix / "info").mkdir(parents=True)
+    (prefix / "bin").mkdir()
+    (prefix / "info" / "index.json").write_text("{}")
+    (prefix / "bin" / "foo").write_text("#!/bin/sh\necho foo\n")
+    files = ["bin/foo", "info/index.json"]
+
+    out = create_packages(
+        str(prefix),
+        files,
+        "foo-1.0-0",
+        [".tar.bz2", ".conda"],
+        str(tmp_path / "out"),
+        zstd_compression_level=3,
+        threads=2,
+    )
+    assert [os.path.basename(x) for x in out] == [
+        "foo-1.0-0.tar.bz2",
+        "foo-1.0-0.conda",
+    ]
+    assert sorted(os.listdir(tmp_path / "out")) == [
+        "foo-1.0-0.conda",
+        "foo-1.0-0.tar.bz2",
+    ]
+
+    with tarfile.open(out[0]) as tar:
+        assert tar.getnames() == ["info/index.json", "bin/foo"]
+
+    with zipfile.ZipFile(out[1]) as zf:
+        assert json.loads(zf.read("metadata.json")) == {"conda_pkg_format_version": 2}
+        for component, names in (("info", ["info/index.json"]), ("pkg", ["bin/foo"])):
+            data = (
+                zstandard.ZstdDecompressor()
+                .decompressobj()
+                .decompress(zf.read(f"{component}-foo-1.0-0.tar.zst"))
+            )
+            with tarfile.open(fileobj=io.BytesIO(data)) as tar:
+                assert tar.getnames() == names
@@ -0,0 +1,62 @@
+import os
+
+import pytest
+
+pytest.importorskip("libmambapy")
+pytest.importorskip("conda_build")
+
+from boa.cli.boa import get_parser  # noqa: E402
+from boa.core.parallel_tests import forwarded_test_args  # noqa: E402
+
+
+def test_forwarded_test_args():
+    parser = get_parser()
+    args = parser.parse_args(
+        [
+            "build",
+            "recipe",
+            "--offline",
+            "--target-platform",
+            "emscripten-32",
+            "-m",
+            "variants.yaml",
+            "--extra-deps",
+            "pytest-xdist",
+            "--prefix-length",
+            "80",
+            "--no-remove-work-dir",
+            "--keep-old-work",
+            "--croot",
+            "/tmp/croot",
+            "--test-jobs",
+            "4",
+            "--output-folder",
+            "output",
+        ]
+    )
+    argv = forwarded_test_args(args)
+    assert "/tmp/croot" not in argv
+
+    # `boa test` understands all of them and ends up with the same options
+    test_args = parser.parse_args(["test", *argv, "--croot", "/tmp/job", "pkg"])
+    assert test_args.offline
+    assert test_args.target_platform == "emscripten-32"
+    assert test_args.variant_config_files == [os.path.abspath("variants.yaml")]
+    assert test_args.extra_deps == ["pytest-xdist"]
+    assert test_args.conda_build_prefix_length == 80
+    assert not test_args.conda_build_remove_work_dir
+    assert test_args.conda_build_keep_old_work
+    assert test_args.conda_build_croot == "/tmp/job"
+    # the tests resolve against the output folder, only the build indexes it
+    assert test_args.output_folder == os.path.abspath("output")
+    assert not test_args.update_channel_index
+
+    defaults = forwarded_test_args(parser.parse_args(["build", "recipe"]))
+    assert defaults == ["--no-update-index", "--prefix-length", "255"]
+    # the output folder of the conda config, resolved by the build
+    assert forwarded_test_args(parser.parse_args(["build", "recipe"]), "/tmp/output")[
+        :2
+    ] == ["--output-folder", "/tmp/output"]
+
+    test_args = parser.parse_args(["test", "pkg"])
+    assert test_args.update_channel_index and test_args.output_folder is None
@@ -0,0 +1,40 @@
+import os
+import stat
+
+import pytest
+
+pytest.importorskip("libmambapy")
+pytest.importorskip("conda_build")
+
+from boa.core import test as boa_test  # noqa: E402
+
+
+@pytest.mark.skipif(os.name == "nt", reason="uses a shell script as pkg-config")
+def test_check_pkg_config_installs_pkg_config(tmp_path, monkeypatch):
+    monkeypatch.delenv("PKG_CONFIG_PATH", raising=False)
+    prefix = tmp_path / "test_env"
+    pc_dir = prefix / "lib" / "pkgconfig"
+    pc_dir.mkdir(parents=True)
+    (pc_dir / "foo.pc").write_text("Name: foo\nDescription: foo\nVersion: 1.0\n")
+    # conflicts are left to the pkg-config binary
+    (pc_dir / "bar.pc").write_text(
+        "Name: bar\nDescription: bar\nVersion: 1.0\nConflicts: foo < 1.0\n"
+    )
+
+    # the resolver decides on its own, pkg-config is not needed
+    assert boa_test.check_pkg_config(str(prefix), ["foo"], pytest.fail)
+    assert not boa_test.check_pkg_config(str(prefix), ["bar"])
+
+    installed = []
+
+    def install_pkg_config():
+        installed.append(True)
+        pkg_config = prefix / "bin" / "pkg-config"
+        pkg_config.parent.mkdir()
+        pkg_config.write_text("#!/bin/sh\nexit 0\n")
+        pkg_config.chmod(pkg_config.stat().st_mode | stat.S_IEXEC)
+
+    assert boa_test.check_pkg_config(
+        str(prefix), ["bar", "foo", "bar"], install_pkg_config
+    )
+    assert installed == [True]
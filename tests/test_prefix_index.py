@@ -0,0 +1,47 @@
+import glob
+import os
+
+from boa.core.prefix_index import PrefixIndex
+
+
+def test_prefix_index(tmp_path):
+    for f in (
+        "lib/libfoo.so",
+        "lib/libbar.so.1",
+        "include/foo/a.h",
+        "include/.hidden.h",
+        "lib/python3.9/site-packages/pkg/__init__.py",
+        "bin/tool",
+    ):
+        path = tmp_path / f
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text("")
+    os.symlink("lib", tmp_path / "lib64")
+    os.symlink("nowhere", tmp_path / "lib" / "broken.so")
+
+    index = PrefixIndex(str(tmp_path))
+    for f in (
+        "lib/libfoo.so",
+        "lib",
+        "lib64",
+        "lib64/libfoo.so",
+        "lib/broken.so",
+        "x/y",
+    ):
+        assert index.isfile(f) == os.path.isfile(tmp_path / f)
+        assert index.isdir(f) == os.path.isdir(tmp_path / f)
+
+    for pattern in (
+        "lib/*.so",
+        "include/*",
+        "include/*/*.h",
+        "include/.h*",
+        "lib64/*",
+        "lib/python*/site-packages/*/__init__.py",
+        "*",
+        "lib/*/",
+        "bin/tool",
+        "nope/*",
+    ):
+        expected = sorted(glob.glob(os.path.join(str(tmp_path), pattern)))
+        assert index.glob(pattern) == expected
@@ -0,0 +1,79 @@
+import os
+import sys
+
+import pytest
+
+from boa.core import prefix_snapshot
+from boa.core.prefix_snapshot import PrefixSnapshot
+
+
+def walk_prefix_files(prefix):
+    # reference implementation, mirrors conda_build.utils.prefix_files
+    res = set()
+    for root, dirs, files in os.walk(prefix):
+        for fn in files:
+            res.add(os.path.relpath(os.path.join(root, fn), prefix))
+        for dn in dirs:
+            path = os.path.join(root, dn)
+            if os.path.islink(path):
+                res.add(os.path.relpath(path, prefix))
+    return res
+
+
+def populate(prefix):
+    (prefix / "lib" / "pkgconfig").mkdir(parents=True)
+    (prefix / "include" / "foo").mkdir(parents=True)
+    (prefix / "empty").mkdir()
+    (prefix / "lib" / "libfoo.so.1").write_text("")
+    (prefix / "lib" / "pkgconfig" / "foo.pc").write_text("")
+    (prefix / "include" / "foo" / "foo.h").write_text("")
+
+
+def test_prefix_snapshot(tmp_path):
+    prefix = tmp_path / "prefix"
+    assert PrefixSnapshot(str(prefix)).files() == set()
+
+    populate(prefix)
+    snapshot = PrefixSnapshot(str(prefix))
+    assert snapshot.files() == walk_prefix_files(prefix)
+
+    (prefix / "include" / "foo" / "bar.h").write_text("")
+    (prefix / "lib" / "pkgconfig" / "foo.pc").unlink()
+    (prefix / "share" / "doc").mkdir(parents=True)
+    (prefix / "share" / "doc" / "README").write_text("")
+    assert snapshot.refresh() == walk_prefix_files(prefix)
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="symlinks need privileges")
+def test_prefix_snapshot_symlinks(tmp_path):
+    prefix = tmp_path / "prefix"
+    populate(prefix)
+    os.symlink("libfoo.so.1", prefix / "lib" / "libfoo.so")
+    os.symlink("doesnotexist", prefix / "lib" / "broken")
+    os.symlink("include/foo", prefix / "foo_include")
+
+    snapshot = PrefixSnapshot(str(prefix))
+    assert snapshot.files() == walk_prefix_files(prefix)
+    assert "foo_include" in snapshot.files()
+    assert os.path.join("foo_include", "foo.h") not in snapshot.files()
+
+
+def test_prefix_snapshot_reuses_unchanged_dirs(tmp_path, monkeypatch):
+    prefix = tmp_path / "prefix"
+    populate(prefix)
+    # pretend the scan happens long after the last modification
+    monkeypatch.setattr(prefix_snapshot, "RACY_WINDOW_NS", -(10**18))
+    snapshot = PrefixSnapshot(str(prefix))
+
+    scanned = []
+    scandir = os.scandir
+
+    def counting_scandir(path):
+        scanned.append(os.path.relpath(path, prefix))
+        return scandir(path)
+
+    monkeypatch.setattr(prefix_snapshot.os, "scandir", counting_scandir)
+    (prefix / "lib" / "libbar.so").write_text("")
+    files = snapshot.refresh()
+    assert scanned == ["lib"]
+    assert os.path.join("lib", "libbar.so") in files
@@ -0,0 +1,35 @@
+import json
+
+from boa.core.profiling import Profiler
+
+
+def test_profiler(tmp_path):
+    profiler = Profiler()
+    with profiler.phase("disabled"):
+        pass
+    assert profiler.events == []
+
+    profiler.enable()
+    with profiler.phase("solve", output="foo", env="host"):
+        sum(range(10000))
+    (event,) = profiler.events
+    assert event["name"] == "solve"
+    assert event["labels"] == {"output": "foo", "env": "host"}
+    assert event["wall_time"] >= 0
+    assert event["cpu_time"] >= 0
+    # the peak RSS is process-wide, it is not attributed to a phase
+    assert "peak_rss" not in event
+    if event["rss_start"] is not None:
+        assert event["rss_end"] > 0
+
+    profiler.write(tmp_path / "profile.json")
+    data = json.loads((tmp_path / "profile.json").read_text())
+    assert data["phases"][0]["name"] == "solve"
+    assert "peak_rss" in data
+
+    profiler.write(tmp_path / "trace.json", fmt="chrome")
+    trace = json.loads((tmp_path / "trace.json").read_text())
+    (trace_event,) = trace["traceEvents"]
+    assert "peak_rss" in trace["otherData"]
+    assert trace_event["ph"] == "X"
+    assert trace_event["args"]["env"] == "host"
@@ -0,0 +1,214 @@
+import hashlib
+import os
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("conda_build")
+
+from boa.core import source_cache  # noqa: E402
+from boa.core.source_cache import (  # noqa: E402
+    SourceCache,
+    SourceTreeCache,
+    WorkDirSources,
+    fetch_source,
+    fetch_sources,
+    src_cache_fn,
+)
+
+ARCHIVE = b"not really a tarball"
+SHA256 = hashlib.sha256(ARCHIVE).hexdigest()
+
+
+def test_source_cache_get_and_put(tmp_path):
+    cache = SourceCache(str(tmp_path / "store"))
+    dest = str(tmp_path / "foo-1.0.tar.gz")
+    assert not cache.get(SHA256, dest)
+    assert not os.path.exists(dest)
+
+    archive = tmp_path / "downloaded.tar.gz"
+    archive.write_bytes(ARCHIVE)
+    cache.put(SHA256, str(archive))
+    assert os.path.isfile(cache.path(SHA256))
+    # a second put keeps the stored archive
+    cache.put(SHA256, str(archive))
+
+    assert cache.get(SHA256, dest)
+    with open(dest, "rb") as fi:
+        assert fi.read() == ARCHIVE
+    assert not [f for f in os.listdir(tmp_path) if f.endswith(".part")]
+
+
+def test_src_cache_fn():
+    url = "https://example.com/foo-1.0.tar.gz"
+    assert src_cache_fn({"url": url}) is None
+    assert src_cache_fn({"url": url, "sha256": SHA256}).startswith("foo-1.0")
+    assert src_cache_fn({"url": [url], "fn": "bar.tgz", "sha256": SHA256}) != (
+        src_cache_fn({"url": url, "sha256": SHA256})
+    )
+
+
+@pytest.fixture
+def downloads(monkeypatch):
+    calls = []
+
+    def download_to_cache(src_cache, recipe_path, source_dict, verbose=False):
+        calls.append(source_dict["url"])
+        path = os.path.join(src_cache, src_cache_fn(source_dict))
+        with open(path, "wb") as fo:
+            fo.write(ARCHIVE)
+        return path, None
+
+    monkeypatch.setattr(source_cache.source, "download_to_cache", download_to_cache)
+    return calls
+
+
+def _metadata(tmp_path, croot, sources):
+    src_cache = str(tmp_path / croot / "src_cache")
+    os.makedirs(src_cache, exist_ok=True)
+    return SimpleNamespace(
+        path=str(tmp_path),
+        config=SimpleNamespace(src_cache=src_cache, verbose=False),
+        get_section=lambda section: sources,
+    )
+
+
+def test_fetch_source_shares_downloads_between_croots(tmp_path, downloads):
+    cache = SourceCache(str(tmp_path / "store"))
+    source_dict = {"url": "https://example.com/foo-1.0.tar.gz", "sha256": SHA256}
+
+    m = _metadata(tmp_path, "croot1", [source_dict])
+    path = fetch_source(m, source_dict, cache)
+    assert downloads == [source_dict["url"]]
+    assert os.path.isfile(cache.path(SHA256))
+
+    # already in the src_cache of the croot
+    assert fetch_source(m, source_dict, cache) == path
+    # another croot gets it from the store
+    other = _metadata(tmp_path, "croot2", [source_dict])
+    other_path = fetch_source(other, source_dict, cache)
+    assert other_path != path and os.path.isfile(other_path)
+    assert downloads == [source_dict["url"]]
+
+
+def test_fetch_source_without_checksum_is_not_stored(tmp_path, monkeypatch):
+    cache = SourceCache(str(tmp_path / "store"))
+    source_dict = {"url": "https://example.com/foo-1.0.tar.gz"}
+    m = _metadata(tmp_path, "croot", [source_dict])
+
+    def download_to_cache(src_cache, recipe_path, source_dict, verbose=False):
+        path = os.path.join(src_cache, "foo-1.0.tar.gz")
+        with open(path, "wb") as fo:
+            fo.write(ARCHIVE)
+        return path, None
+
+    monkeypatch.setattr(source_cache.source, "download_to_cache", download_to_cache)
+    fetch_source(m, source_dict, cache)
+    fetch_source(m, source_dict, cache)
+    assert not os.path.exists(cache.root)
+
+
+def test_fetch_sources(tmp_path, downloads):
+    sources = [
+        {
+            "url": f"https://example.com/part{i}.tar.gz",
+            "sha256": hashlib.sha256(str(i).encode()).hexdigest(),
+        }
+        for i in range(3)
+    ]
+    sources.append({"path": "../local"})
+    m = _metadata(tmp_path, "croot", sources)
+    paths = fetch_sources(m, SourceCache(str(tmp_path / "store")))
+    assert len(paths) == 3
+    assert sorted(downloads) == sorted(s["url"] for s in sources[:3])
+
+
+class FakeMetaData:
+    def __init__(self, recipe_dir, work_dir, name, source, variant):
+        self.path = str(recipe_dir)
+        self.config = SimpleNamespace(work_dir=str(work_dir))
+        self.output = SimpleNamespace(
+            name=name, sections={"source": source}, variant=variant
+        )
+
+    def get_section(self, section):
+        return self.output.sections[section]
+
+
+PINNED = [
+    {
+        "url": "https://example.com/foo-1.0.tar.gz",
+        "sha256": SHA256,
+        "patches": ["fix.patch"],
+    }
+]
+
+
+def test_source_tree_cache_key(tmp_path):
+    (tmp_path / "fix.patch").write_text("first version")
+    trees = SourceTreeCache(SimpleNamespace(croot=str(tmp_path / "croot")))
+    m = FakeMetaData(tmp_path, tmp_path / "work", "foo", PINNED, {})
+    key = trees.key(m)
+    assert key == trees.key(m)
+
+    # patches are part of the key
+    (tmp_path / "fix.patch").write_text("second version")
+    assert trees.key(m) != key
+
+    unpinned = [{"url": "https://example.com/foo-1.0.tar.gz"}]
+    assert trees.key(FakeMetaData(tmp_path, "work", "foo", unpinned, {})) is None
+    step_only = [{"step": "foo-step"}]
+    assert trees.key(FakeMetaData(tmp_path, "work", "foo", step_only, {})) is None
+
+
+def _build(m, artifact):
+    # a build script writing to the (shared) work dir
+    with open(os.path.join(m.config.work_dir, artifact), "w") as fo:
+        fo.write(m.output.name)
+
+
+@pytest.mark.parametrize("source", [PINNED, [{"path": "../src"}]])
+def test_work_dir_sources_multi_output(tmp_path, source):
+    (tmp_path / "fix.patch").write_text("patch")
+    work_dir = tmp_path / "work"
+    downloads = []
+
+    def download(m):
+        downloads.append(m.output.name)
+        os.makedirs(m.config.work_dir, exist_ok=True)
+        with open(os.path.join(m.config.work_dir, "source.c"), "w") as fo:
+            fo.write("int main() {}")
+
+    trees = SourceTreeCache(SimpleNamespace(croot=str(tmp_path / "croot")))
+    sources = WorkDirSources(trees, download)
+
+    def metadata(name, variant, source=source):
+        return FakeMetaData(tmp_path, work_dir, name, source, variant)
+
+    # two outputs of the first variant share the work dir
+    libfoo = metadata("libfoo", {"python": "3.9", "target_platform": "linux-64"})
+    assert sources.prepare(libfoo)
+    _build(libfoo, "libfoo.so")
+    py_foo = metadata("py-foo", {"python": "3.9"})
+    assert not sources.prepare(py_foo)
+    assert (work_dir / "libfoo.so").exists()
+    _build(py_foo, "py_foo.so")
+
+    # the next variant starts from a clean tree
+    libfoo_310 = metadata("libfoo", {"python": "3.10", "target_platform": "linux-64"})
+    assert sources.prepare(libfoo_310)
+    assert sorted(os.listdir(work_dir)) == ["source.c"]
+    _build(libfoo_310, "libfoo.so")
+    assert not sources.prepare(metadata("py-foo", {"python": "3.10"}))
+    assert (work_dir / "libfoo.so").exists()
+
+    # an output with other sources
+    other = metadata("other", {"python": "3.10"}, source=[{"path": "../other"}])
+    assert sources.prepare(other)
+    assert not (work_dir / "libfoo.so").exists()
+
+    if source is PINNED:
+        # the second variant got the tree from the cache
+        assert downloads == ["libfoo", "other"]
+    else:
+        assert downloads == ["libfoo", "libfoo", "other"]
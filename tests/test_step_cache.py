@@ -0,0 +1,100 @@
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("conda_build")
+
+from boa.core.step_cache import (  # noqa: E402
+    StepCache,
+    get_required_step,
+    is_pinned_source,
+)
+
+
+def test_restore_does_not_share_files_with_the_cache(tmp_path):
+    cache = StepCache(SimpleNamespace(croot=str(tmp_path / "croot")))
+    work = tmp_path / "work_step"
+    (work / "build").mkdir(parents=True)
+    (work / "build" / "artifact.o").write_text("step output\n")
+    (work / "link").symlink_to("build")
+
+    key = "ab" * 32
+    dest = tmp_path / "work_consumer"
+    assert not cache.restore(key, dest)
+    assert not dest.exists()
+
+    cache.store(key, work)
+    (dest / "stale").mkdir(parents=True)
+    assert cache.restore(key, dest)
+    assert not (dest / "stale").exists()
+    assert (dest / "link").is_symlink()
+
+    # the consumer builds in the restored tree, in-place writes must not reach
+    # the cache or the next restore
+    with open(dest / "build" / "artifact.o", "a") as fo:
+        fo.write("modified by the consumer\n")
+    other = tmp_path / "work_other"
+    assert cache.restore(key, other)
+    assert (other / "build" / "artifact.o").read_text() == "step output\n"
+
+
+def _output(name, variant, built=True):
+    output = SimpleNamespace(name=name, variant=variant)
+    if built:
+        output.moved_work_dir = f"work_{name}_{variant.get('python')}"
+    return output
+
+
+def test_get_required_step():
+    step_38 = _output("step", {"python": "3.8"})
+    step_39 = _output("step", {"python": "3.9"})
+    outputs = [_output("step", {"python": "3.10"}, built=False), step_38, step_39]
+
+    consumer = _output("pkg", {"python": "3.9", "numpy": "1.21"})
+    assert get_required_step(consumer, "step", outputs) is step_39
+    # variant keys the consumer does not use do not matter
+    assert get_required_step(_output("pkg", {}), "step", outputs) is step_38
+
+    with pytest.raises(RuntimeError, match="step"):
+        get_required_step(_output("pkg", {"python": "3.10"}), "step", outputs)
+    with pytest.raises(RuntimeError, match="other"):
+        get_required_step(consumer, "other", outputs)
+
+
+def test_is_pinned_source():
+    url = "https://example.com/foo-1.0.tar.gz"
+    git_url = "https://github.com/foo/foo.git"
+    assert is_pinned_source({"url": url, "sha256": "ab" * 32})
+    assert not is_pinned_source({"url": url})
+    assert not is_pinned_source({"url": url, "md5": "ab" * 16})
+    assert is_pinned_source({"git_url": git_url, "git_rev": "0123abcd" * 5})
+    # branches and tags move
+    assert not is_pinned_source({"git_url": git_url, "git_rev": "main"})
+    assert not is_pinned_source({"git_url": git_url, "git_rev": "v1.0"})
+    assert not is_pinned_source({"git_url": git_url, "git_rev": "0123abcd"})
+    assert not is_pinned_source({"git_url": git_url})
+    assert is_pinned_source({"step": "foo-step"})
+    assert not is_pinned_source({"path": "../src"})
+
+
+def test_key_contains_the_build_paths(tmp_path):
+    cache = StepCache(SimpleNamespace(croot=str(tmp_path / "croot")))
+
+    def metadata(build_folder):
+        output = SimpleNamespace(
+            name="step",
+            sections={"source": [{"step": "other"}], "build": {}},
+            requirements={},
+            variant={"python": "3.9"},
+        )
+        config = SimpleNamespace(
+            work_dir=f"{build_folder}/work",
+            build_prefix=f"{build_folder}/_build_env",
+            host_prefix=f"{build_folder}/_h_env",
+        )
+        return SimpleNamespace(output=output, config=config, path=str(tmp_path))
+
+    key = cache.key(metadata("/croot/step_1"))
+    assert key == cache.key(metadata("/croot/step_1"))
+    # the restored tree would point to the build folder of another run
+    assert key != cache.key(metadata("/croot/step_2"))
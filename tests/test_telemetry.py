@@ -0,0 +1,64 @@
+import sys
+
+import pytest
+
+from boa.core.profiling import profiler
+from boa.core.telemetry import Metrics, metrics, telemetry
+
+
+def test_prometheus_text(tmp_path):
+    metrics = Metrics()
+    metrics.cache_lookup("step", True)
+    assert metrics.to_prometheus_text() == ""
+
+    metrics.enable()
+    metrics.cache_lookup("step", True)
+    metrics.cache_lookup("step", True)
+    metrics.cache_lookup("source", False)
+    metrics.observe("boa_phase_duration_seconds", 0.3, phase="solve")
+    metrics.observe("boa_phase_duration_seconds", 7, phase="solve")
+    metrics.set_gauge("boa_run_success", 1, command='b"uild')
+
+    package = tmp_path / "foo-1.0-0.tar.bz2"
+    package.write_bytes(b"x" * 100)
+    metrics.record_package(str(package), files_size=400)
+
+    path = tmp_path / "metrics" / "boa.prom"
+    metrics.write(str(path))
+    lines = path.read_text().splitlines()
+
+    assert "# TYPE boa_cache_requests_total counter" in lines
+    assert lines[lines.index("# TYPE boa_cache_requests_total counter") - 1] == (
+        "# HELP boa_cache_requests_total Lookups in the caches of boa by cache and "
+        "result (hit or miss)"
+    )
+    assert 'boa_cache_requests_total{cache="step",result="hit"} 2' in lines
+    assert 'boa_cache_requests_total{cache="source",result="miss"} 1' in lines
+    assert "# TYPE boa_phase_duration_seconds histogram" in lines
+    assert 'boa_phase_duration_seconds_bucket{phase="solve",le="0.1"} 0' in lines
+    assert 'boa_phase_duration_seconds_bucket{phase="solve",le="0.5"} 1' in lines
+    assert 'boa_phase_duration_seconds_bucket{phase="solve",le="10"} 2' in lines
+    assert 'boa_phase_duration_seconds_bucket{phase="solve",le="+Inf"} 2' in lines
+    assert 'boa_phase_duration_seconds_count{phase="solve"} 2' in lines
+    assert 'boa_phase_duration_seconds_sum{phase="solve"} 7.3' in lines
+    assert 'boa_run_success{command="b\\"uild"} 1' in lines
+    assert 'boa_packages_total{format="tar.bz2"} 1' in lines
+    assert 'boa_package_compression_ratio_bucket{format="tar.bz2",le="4"} 1' in lines
+    # Prometheus 0.0.4 has no UNIT and EOF lines
+    assert not [line for line in lines if line.startswith(("# UNIT", "# EOF"))]
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="no peak RSS on Windows")
+def test_telemetry_process_max_rss(tmp_path):
+    path = tmp_path / "boa.prom"
+    try:
+        with telemetry("build", str(path)):
+            pass
+    finally:
+        metrics.reset()
+        profiler.reset()
+    lines = path.read_text().splitlines()
+    assert "# TYPE boa_process_max_rss_bytes gauge" in lines
+    (sample,) = [x for x in lines if x.startswith("boa_process_max_rss_bytes{")]
+    assert sample.startswith('boa_process_max_rss_bytes{command="build"} ')
+    assert int(sample.split()[-1]) > 0
@@ -0,0 +1,73 @@
+import argparse
+import json
+import os
+import tarfile
+from concurrent.futures import Future
+
+import pytest
+
+pytest.importorskip("libmambapy")
+
+from boa.cli import transmute  # noqa: E402
+
+
+def make_package(path):
+    info = path.parent / "info"
+    info.mkdir(exist_ok=True)
+    (info / "index.json").write_text(json.dumps({"name": "foo", "version": "1.0"}))
+    with tarfile.open(path, "w:bz2") as tar:
+        tar.add(info / "index.json", "info/index.json")
+
+
+def run(tmp_path, *files):
+    args = argparse.Namespace(
+        files=[str(f) for f in files],
+        output_folder=str(tmp_path / "out"),
+        compression_level=3,
+        num_jobs=2,
+        metrics_file=None,
+    )
+    transmute.main(args)
+
+
+def test_transmute(tmp_path):
+    package = tmp_path / "foo-1.0-0.tar.bz2"
+    make_package(package)
+    bad = tmp_path / "foo-1.0-0.zip"
+    bad.write_text("")
+
+    # the bad file fails, the package is transmuted anyway
+    with pytest.raises(SystemExit):
+        run(tmp_path, package, bad)
+    outfile = tmp_path / "out" / "foo-1.0-0.conda"
+    assert outfile.is_file()
+    assert os.listdir(tmp_path / "out") == ["foo-1.0-0.conda"]
+
+    # up to date outputs are skipped
+    mtime = outfile.stat().st_mtime_ns
+    run(tmp_path, package)
+    assert outfile.stat().st_mtime_ns == mtime
+
+
+def test_transmute_interrupted(tmp_path, monkeypatch):
+    futures = []
+
+    class Pool:
+        def submit(self, *args):
+            futures.append(Future())
+            return futures[-1]
+
+        def shutdown(self, wait=True):
+            assert not wait
+
+    def iter_files(patterns):
+        yield from patterns
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(transmute, "ProcessPoolExecutor", lambda jobs: Pool())
+    monkeypatch.setattr(transmute, "iter_files", iter_files)
+    with pytest.raises(KeyboardInterrupt):
+        run(tmp_path, *(tmp_path / f"foo-{i}-0.tar.bz2" for i in range(3)))
+    # the queued packages are not transmuted
+    assert len(futures) == 3
+    assert all(future.cancelled() for future in futures)